@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds after a video during which the next video of the same user joins its batch
+BATCH_WINDOW = float(os.environ.get("BATCH_WINDOW", 3))
+# Telegram refuses longer messages
+MESSAGE_LIMIT = 4096
+
+
+def _new_future() -> asyncio.Future:
+    return asyncio.get_running_loop().create_future()
+
+
+@dataclass(eq=False)
+class Batch:
+    """
+    Videos sent together by a user : an album, or videos forwarded in a row.
+
+    The videos share one status message, in which each of them owns a section.
+    They are downloaded one after the other in their order of arrival, each one
+    queued as soon as it is on disk : the next download overlaps the encoding.
+    """
+    chat_id: int
+    media_group_id: str | None = None
+    # Id of the shared status message, once the first video has sent it
+    message_id: asyncio.Future = field(default_factory=_new_future)
+    # Latest status of each video, by section label, in their order of arrival
+    sections: dict[str, str] = field(default_factory=dict)
+    finished: set[str] = field(default_factory=set)
+    downloads: asyncio.Lock = field(default_factory=asyncio.Lock)
+    last_joined: float = field(default_factory=time.monotonic)
+
+    def render(self) -> str:
+        """Text of the status message : the status alone for a single video, one section per video otherwise."""
+        if len(self.sections) == 1:
+            return next(iter(self.sections.values()))
+        header = f"📦 Batch of {len(self.sections)} videos, {len(self.finished)} finished"
+        text = "\n\n".join([header, *(f"▸ {label}\n{status}" for label, status in self.sections.items())])
+        if len(text) > MESSAGE_LIMIT:
+            # Progress bars dropped : the first line of each status is enough to follow the batch
+            text = "\n".join([header, *(f"▸ {label}: {status.splitlines()[0]}"
+                                        for label, status in self.sections.items())])
+        return text[:MESSAGE_LIMIT]
+
+
+class BatchCollector:
+    """
+    Groups the videos of a user into batches : same `media_group_id`, or less
+    than `window` seconds after the previous video.
+    """
+
+    def __init__(self, window: float = BATCH_WINDOW):
+        self.window = window
+        # Batch still open to new videos, by (chat, user)
+        self._open: dict[tuple[int, str], Batch] = {}
+        # Batches with unfinished videos, by (chat, status message)
+        self._messages: dict[tuple[int, int], Batch] = {}
+
+    def join(self, chat_id: int, user_id: str, name: str, media_group_id: str | None = None) -> tuple[Batch, str]:
+        """
+        Add a video to the open batch of its user, or start a new batch.
+
+        Returns:
+            tuple: The batch, and the label of the section of the video.
+        """
+        now = time.monotonic()
+        batch = self._open.get((chat_id, user_id))
+        same_album = batch is not None and media_group_id is not None and batch.media_group_id == media_group_id
+        if batch is None or not (same_album or now - batch.last_joined <= self.window):
+            if batch is not None and len(batch.finished) >= len(batch.sections):
+                self._forget(batch)
+            batch = self._open[(chat_id, user_id)] = Batch(chat_id=chat_id, media_group_id=media_group_id)
+        batch.media_group_id = media_group_id or batch.media_group_id
+        batch.last_joined = now
+        label = f"{len(batch.sections) + 1}. {name}"
+        batch.sections[label] = "⏳ Waiting for the previous downloads..."
+        return batch, label
+
+    def attach(self, batch: Batch, message_id: int) -> None:
+        """Record the status message sent for the first video of a batch."""
+        self._messages[(batch.chat_id, message_id)] = batch
+        batch.message_id.set_result(message_id)
+
+    def render(self, chat_id: int, message_id: int, section: str | None, text: str, finished: bool = False) -> str:
+        """
+        Text of a status message once the status of one of its videos is replaced by `text`,
+        the last status of the video if `finished`.
+        """
+        if section is None:
+            return text
+        batch = self._messages.get((chat_id, message_id))
+        if batch is None:
+            # Batch of a job resumed after a restart : its other videos report again as they go on
+            batch = self._messages[(chat_id, message_id)] = Batch(chat_id=chat_id)
+            batch.message_id.set_result(message_id)
+        batch.sections[section] = text
+        if finished:
+            batch.finished.add(section)
+        return batch.render()
+
+    def is_shared(self, chat_id: int, message_id: int) -> bool:
+        """True when several videos report in this status message."""
+        batch = self._messages.get((chat_id, message_id))
+        return batch is not None and len(batch.sections) > 1
+
+    def finish(self, chat_id: int, message_id: int, section: str | None) -> None:
+        """Mark a video of a batch as over, forgetting the batch once all its videos are and it is closed."""
+        batch = self._messages.get((chat_id, message_id))
+        if batch is None or section is None:
+            return
+        batch.finished.add(section)
+        # Still open : the next video joining it would find the batch gone
+        if len(batch.finished) >= len(batch.sections) and time.monotonic() - batch.last_joined > self.window:
+            self._forget(batch)
+
+    def _forget(self, batch: Batch) -> None:
+        for key, current in list(self._messages.items()):
+            if current is batch:
+                del self._messages[key]
+        for key, current in list(self._open.items()):
+            if current is batch:
+                del self._open[key]
@@ -0,0 +1,294 @@
+"""
+Encoder benchmark over synthetic videos.
+
+Generates deterministic inputs with the lavfi sources of ffmpeg, compresses
+them with the command the bot would run for every combination of the menu
+options, and records speed, resource usage, output size and quality.
+
+    python benchmark.py run --output bench.json --csv bench.csv
+    python benchmark.py run --bitrates 480k,1000k --tunes film --output new.json
+    python benchmark.py compare new.json baseline.json
+
+`compare` exits with status 1 when a result regressed beyond the tolerances,
+so it can gate a change against a saved baseline.
+"""
+import argparse
+import asyncio
+import csv
+import itertools
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+from engine import DEFAULT_PRESET, DEFAULT_VCODEC, build_ffmpeg_command
+from probe import plan_encode, probe_media
+from progress import EncodeProgress, ProgressParser
+
+
+# Synthetic inputs : lavfi video source, size, duration in seconds
+SOURCES = {
+    "testsrc2": ("testsrc2=size=1920x1080:rate=25", 10),
+    "mandelbrot": ("mandelbrot=size=1280x720:rate=25", 20),
+    "noise": ("testsrc2=size=854x480:rate=25,noise=alls=60:allf=t+u:all_seed=42", 5),
+}
+
+# Options offered by the settings menu
+RESOLUTIONS = ["1920:1080", "1280:720", "720:480"]
+BITRATES = ["480k", "1000k", "1500k", "2000k"]
+TUNES = ["animation", "film", "grain", "stillimage", "zerolatency"]
+PRESETS = [DEFAULT_PRESET]
+
+# Columns identifying a run, the other ones are measures
+KEY_FIELDS = ("source", "resolution", "bitrate", "tune", "preset")
+# Measures compared to the baseline, with the direction of an improvement
+COMPARED_FIELDS = {
+    "encode_fps": "higher",
+    "wall_time": "lower",
+    "cpu_time": "lower",
+    "peak_rss_mb": "lower",
+    "output_mb": "lower",
+    "ssim": "higher",
+    "psnr": "higher",
+}
+
+DEFAULT_WORK_DIR = Path(tempfile.gettempdir()) / "compresseuzone-bench"
+
+
+@dataclass
+class BenchmarkResult:
+    """Measures of one encoding."""
+    source: str
+    resolution: str
+    bitrate: str
+    tune: str
+    preset: str
+    input_mb: float
+    output_mb: float
+    frames: int
+    encode_fps: float
+    wall_time: float
+    cpu_time: float
+    peak_rss_mb: float
+    ssim: float | None
+    psnr: float | None
+
+    @property
+    def key(self) -> tuple[str, ...]:
+        return tuple(getattr(self, name) for name in KEY_FIELDS)
+
+
+def make_source(name: str, work_dir: Path) -> Path:
+    """Generate a synthetic input once ; later runs reuse the same file."""
+    video_source, duration = SOURCES[name]
+    path = work_dir / f"{name}.mp4"
+    if path.exists():
+        return path
+    work_dir.mkdir(parents=True, exist_ok=True)
+    partial = path.with_suffix(".part.mp4")
+    subprocess.run([
+        "ffmpeg", "-y", "-loglevel", "error",
+        "-f", "lavfi", "-i", video_source,
+        "-f", "lavfi", "-i", "sine=frequency=440:sample_rate=48000",
+        "-t", str(duration),
+        "-c:v", "libx264", "-preset", "veryfast", "-crf", "12", "-pix_fmt", "yuv420p",
+        "-c:a", "aac", "-b:a", "128k",
+        "-fflags", "+bitexact", "-flags:v", "+bitexact",
+        str(partial)
+    ], check=True)
+    partial.rename(path)
+    return path
+
+
+def run_measured(command: list[str], progress: EncodeProgress) -> tuple[float, float, float]:
+    """
+    Run ffmpeg and measure it.
+
+    Returns:
+        tuple: (wall_time_sec, cpu_time_sec, peak_rss_mb) of the ffmpeg process.
+
+    Raises:
+        RuntimeError: If FFmpeg fails.
+    """
+    parser = ProgressParser(progress)
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    for line in process.stdout:
+        parser.feed(line)
+    stderr = process.stderr.read()
+    # wait4 gives the resource usage of this process only
+    _, status, usage = os.wait4(process.pid, 0)
+    wall_time = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError(f"FFmpeg failed:\n{stderr}")
+    return wall_time, usage.ru_utime + usage.ru_stime, usage.ru_maxrss / 1024
+
+
+def measure_quality(output_path: Path, reference_path: Path, width: int, height: int) -> tuple[float | None, float | None]:
+    """SSIM and PSNR of the output against the input, scaled back to the input size."""
+    result = subprocess.run([
+        "ffmpeg", "-hide_banner", "-nostats",
+        "-i", str(output_path), "-i", str(reference_path),
+        "-lavfi", f"[0:v]scale={width}:{height}:flags=bicubic,split[d1][d2];"
+                  f"[1:v]split[r1][r2];[d1][r1]ssim;[d2][r2]psnr",
+        "-f", "null", "-"
+    ], capture_output=True, text=True)
+    ssim = re.search(r"SSIM .*All:([\d.]+)", result.stderr)
+    psnr = re.search(r"PSNR .*average:([\d.]+|inf)", result.stderr)
+    return (float(ssim.group(1)) if ssim else None,
+            float(psnr.group(1)) if psnr and psnr.group(1) != "inf" else None)
+
+
+async def benchmark_one(source: str, input_path: Path, work_dir: Path,
+                        resolution: str, bitrate: str, tune: str, preset: str) -> BenchmarkResult:
+    """Encode one input with one set of options, as `compress_video` would in a single pass."""
+    info = await probe_media(input_path)
+    output_path = work_dir / f"out_{source}_{resolution.replace(':', 'x')}_{bitrate}_{tune}_{preset}.mp4"
+    output_path.unlink(missing_ok=True)
+    plan = plan_encode(info, "mp4", resolution=resolution, bitrate=bitrate, vcodec=DEFAULT_VCODEC)
+    command = build_ffmpeg_command(input_path, output_path, vcodec=DEFAULT_VCODEC, resolution=resolution,
+                                   bitrate=bitrate, tune=tune, preset=preset, plan=plan)
+
+    progress = EncodeProgress(total_duration=info.duration)
+    wall_time, cpu_time, peak_rss_mb = await asyncio.to_thread(run_measured, command, progress)
+    width, height = info.video.display_size
+    ssim, psnr = await asyncio.to_thread(measure_quality, output_path, input_path, width, height)
+    output_mb = output_path.stat().st_size / (1024 * 1024)
+    output_path.unlink(missing_ok=True)
+
+    return BenchmarkResult(source=source, resolution=resolution, bitrate=bitrate, tune=tune, preset=preset,
+                           input_mb=round(info.size / (1024 * 1024), 3),
+                           output_mb=round(output_mb, 3),
+                           frames=progress.frame,
+                           encode_fps=round(progress.frame / wall_time, 2) if wall_time else 0.0,
+                           wall_time=round(wall_time, 3),
+                           cpu_time=round(cpu_time, 3),
+                           peak_rss_mb=round(peak_rss_mb, 1),
+                           ssim=ssim, psnr=psnr)
+
+
+def environment() -> dict:
+    """Machine description saved with the results : numbers are only comparable on the same setup."""
+    version = subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True).stdout.split("\n")[0]
+    return {"ffmpeg": version, "cpu_count": os.cpu_count(), "platform": platform.platform(),
+            "python": platform.python_version(), "date": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+async def run_benchmark(sources: list[str], resolutions: list[str], bitrates: list[str],
+                        tunes: list[str], presets: list[str], work_dir: Path) -> list[BenchmarkResult]:
+    """Run the whole matrix, one encoding at a time so that the measures do not disturb each other."""
+    inputs = {source: make_source(source, work_dir) for source in sources}
+    matrix = list(itertools.product(sources, resolutions, bitrates, tunes, presets))
+    results = []
+    for number, (source, resolution, bitrate, tune, preset) in enumerate(matrix, start=1):
+        result = await benchmark_one(source, inputs[source], work_dir, resolution, bitrate, tune, preset)
+        print(f"[{number}/{len(matrix)}] {source} {resolution} {bitrate} {tune} {preset}: "
+              f"{result.encode_fps} fps, {result.output_mb} MB, SSIM {result.ssim}", file=sys.stderr)
+        results.append(result)
+    return results
+
+
+def save_results(results: list[BenchmarkResult], json_path: Path, csv_path: Path | None = None) -> None:
+    json_path.write_text(json.dumps({"environment": environment(),
+                                     "results": [asdict(result) for result in results]}, indent=2))
+    if csv_path is not None:
+        with csv_path.open("w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=list(BenchmarkResult.__dataclass_fields__))
+            writer.writeheader()
+            writer.writerows(asdict(result) for result in results)
+
+
+def load_results(path: Path) -> dict[tuple[str, ...], dict]:
+    rows = json.loads(path.read_text())["results"]
+    return {tuple(row[name] for name in KEY_FIELDS): row for row in rows}
+
+
+def compare_results(current: dict[tuple[str, ...], dict], baseline: dict[tuple[str, ...], dict],
+                    tolerance: float, quality_tolerance: float) -> list[str]:
+    """
+    List the regressions of `current` against `baseline`.
+
+    Args:
+        tolerance (float): Accepted relative loss on speed, resources and size (0.1 = 10 %).
+        quality_tolerance (float): Accepted absolute loss on SSIM ; ten times more on PSNR (dB).
+
+    Returns:
+        list: One line per regressed measure.
+    """
+    regressions = []
+    for key, row in current.items():
+        reference = baseline.get(key)
+        if reference is None:
+            continue
+        for name, better in COMPARED_FIELDS.items():
+            new, old = row.get(name), reference.get(name)
+            if new is None or old is None:
+                continue
+            if name in ("ssim", "psnr"):
+                allowed = quality_tolerance * (10 if name == "psnr" else 1)
+                regressed = old - new > allowed
+            elif better == "higher":
+                regressed = new < old * (1 - tolerance)
+            else:
+                regressed = new > old * (1 + tolerance)
+            if regressed:
+                regressions.append(f"{' '.join(key)}: {name} {old} -> {new}")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="run the benchmark matrix")
+    run.add_argument("--sources", default=",".join(SOURCES))
+    run.add_argument("--resolutions", default=",".join(RESOLUTIONS))
+    run.add_argument("--bitrates", default=",".join(BITRATES))
+    run.add_argument("--tunes", default=",".join(TUNES))
+    run.add_argument("--presets", default=",".join(PRESETS))
+    run.add_argument("--work-dir", type=Path, default=DEFAULT_WORK_DIR, help="where inputs are generated and kept")
+    run.add_argument("--output", type=Path, default=Path("benchmark.json"))
+    run.add_argument("--csv", type=Path, default=None)
+    run.add_argument("--baseline", type=Path, default=None, help="compare the results to this file")
+
+    compare = commands.add_parser("compare", help="compare two result files")
+    compare.add_argument("current", type=Path)
+    compare.add_argument("baseline", type=Path)
+
+    for command in (run, compare):
+        command.add_argument("--tolerance", type=float, default=0.10)
+        command.add_argument("--quality-tolerance", type=float, default=0.005)
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        unknown = set(args.sources.split(",")) - set(SOURCES)
+        if unknown:
+            parser.error(f"unknown sources: {', '.join(sorted(unknown))}")
+        results = asyncio.run(run_benchmark(args.sources.split(","), args.resolutions.split(","),
+                                            args.bitrates.split(","), args.tunes.split(","),
+                                            args.presets.split(","), args.work_dir))
+        save_results(results, args.output, args.csv)
+        if args.baseline is None:
+            return 0
+        current_path = args.output
+    else:
+        current_path = args.current
+
+    regressions = compare_results(load_results(current_path), load_results(args.baseline),
+                                  args.tolerance, args.quality_tolerance)
+    for line in regressions:
+        print(f"REGRESSION {line}")
+    print(f"{len(regressions)} regression(s)")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
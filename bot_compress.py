@@ -1,15 +1,15 @@
 import asyncio
-import aiofiles
-import json
+from datetime import timedelta
+from functools import partial
 import logging
 import os
-from pathlib import Path
-import subprocess
 import time
+from pathlib import Path
 
 from dotenv import load_dotenv
-from telegram import (Update,
+from telegram import (Bot, Document, File, Update, Video,
                       InlineKeyboardButton, InlineKeyboardMarkup)
+from telegram.error import BadRequest, TelegramError
 from telegram.helpers import escape_markdown
 from telegram.ext import (ApplicationBuilder,
                           CommandHandler,
@@ -19,6 +19,27 @@ from telegram.ext import (ApplicationBuilder,
                           ContextTypes,
                           filters)
 
+from batches import BatchCollector
+from codec_policy import CodecPolicy
+from compression_queue import (CompressionQueue, QueueScheduler, QueuedJob, AWAITING, ENCODED, FAILED, PENDING,
+                               RUNNING, STAGE_ENCODED, STAGE_UPLOADING, UPLOADING, WORKER_LEASE)
+from encoders import menu_codecs, probe_encoders
+from engine import CompressionEngine, JobCancelled
+from local_files import BOT_API_FILE_URL, BOT_API_URL, LOCAL_MODE, LocalInput, fetch_video, upload_input
+from metrics import MetricsRegistry, MetricsServer
+from outbound import OutboundScheduler
+from pipeline import EncodeResult, choose_options, encode_job, encode_options, parse_renditions, restore_speeds
+from preset_policy import PresetPolicy
+from preview import PREVIEW_CONFIRM_TIMEOUT, EstimateModel, preview_job, restore_estimates
+from probe import probe_duration
+from progress import EncodeProgress, StatusUpdater, format_progress
+from result_cache import CachedResult, ResultCache, encode_key
+from scratch import ScratchFull, ScratchSpace
+from settings_store import SettingsStore, UserSettings
+from streaming import STREAM_ENCODE, StreamingDownload
+from target_size import TARGET_SIZE_OFF, TargetSizeError, parse_size
+from thumbnails import UserThumbnails, cover_path, extract_cover, video_attributes
+from tracing import Tracer, detached_task, record, span
 
 # Configuration du logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -32,75 +53,112 @@ TOKEN = str(os.environ.get("TOKEN"))
 if not TOKEN:
     raise ValueError("TOKEN must be set in environment variables")
 
-# Data file configuration
+# Former data file, imported once into the settings store
 DATA_FILE = "compresse_data.json"
+# Encodings done by worker.py processes sharing the queue database, instead of the bot itself
+REMOTE_WORKERS = os.environ.get("REMOTE_WORKERS", "0") == "1"
+# Seconds between two looks at the jobs of the workers
+REMOTE_POLL_INTERVAL = float(os.environ.get("REMOTE_POLL_INTERVAL", 2))
+
+# === Metrics ===
+metrics_registry = MetricsRegistry()
+stage_latency = metrics_registry.histogram("compressbot_stage_seconds",
+                                           "Duration of each stage of a video job", labels=("stage",))
+settings_latency = metrics_registry.histogram("compressbot_settings_seconds",
+                                              "Latency of the settings store operations", labels=("operation",))
+bytes_in = metrics_registry.counter("compressbot_input_bytes_total", "Size of the videos received")
+bytes_out = metrics_registry.counter("compressbot_output_bytes_total", "Size of the compressed videos")
+compression_ratio = metrics_registry.histogram("compressbot_compression_ratio",
+                                               "Compressed size over original size",
+                                               buckets=(0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2))
+encode_speed = metrics_registry.histogram("compressbot_encode_speed",
+                                          "Seconds of video encoded per second",
+                                          buckets=(0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32))
+job_failures = metrics_registry.counter("compressbot_job_failures_total", "Failed jobs by cause", labels=("cause",))
+metrics_registry.gauge("compressbot_active_jobs", "Jobs in progress",
+                       lambda: compression_queue.count(RUNNING) if REMOTE_WORKERS else job_scheduler.running)
+metrics_registry.gauge("compressbot_queued_jobs", "Jobs waiting in the queue",
+                       lambda: compression_queue.count(PENDING))
+metrics_registry.gauge("compressbot_encoder_processes", "Running ffmpeg encodings",
+                       lambda: compression_engine.active_jobs)
+metrics_registry.gauge("compressbot_scratch_reserved_bytes", "Scratch space reserved by the jobs",
+                       lambda: scratch_space.usage()["reserved"])
+metrics_registry.gauge("compressbot_scratch_free_bytes", "Free space on the scratch filesystem",
+                       lambda: scratch_space.usage()["free"])
+metrics_registry.gauge("compressbot_outbound_queued", "Telegram requests waiting for the flood limits",
+                       lambda: outbound_scheduler.queued)
+metrics_server = MetricsServer(metrics_registry)
+
 
 class BotManager:
+    """Access to the users settings, kept in memory and persisted by the settings store."""
+
+    def __init__(self):
+        self.store = SettingsStore(legacy_json=DATA_FILE,
+                                   on_flush=lambda _, duration: settings_latency.observe(duration, operation="flush"))
 
-    async def load_data(self) -> dict:
-        if not os.path.exists(DATA_FILE):
-            return {}
-        async with aiofiles.open(DATA_FILE, "r") as f:
-            content = await f.read()
-            if not content.strip():
-                return {}
-            return json.loads(content)
-
-    async def save_data(self, data) -> None:
-        async with aiofiles.open(DATA_FILE, "w") as f:
-            await f.write(json.dumps(data, indent=4))
-
-    async def init_new_user(self, user_id, data):
-        if user_id not in data:
-            data[user_id] = {
-                "upload_type": "media",
-                "video_format": "mp4",
-                "compresse_resolution": "720:480",
-                "prefixe": "",
-                "suffixe": "",
-                "thumbnail": "Not exist",
-                "bitrate": "480k",
-                "tune": "film"
-            }
-            await self.save_data(data)
-
-    async def reset_user(self, user_id):
-        data = await self.load_data()
-        data[user_id] = {
-            "upload_type": "media",
-            "video_format": "mp4",
-            "compresse_resolution": "720:480",
-            "prefixe": "",
-            "suffixe": "",
-            "thumbnail": "Not exist",
-            "bitrate": "480k",
-            "tune": "film"
-        }
-        user_dir = Path(Path.cwd() / f"{user_id}")
-        thumbnail_path = user_dir / "thumbnail.jpeg"
-        if thumbnail_path.exists():
-            thumbnail_path.unlink(missing_ok=True)
-        await self.save_data(data)
+    def get_user(self, user_id: str) -> UserSettings:
+        with settings_latency.time(operation="get"), span("settings.get"):
+            return self.store.get(user_id)
+
+    def update_user(self, user_id: str, **values) -> UserSettings:
+        with settings_latency.time(operation="update"), span("settings.update"):
+            return self.store.update(user_id, **values)
+
+    def reset_user(self, user_id: str) -> UserSettings:
+        user_thumbnails.forget(user_id)
+        with settings_latency.time(operation="reset"), span("settings.reset"):
+            return self.store.reset(user_id)
 
 bot_manager = BotManager()
+compression_engine = CompressionEngine()
+compression_queue = CompressionQueue()
+job_scheduler = QueueScheduler(compression_queue, max_running=compression_engine.max_workers)
+status_updater = StatusUpdater()
+outbound_scheduler = OutboundScheduler()
+result_cache = ResultCache()
+scratch_space = ScratchSpace()
+preset_policy = PresetPolicy()
+codec_policy = CodecPolicy()
+estimate_model = EstimateModel()
+batch_collector = BatchCollector()
+user_thumbnails = UserThumbnails()
+tracer = Tracer()
+# Encoding progress of the running queue jobs, by queue job id
+job_progress: dict[int, EncodeProgress] = {}
+# Watcher of the workers, in remote mode
+remote_tasks: set[asyncio.Task] = set()
+# Uploads of the encoded jobs, running outside of the encoding slots
+upload_tasks: set[asyncio.Task] = set()
+# Jobs cancelled while a worker encodes them, released once it has stopped, by queue job id
+remote_cancels: dict[int, QueuedJob] = {}
+# Previewed jobs dropped if not confirmed in time
+preview_timers: set[asyncio.Task] = set()
+# Downloads still running while their job is queued or encoded, by queue job id
+streaming_downloads: dict[int, StreamingDownload] = {}
 
 ASK_PREFIX_SUFFIX = 0
 ASK_THUMBNAIL = 1
 MAX_VIDEO_SIZE_MB = 2000
+# Choices of the target size menu
+TARGET_SIZES = ["10MB", "25MB", "50MB", "100MB", "200MB", "500MB", "2000MB"]
+# Choices of the ladder mode menu
+LADDER_RESOLUTIONS = ["1920:1080", "1280:720", "720:480"]
+LADDER_BITRATES = ["480k", "1000k", "1500k", "2000k"]
 
 # === Menu de paramètre principal ===
-def build_settings_message(user: dict) -> tuple[str, InlineKeyboardMarkup]:
+def build_settings_message(user: UserSettings) -> tuple[str, InlineKeyboardMarkup]:
     """
         Generates the text and keyboard markup for the settings menu.
 
         Args:
-            user (dict): User's saved settings.
+            user (UserSettings): User's saved settings.
 
         Returns:
             tuple: A Markdown-formatted message and its InlineKeyboardMarkup.
         """
 
-    upload_type = "Media" if user['upload_type'] == "document" else "Document"
+    upload_type = "Media" if user.upload_type == "document" else "Document"
     keyboard = [
         [InlineKeyboardButton(f"Upload comme {upload_type}", callback_data="upload_type")],
         [
@@ -116,19 +174,30 @@ def build_settings_message(user: dict) -> tuple[str, InlineKeyboardMarkup]:
             InlineKeyboardButton("Bitrate", callback_data="change_bitrate"),
             InlineKeyboardButton("Tune", callback_data="tune")
         ],
+        [
+            InlineKeyboardButton("🎞 Codec", callback_data="vcodec"),
+            InlineKeyboardButton("🎯 Taille cible", callback_data="target_size")
+        ],
+        [InlineKeyboardButton("🪜 Multi-résolution", callback_data="renditions")],
+        [InlineKeyboardButton(f"👁 Aperçu : {'Désactiver' if user.preview else 'Activer'}",
+                              callback_data="toggle_preview")],
         [InlineKeyboardButton("🔄 Réinitialiser les paramètres", callback_data="reset_user_settings")],
         [InlineKeyboardButton("❌ Close", callback_data="close")]
     ]
     text = (
         "🛠 *Paramètres de compression et d'upload*\n\n"
-        f"Upload as : *{escape_markdown(text=user['upload_type'], version=2).upper()}*\n"
-        f"Compression format : *{escape_markdown(text=user['video_format'], version=2).upper()}*\n"
-        f"Résolution de la compression : *{escape_markdown(text=user['compresse_resolution'], version=2)}*\n"
-        f"Préfixe : `{escape_markdown(text=user['prefixe'], version=2)}`\n"
-        f"Suffixe : `{escape_markdown(text=user['suffixe'], version=2)}`\n"
-        f"Thumbnail : *{escape_markdown(text=user['thumbnail'], version=2)}*\n"
-        f"Compression bitrate : *{escape_markdown(text=user['bitrate'], version=2).upper()}*\n"
-        f"Tune : *{escape_markdown(text=user['tune'], version=2).upper()}*\n"
+        f"Upload as : *{escape_markdown(text=user.upload_type, version=2).upper()}*\n"
+        f"Compression format : *{escape_markdown(text=user.video_format, version=2).upper()}*\n"
+        f"Résolution de la compression : *{escape_markdown(text=user.compresse_resolution, version=2)}*\n"
+        f"Préfixe : `{escape_markdown(text=user.prefixe, version=2)}`\n"
+        f"Suffixe : `{escape_markdown(text=user.suffixe, version=2)}`\n"
+        f"Thumbnail : *{escape_markdown(text=user.thumbnail, version=2)}*\n"
+        f"Compression bitrate : *{escape_markdown(text=user.bitrate, version=2).upper()}*\n"
+        f"Tune : *{escape_markdown(text=user.tune, version=2).upper()}*\n"
+        f"Codec : *{escape_markdown(text=user.vcodec, version=2).upper()}*\n"
+        f"Taille cible : *{escape_markdown(text=user.target_size, version=2).upper()}*\n"
+        f"Multi\\-résolution : *{escape_markdown(text=user.renditions or 'Désactivé', version=2)}*\n"
+        f"Aperçu avant compression : *{'Activé' if user.preview else 'Désactivé'}*\n"
     )
     return text, InlineKeyboardMarkup(keyboard)
 
@@ -139,11 +208,8 @@ async def settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
         Can be triggered by command or callback.
         """
 
-    data = await bot_manager.load_data()
     user_id = str(update.effective_user.id)
-    if user_id not in data:
-        await bot_manager.init_new_user(user_id=user_id, data=data)
-    user = data[user_id]
+    user = bot_manager.get_user(user_id)
 
     text, reply_markup = build_settings_message(user)
 
@@ -183,12 +249,49 @@ async def handle_set_param(update: Update, context: ContextTypes.DEFAULT_TYPE):
     _, param_name, value = query.data.split(" ")
 
     user_id = str(update.effective_user.id)
-    data = await bot_manager.load_data()
-    data[user_id][param_name] = value
-    await bot_manager.save_data(data)
+    try:
+        bot_manager.update_user(user_id, **{param_name: value})
+    except KeyError:
+        await query.answer("❌ Action inconnue")
+        return
     await settings(update, context)
 
 
+# === Mode multi-résolution ===
+def toggle_rendition(value: str, resolution: str, bitrate: str) -> str:
+    """Select a bitrate for a resolution of the ladder, or unselect it if it was already chosen."""
+    pairs = dict(parse_renditions(value))
+    if pairs.get(resolution) == bitrate:
+        del pairs[resolution]
+    else:
+        pairs[resolution] = bitrate
+    return ",".join(f"{res}@{rate}" for res, rate in pairs.items())
+
+
+def build_renditions_keyboard(user: UserSettings) -> InlineKeyboardMarkup:
+    """
+        Generates the ladder mode keyboard : one row of bitrates per resolution.
+
+        Args:
+            user (UserSettings): User's saved settings.
+
+        Returns:
+            InlineKeyboardMarkup: The toggle buttons, the chosen pairs marked.
+        """
+    chosen = dict(parse_renditions(user.renditions))
+    keyboard = []
+    for resolution in LADDER_RESOLUTIONS:
+        height = resolution.split(":")[1]
+        keyboard.append([
+            InlineKeyboardButton(f"{'✅ ' if chosen.get(resolution) == bitrate else ''}{height}p {bitrate}",
+                                 callback_data=f"toggle_rendition {resolution}@{bitrate}")
+            for bitrate in LADDER_BITRATES
+        ])
+    keyboard.append([InlineKeyboardButton("🗑 Désactiver", callback_data="clear_renditions")])
+    keyboard.append([InlineKeyboardButton("⬅️ Retour", callback_data="back_to_settings")])
+    return InlineKeyboardMarkup(keyboard)
+
+
 # === Génération des sous-claviers pour préfixe/suffixe===
 def pre_suffix_keyboard(param_name: str):
     keyboard = [
@@ -228,10 +331,8 @@ async def receive_prefix_suffix(update: Update, context: ContextTypes.DEFAULT_TY
         """
 
     user_id = str(update.effective_user.id)
-    data = await bot_manager.load_data()
     param_name = context.user_data.pop('param_name')
-    data[user_id][f"{param_name}"] = update.message.text + " "
-    await bot_manager.save_data(data)
+    bot_manager.update_user(user_id, **{param_name: update.message.text + " "})
     await context.bot.delete_message(chat_id= update.effective_chat.id, message_id=update.effective_message.id)
 
     last_update = context.user_data.pop('current_update')
@@ -241,10 +342,8 @@ async def receive_prefix_suffix(update: Update, context: ContextTypes.DEFAULT_TY
 
 async def delete_pre_suffix(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    data = await bot_manager.load_data()
     param_name = context.user_data.get('param_name', 'suffixe')
-    data[user_id][param_name] = ""
-    await bot_manager.save_data(data)
+    bot_manager.update_user(user_id, **{param_name: ""})
     last_update = context.user_data.pop('current_update')
     await settings(update=last_update, context=context)
     return ConversationHandler.END
@@ -265,13 +364,15 @@ async def receive_thumbnail(update: Update, context: ContextTypes.DEFAULT_TYPE):
     file_id = update.message.photo[-1].file_id
     file = await context.bot.get_file(file_id)
     user_id = str(update.effective_user.id)
-    user_dir = Path(Path.cwd() / f"{user_id}")
-    user_dir.mkdir(parents=True, exist_ok=True)
-    thumbnail_path = user_dir / "thumbnail.jpeg"
+    thumbnail_path = user_thumbnails.original_path(user_id)
+    thumbnail_path.parent.mkdir(parents=True, exist_ok=True)
     await file.download_to_drive(custom_path=thumbnail_path)
-    data = await bot_manager.load_data()
-    data[user_id]['thumbnail'] = "Exist"
-    await bot_manager.save_data(data)
+    # Normalized once now, not before each upload
+    if await user_thumbnails.get(user_id) is not None:
+        bot_manager.update_user(user_id, thumbnail="Exist")
+    else:
+        user_thumbnails.forget(user_id)
+        bot_manager.update_user(user_id, thumbnail="Not Exist")
     await context.bot.delete_message(update.effective_chat.id, update.effective_message.id)
 
     last_update = context.user_data.pop('current_update')
@@ -281,13 +382,8 @@ async def receive_thumbnail(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def delete_thumbnail(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    user_dir = Path(Path.cwd() / f"{user_id}")
-    thumbnail_path = user_dir / "thumbnail.jpeg"
-    if thumbnail_path.exists():
-        thumbnail_path.unlink(missing_ok=True)
-        data = await bot_manager.load_data()
-        data[user_id]['thumbnail'] = "Not Exist"
-        await bot_manager.save_data(data)
+    if user_thumbnails.forget(user_id):
+        bot_manager.update_user(user_id, thumbnail="Not Exist")
 
     last_update = context.user_data.pop('current_update')
     await settings(update=last_update, context=context)
@@ -295,6 +391,11 @@ async def delete_thumbnail(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def cancel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.callback_query is None:
+        # /cancel sent during a conversation : it ends it, then cancels a job as anywhere else
+        context.user_data.pop('current_update', None)
+        await cancel_job(update, context)
+        return ConversationHandler.END
     await update.callback_query.answer()
     await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=update.effective_message.id)
     return ConversationHandler.END
@@ -320,11 +421,11 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await handle_set_param(update, context)
 
     elif data == "upload_type":
-        data = await bot_manager.load_data()
         user_id = str(update.effective_user.id)
-        data[user_id]['upload_type'] = "media" if data[user_id]['upload_type'] == "document" else "document"
-        await bot_manager.save_data(data)
-        text, reply_markup = build_settings_message(data[user_id])
+        user = bot_manager.get_user(user_id)
+        user = bot_manager.update_user(user_id,
+                                       upload_type="media" if user.upload_type == "document" else "document")
+        text, reply_markup = build_settings_message(user)
         await query.edit_message_text(text=text, parse_mode='MarkdownV2', reply_markup=reply_markup)
 
 
@@ -354,9 +455,77 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
                                                choices=["animation", "film", "grain", "stillimage", "zerolatency"])
         )
 
+    elif data == "vcodec":
+        await query.edit_message_text(
+            "Choisissez le codec vidéo (AUTO : le plus compact que la charge du bot permet, "
+            "le tune n'est appliqué qu'en H.264) :",
+            reply_markup=build_choice_keyboard(param_name="vcodec", choices=menu_codecs())
+        )
+
+    elif data == "target_size":
+        await query.edit_message_text(
+            "Choisissez la taille maximale de la vidéo compressée : le bitrate est calculé "
+            "d'après sa durée, et la vidéo n'est jamais plus lourde que l'originale :",
+            reply_markup=build_choice_keyboard(param_name="target_size", choices=[*TARGET_SIZES, TARGET_SIZE_OFF])
+        )
+
+    elif data == "renditions":
+        user = bot_manager.get_user(str(update.effective_user.id))
+        await query.edit_message_text(
+            "Choisissez un bitrate par résolution : la vidéo est décodée une seule fois "
+            "et chaque résolution est envoyée séparément.",
+            reply_markup=build_renditions_keyboard(user)
+        )
+
+    elif data.startswith("toggle_rendition"):
+        user_id = str(update.effective_user.id)
+        resolution, bitrate = data.split(" ")[1].split("@")
+        user = bot_manager.get_user(user_id)
+        user = bot_manager.update_user(user_id, renditions=toggle_rendition(user.renditions, resolution, bitrate))
+        await query.edit_message_reply_markup(reply_markup=build_renditions_keyboard(user))
+
+    elif data == "clear_renditions":
+        user_id = str(update.effective_user.id)
+        user = bot_manager.update_user(user_id, renditions="")
+        text, reply_markup = build_settings_message(user)
+        await query.edit_message_text(text=text, parse_mode='MarkdownV2', reply_markup=reply_markup)
+
+    elif data == "toggle_preview":
+        user_id = str(update.effective_user.id)
+        user = bot_manager.get_user(user_id)
+        user = bot_manager.update_user(user_id, preview=not user.preview)
+        text, reply_markup = build_settings_message(user)
+        await query.edit_message_text(text=text, parse_mode='MarkdownV2', reply_markup=reply_markup)
+
+    elif data.startswith("confirm_job") or data.startswith("drop_preview"):
+        user_id = str(update.effective_user.id)
+        job_id = int(data.split(" ")[1])
+        job = compression_queue.get(job_id)
+        if job is None or job.user_id != user_id or job.status != AWAITING:
+            await query.answer("❌ Cette tâche n'attend plus de confirmation")
+        elif data.startswith("confirm_job") and compression_queue.confirm(job_id):
+            await query.answer(f"✅ Tâche #{job_id} lancée")
+            await announce_queued(context.bot, compression_queue.get(job_id))
+        elif data.startswith("drop_preview") and await drop_job(job_id, context.bot):
+            await query.answer(f"🚫 Tâche #{job_id} annulée")
+        else:
+            await query.answer("❌ Cette tâche n'attend plus de confirmation")
+        await query.edit_message_reply_markup(reply_markup=None)
+
+    elif data.startswith("cancel_job"):
+        user_id = str(update.effective_user.id)
+        job_id = int(data.split(" ")[1])
+        job = compression_queue.get(job_id)
+        if job is None or job.user_id != user_id or not await drop_job(job_id, context.bot):
+            await query.answer("❌ Cette tâche est déjà terminée")
+        else:
+            await query.answer(f"🚫 Tâche #{job_id} annulée")
+        text, reply_markup = build_queue_message(user_id)
+        await query.edit_message_text(text=text, reply_markup=reply_markup)
+
     elif data == "reset_user_settings":
         user_id = str(update.effective_user.id)
-        await bot_manager.reset_user(user_id)
+        bot_manager.reset_user(user_id)
         await query.answer("🔄 Paramètres réinitialisés")
         await settings(update, context)
 
@@ -372,10 +541,8 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Commande /start : Affiche un message de bienvenue."""
-    data = await bot_manager.load_data()
     user_id = str(update.message.from_user.id)
-    if not user_id in data:
-        await bot_manager.init_new_user(user_id=user_id, data=data)
+    bot_manager.get_user(user_id)
 
     await context.bot.send_message(chat_id=update.effective_chat.id,
                                    text=(
@@ -385,89 +552,176 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                                    )
 
 async def upload_compressed_video(file_path: Path,
-                                  user_settings:dict,
-                                  update: Update,
-                                  context: ContextTypes.DEFAULT_TYPE) -> None:
+                                  user_settings: UserSettings,
+                                  user_id: str,
+                                  chat_id: int,
+                                  bot: Bot) -> CachedResult | None:
+    """
+    Send a compressed video to the user and delete it.
+
+    The thumbnail is the custom one of the user, or else the cover frame chosen
+    during the encoding ; the duration and size of the video are given as well,
+    so that Telegram shows a preview without processing the video again.
+
+    Returns:
+        CachedResult | None: The Telegram file of the sent video, to be reused for identical requests.
+    """
     if not file_path.exists():
-        return
-    if user_settings['upload_type'] == "document":
-        await context.bot.send_document(chat_id=update.effective_chat.id, document=file_path,
-                                        caption=f"*{file_path.stem}*",
-                                        thumbnail=f"{update.effective_user.id}/thumbnail.jpeg",
-                                        parse_mode="Markdown")
-    
+        return None
+    with span("thumbnail"):
+        attributes = await video_attributes(file_path)
+        thumbnail_path = await user_thumbnails.get(user_id)
+        cover = cover_path(file_path)
+        if thumbnail_path is None:
+            # Encodings in segments or several resolutions do not produce the cover
+            thumbnail_path = cover if cover.exists() else await extract_cover(file_path, cover,
+                                                                               attributes.get("duration"))
+    # In local mode the Bot API server reads the files from disk by itself
+    thumbnail = upload_input(thumbnail_path) if thumbnail_path is not None else None
+    bytes_out.inc(file_path.stat().st_size)
+    start_time = time.perf_counter()
+    upload_start = time.time()
+    if user_settings.upload_type == "document":
+        sent = await bot.send_document(chat_id=chat_id, document=upload_input(file_path),
+                                caption=f"*{file_path.stem}*",
+                                thumbnail=thumbnail,
+                                parse_mode="Markdown")
+
     else:
 
-        await context.bot.send_video(chat_id= update.effective_chat.id,
-                                    video=file_path,
-                                    caption=f"*{file_path.stem}*",
-                                    thumbnail=f"{update.effective_user.id}/thumbnail.jpeg",
-                                    parse_mode="Markdown"
-                                    )
-        
+        sent = await bot.send_video(chat_id=chat_id,
+                             video=upload_input(file_path),
+                             caption=f"*{file_path.stem}*",
+                             thumbnail=thumbnail,
+                             parse_mode="Markdown",
+                             **attributes
+                             )
+
+    stage_latency.observe(time.perf_counter() - start_time, stage="upload")
+    record("upload", upload_start, time.time(), output=file_path.name)
     file_path.unlink(missing_ok=True)
+    cover.unlink(missing_ok=True)
+    attachment = sent.effective_attachment
+    return CachedResult(attachment.file_id, user_settings.upload_type) if attachment else None
 
 
-def compress_video(input_path: Path,
-                   output_path: Path,
-                   vcodec: str = "libx264",
-                   resolution: str = "1280:720",
-                   bitrate: str = "480k",
-                   crf: str = "28",
-                   tune: str = "animation",
-                   preset: str = "faster"
-                   ) -> tuple[float, float]:
+def result_key(file_unique_id: str, user_settings: UserSettings) -> str | None:
     """
-    Compress a video using FFmpeg with specified settings.
-
-    Args:
-        input_path (Path): Path to original video.
-        output_path (Path): Path to save compressed video.
-        vcodec (str): video codec to use x264 or x265.
-        resolution (str): Resolution to scale (e.g., "1280:720").
-        bitrate (str): Target bitrate (e.g. 480k, "800k", etc).
-        tune (str): FFmpeg tune preset (e.g. "film", "animation").
-        preset (str): compression preset (e.g. fast, faster, slow
+    Result cache key of a video compressed with these settings.
+    None when the result is personal and must not be shared (custom thumbnail),
+    or made of several files (ladder mode).
+    """
+    if user_settings.thumbnail == "Exist" or user_settings.renditions:
+        return None
+    # "auto" resolves to a codec per job : its results are not those of the default codec
+    return encode_key(file_unique_id, {**encode_options(user_settings), "vcodec": user_settings.vcodec,
+                                       "target_size": user_settings.target_size,
+                                       "video_format": user_settings.video_format})
+
+
+async def reply_from_cache(cache_key: str,
+                           user_settings: UserSettings,
+                           compressed_path: Path,
+                           user_id: str,
+                           chat_id: int,
+                           bot: Bot) -> bool:
+    """
+    Answer with a video already compressed with the same settings,
+    after waiting for an identical compression in progress.
 
     Returns:
-        tuple: (compressed_file_size_MB, compression_duration_sec)
-
-    Raises:
-        RuntimeError: If FFmpeg fails.
+        bool: False if the video has to be compressed.
     """
-    start_time = time.time()
-
-    ffmpeg_cmd = [
-        "ffmpeg",
-        "-n",
-        "-loglevel", "error",
-        "-i", str(input_path),
-        "-map", "0",
-        "-vcodec", vcodec,
-        "-vf", f"scale={resolution}",
-        "-b", bitrate,
-        "-tune", tune,
-        "-preset", preset,
-        str(output_path)
-    ]
+    leader = result_cache.leader(cache_key)
+    if leader is not None:
+        wait_message = await bot.send_message(chat_id=chat_id,
+                                              text="⏳ This video is already being compressed, waiting for it...")
+        await asyncio.shield(leader)
+        await bot.delete_message(chat_id=chat_id, message_id=wait_message.message_id)
+
+    cached = result_cache.lookup(cache_key, user_settings.upload_type)
+    if cached is not None:
+        caption = f"*{compressed_path.stem}*"
+        try:
+            if cached.upload_type == "document":
+                await bot.send_document(chat_id=chat_id, document=cached.file_id,
+                                        caption=caption, parse_mode="Markdown")
+            else:
+                await bot.send_video(chat_id=chat_id, video=cached.file_id,
+                                     caption=caption, parse_mode="Markdown")
+            return True
+        except BadRequest as e:
+            logger.warning(f"Cached file {cached.file_id} refused: {e}")
+            result_cache.forget(cache_key, cached.upload_type)
+
+    if result_cache.fetch_output(cache_key, compressed_path):
+        result = await upload_compressed_video(compressed_path, user_settings, user_id, chat_id, bot)
+        if result is not None:
+            result_cache.store(cache_key, result)
+        return True
+
+    result_cache.miss()
+    return False
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes} min {seconds:02d} s" if minutes else f"{seconds} s"
+
+
+# === Messages de statut ===
+async def set_status(bot: Bot, chat_id: int, message_id: int, text: str,
+                     section: str | None = None, finished: bool = False) -> None:
+    """
+    Edit a status message right away.
 
+    The videos of a batch share their status message : only the `section` of
+    the video is replaced, `finished` once it is its last status. A shared
+    message goes through the throttled edits, which always send its latest text.
+    """
+    text = batch_collector.render(chat_id, message_id, section, text, finished=finished)
+    if batch_collector.is_shared(chat_id, message_id):
+        status_updater.update(bot, chat_id, message_id, text)
+        return
     try:
-        subprocess.run(ffmpeg_cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    except subprocess.CalledProcessError as e:
-        raise RuntimeError(f"FFmpeg failed:\n{e.stderr.decode()}") from e
+        await status_updater.set_final(bot, chat_id, message_id, text)
+    except BadRequest as e:
+        # "Message is not modified" or message deleted by the user
+        logger.debug(f"Status edit of {message_id} ignored: {e}")
 
-    duration = time.time() - start_time
-    size_mb = output_path.stat().st_size / (1024 * 1024)
 
-    input_path.unlink(missing_ok=True)
+def update_status(bot: Bot, chat_id: int, message_id: int, text: str, section: str | None = None) -> None:
+    """Throttled `set_status`, for the progress."""
+    status_updater.update(bot, chat_id, message_id, batch_collector.render(chat_id, message_id, section, text))
 
-    return round(size_mb, 2), round(duration, 2)
+
+async def release_job(job: QueuedJob, result: CachedResult | None = None, keep_files: bool = False) -> None:
+    """
+    End of a job : identical requests waiting for it look the cache up again,
+    and nothing of it is left on disk, unless it is to be resumed (`keep_files`).
+    """
+    payload = job.payload
+    result_cache.end(payload.get("cache_key"), result)
+    tracer.finish(job.job_id)
+    # A partial original cannot be resumed
+    download = streaming_downloads.pop(job.job_id, None)
+    if download is not None:
+        download.cancel()
+    if keep_files:
+        return
+    batch_collector.finish(job.chat_id, payload["message_id"], payload.get("batch_item"))
+    if payload.get("scratch_dir"):
+        await scratch_space.release(payload["scratch_dir"])
 
 
 async def handle_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Handle incoming video or document messages.
-    Validates size and type, then downloads to user-specific folder.
+    Validates size and type, downloads to user-specific folder, then queues the compression.
+
+    Videos of an album, or sent in a row, form a batch : they share a single
+    status message and are downloaded one after the other, each one queued as
+    soon as it is on disk, so that the next download overlaps its encoding.
     """
     user_id = str(update.effective_user.id)
     message = update.message
@@ -490,63 +744,584 @@ async def handle_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
                                        text=f"❌ Video too large: {file_size_mb:.2f} MB (limit is 2000 MB).")
         return
 
-    # User-specific folder
-    user_dir = Path.cwd() / user_id
-    user_dir.mkdir(parents=True, exist_ok=True)
+    # Private copy : the changes below must not reach the stored settings
+    user_settings = bot_manager.get_user(user_id).copy()
 
-    # Download original video
-    file_path = user_dir / f"original_{file_name}{extension}"
-    upload_message = await context.bot.send_message(chat_id=update.effective_chat.id,
-                                   text="📥 Downloading video...")
-    telegram_file = await context.bot.get_file(file.file_id)
+    # To avoid encodage incompatibilité
+    if extension == ".mkv":
+        user_settings.video_format = "mkv"
+
+    # Working directory of this job only : videos with the same name do not collide
+    job_dir = scratch_space.create(user_id)
+    filename = f"{user_settings.prefixe} {file_name}{user_settings.suffixe}.{user_settings.video_format or 'mkv'}"
+    compressed_path = job_dir.path / filename
+
+    # Same video already compressed with the same settings : nothing to download nor encode
+    cache_key = result_key(file.file_unique_id, user_settings)
+    if cache_key is not None:
+        if await reply_from_cache(cache_key, user_settings, compressed_path,
+                                  user_id, update.effective_chat.id, context.bot):
+            await scratch_space.release(job_dir.path)
+            return
+        result_cache.begin(cache_key)
+
+    # Videos of an album or sent in a row share one status message
+    chat_id = update.effective_chat.id
+    batch, section = batch_collector.join(chat_id, user_id, file_name or file.file_unique_id,
+                                          media_group_id=message.media_group_id)
+    if len(batch.sections) == 1:
+        try:
+            status_message = await context.bot.send_message(chat_id=chat_id, text="📥 Downloading video...")
+        except BaseException:
+            batch.message_id.cancel()
+            raise
+        batch_collector.attach(batch, status_message.message_id)
+        message_id = status_message.message_id
+        batch_collector.render(chat_id, message_id, section, status_message.text)
+    else:
+        message_id = await batch.message_id
+        update_status(context.bot, chat_id, message_id, "⏳ Waiting for the previous downloads...", section)
+
+    async def on_wait(reason: str) -> None:
+        await set_status(context.bot, chat_id, message_id, f"⏳ Waiting for disk space: {reason}", section)
+
+    # One download at a time in a batch, in the order the videos were sent
+    async with batch.downloads:
+        # Room for the original, the output and the segments, or wait for other jobs to free it
+        try:
+            with span("scratch.admit"):
+                await scratch_space.admit(job_dir, file.file_size, on_wait=on_wait)
+        except ScratchFull as e:
+            job_failures.inc(cause="scratch_full")
+            result_cache.end(cache_key, None)
+            await scratch_space.release(job_dir.path)
+            await set_status(context.bot, chat_id, message_id,
+                             f"❌ Not enough space to process this video: {e}", section, finished=True)
+            batch_collector.finish(chat_id, message_id, section)
+            return
+        if batch.sections[section] != "📥 Downloading video...":
+            await set_status(context.bot, chat_id, message_id, "📥 Downloading video...", section)
+        with span("getFile"):
+            telegram_file = await context.bot.get_file(file.file_id)
+
+        def enqueue(input_path: Path, owns_input: bool, streaming: bool = False) -> QueuedJob:
+            # The compression waits its turn in the queue : settings are frozen at submission time
+            queued = compression_queue.enqueue(user_id=user_id,
+                                               chat_id=chat_id,
+                                               payload={
+                                                   "input_path": str(input_path),
+                                                   "owns_input": owns_input,
+                                                   "streaming": streaming,
+                                                   "output_path": str(compressed_path),
+                                                   "message_id": message_id,
+                                                   "batch_item": section,
+                                                   "source_message_id": message.message_id,
+                                                   "cache_key": cache_key,
+                                                   "scratch_dir": str(job_dir.path),
+                                                   "settings": user_settings.to_dict()
+                                               },
+                                               # Ladder mode outputs several files, no single estimate to show
+                                               hold=user_settings.preview and not user_settings.renditions)
+            # The trace of this update goes on with the job
+            tracer.attach(queued.job_id)
+            return queued
+
+        # Download original video
+        file_path = job_dir.path / f"original_{file_name}{extension}"
+        download = start_streaming_download(telegram_file, file, file_path, user_settings)
+        if download is not None and await download.wait_streamable():
+            # Queued at once : the encoding follows the rest of the transfer
+            job = enqueue(file_path, owns_input=True, streaming=True)
+            streaming_downloads[job.job_id] = download
+            bytes_in.inc(file.file_size or 0)
+            await announce_queued(context.bot, job)
+            try:
+                with stage_latency.time(stage="download"), span("download", streaming=True):
+                    await download.wait()
+            except RuntimeError as e:
+                # Reported by the job, which cannot be encoded without its whole input
+                logger.error(f"Download error of job {job.job_id}: {e}")
+            return
+        try:
+            with stage_latency.time(stage="download"), span("download"):
+                if download is not None:
+                    # Not streamable : encoded once complete, as any other download
+                    local_input = LocalInput(await download.wait())
+                else:
+                    # Hardlink of the Bot API server copy when possible, download otherwise
+                    local_input = await fetch_video(telegram_file, file_path)
+            file_path = local_input.path
+        except Exception as e:
+            logger.error(f"Download error: {e}")
+            job_failures.inc(cause="download")
+            result_cache.end(cache_key, None)
+            await scratch_space.release(job_dir.path)
+            await set_status(context.bot, chat_id, message_id,
+                             "❌ Failed to download the video.", section, finished=True)
+            batch_collector.finish(chat_id, message_id, section)
+            return
 
-    try:
-        await telegram_file.download_to_drive(custom_path=file_path)
-    except Exception as e:
-        logger.error(f"Download error: {e}")
-        await context.bot.edit_message_text(chat_id= update.effective_chat.id,
-                                            message_id=upload_message.message_id,
-                                            text="❌ Failed to download the video.")
+    if not file_path.exists():
+        job_failures.inc(cause="download")
+        result_cache.end(cache_key, None)
+        await scratch_space.release(job_dir.path)
+        await set_status(context.bot, chat_id, message_id,
+                         "✅ Quelque chose s'est mal passée\n", section, finished=True)
+        batch_collector.finish(chat_id, message_id, section)
+        return
+
+    bytes_in.inc(file.file_size or file_path.stat().st_size)
 
+    job = enqueue(file_path, owns_input=local_input.owned)
+    if job.status == AWAITING:
+        await offer_preview(context.bot, job)
         return
+    await announce_queued(context.bot, job)
 
-    await context.bot.edit_message_text(chat_id= update.effective_chat.id,
-                                        message_id=upload_message.message_id,
-                                   text="✅ Video downloaded successfully\n"
-                                        "Begin compression.....")
 
-    data = await bot_manager.load_data()
-    user_settings = data[user_id]
-    if not file_path.exists():
-        await context.bot.edit_message_text(chat_id=update.effective_chat.id,
-                                            message_id=upload_message.message_id,
-                                            text="✅ Quelque chose s'est mal passée\n")
+def start_streaming_download(telegram_file: File, file: Video | Document, file_path: Path,
+                             user_settings: UserSettings) -> StreamingDownload | None:
+    """
+    Start the download of a video in the background when its encoding may follow the transfer.
+
+    Only files fetched from a remote Bot API server can : in local mode the server
+    gives the file once it has it all. The job must also be encoded by the bot
+    itself, in a single output and without preview, which need the whole file.
+
+    Returns:
+        StreamingDownload | None: The started download, None to fetch the file as usual.
+    """
+    if not STREAM_ENCODE or LOCAL_MODE or REMOTE_WORKERS or user_settings.preview or user_settings.renditions:
+        return None
+    if not (telegram_file.file_path or "").startswith(("http://", "https://")):
+        return None
+    duration = getattr(file, "duration", None)
+    if isinstance(duration, timedelta):
+        duration = duration.total_seconds()
+    download = StreamingDownload(telegram_file.file_path, file_path, total_size=file.file_size,
+                                 duration=float(duration) if duration else None)
+    download.start()
+    return download
+
+
+async def announce_queued(bot: Bot, job: QueuedJob) -> None:
+    """Tell the user the position of a job which just entered the queue."""
+    position = compression_queue.position(job)
+    wait = compression_queue.estimated_wait(job, encode_slots())
+    downloaded = ("📥 Downloading, the compression follows the transfer\n" if job.payload.get("streaming")
+                  else "✅ Video downloaded successfully\n")
+    await set_status(bot, job.chat_id, job.payload["message_id"],
+                     downloaded +
+                     f"⏳ Job #{job.job_id} queued at position {position + 1} "
+                     f"(estimated wait: {format_duration(wait)})\n"
+                     "Use /queue to follow it or /cancel to drop it.",
+                     job.payload.get("batch_item"))
+    job_scheduler.notify()
+
+
+# === Aperçu avant compression ===
+async def offer_preview(bot: Bot, job: QueuedJob) -> None:
+    """
+    Encode a few samples of a held job, then send a preview clip with the
+    estimated size and time and let the user confirm or drop the job.
+    Without a preview (unknown duration, ffmpeg error) the job is queued at once.
+    """
+    payload = job.payload
+    user_settings = UserSettings.from_dict(payload["settings"])
+    # Identical requests must not wait for a confirmation that may never come
+    result_cache.end(payload.get("cache_key"), None)
+    await set_status(bot, job.chat_id, payload["message_id"], "🔍 Encoding a preview...", payload.get("batch_item"))
+    try:
+        with stage_latency.time(stage="preview"), span("preview"):
+            # The samples must be encoded as the job will be, with the codec and preset the load gives now
+            input_path = Path(payload["input_path"])
+            options, choices = choose_options(user_settings, await probe_duration(input_path), compression_queue,
+                                              preset_policy, encode_slots(), codecs=codec_policy)
+            preview = await preview_job(compression_engine, input_path,
+                                        Path(payload["scratch_dir"]),
+                                        video_format=user_settings.video_format or "mkv",
+                                        model=estimate_model,
+                                        target_size=None if user_settings.renditions
+                                        else parse_size(user_settings.target_size),
+                                        **options)
+    except Exception as e:
+        logger.warning(f"No preview for job {job.job_id}: {e}")
+        if compression_queue.confirm(job.job_id):
+            await announce_queued(bot, compression_queue.get(job.job_id))
         return
+    # The job is encoded as its samples were, for the estimate to hold and to fit the model on
+    compression_queue.update_payload(job.job_id, estimate=preview.raw.to_dict(), **choices)
+
+    estimate = preview.estimate
+    caption = (f"🔍 Preview of job #{job.job_id}\n"
+               f"📦 Estimated size: {estimate.size_mb:.1f} MB (original {estimate.input_mb:.1f} MB)\n"
+               f"⏱ Estimated compression time: {format_duration(estimate.seconds)}")
+    # A target size never gives a file bigger than the original
+    if estimate.bigger and parse_size(user_settings.target_size) is None:
+        caption += (f"\n⚠️ At {user_settings.bitrate} the video would not get smaller than the original: "
+                    "lower the bitrate or the resolution in /settings.")
+    keyboard = InlineKeyboardMarkup([[
+        InlineKeyboardButton("✅ Compresser", callback_data=f"confirm_job {job.job_id}"),
+        InlineKeyboardButton("❌ Annuler", callback_data=f"drop_preview {job.job_id}")
+    ]])
+    try:
+        await bot.send_video(chat_id=job.chat_id, video=upload_input(preview.clip), caption=caption,
+                             reply_markup=keyboard, reply_to_message_id=payload["source_message_id"])
+    finally:
+        preview.clip.unlink(missing_ok=True)
+    await set_status(bot, job.chat_id, payload["message_id"],
+                     f"👁 Job #{job.job_id} waiting for your confirmation...", payload.get("batch_item"))
+    start_preview_timer(bot, job.job_id, PREVIEW_CONFIRM_TIMEOUT)
 
-    # To avoid encodage incompatibilité
-    if extension == ".mkv":
-        user_settings['video_format'] = "mkv"
 
-    parent = file_path.parent
-    stem = file_path.stem.replace("original_", "")
-    filename = f"{user_settings['prefixe']} {stem}{user_settings['suffixe']}.{user_settings.get('video_format', "mkv")}"
-    compressed_path = parent / filename
+def start_preview_timer(bot: Bot, job_id: int, delay: float) -> None:
+    """Drop a previewed job if it is still not confirmed after `delay` seconds."""
+    async def expire() -> None:
+        await asyncio.sleep(max(0.0, delay))
+        job = compression_queue.get(job_id)
+        if job is not None and job.status == AWAITING:
+            logger.info(f"Job {job_id} not confirmed in time, dropped")
+            await drop_job(job_id, bot)
+
+    task = detached_task(expire(), name=f"preview-timer-{job_id}")
+    preview_timers.add(task)
+    task.add_done_callback(preview_timers.discard)
 
+
+def encode_slots() -> int:
+    """Number of jobs encoded at the same time, by the bot or by the live workers."""
+    if REMOTE_WORKERS:
+        return compression_queue.worker_slots(max_age=WORKER_LEASE)
+    return job_scheduler.max_running
+
+
+async def deliver_job(bot: Bot, job: QueuedJob, encoded: EncodeResult) -> CachedResult | None:
+    """
+    Report the end of the encoding of a job and upload its outputs.
+
+    Returns:
+        CachedResult | None: The Telegram file of a single output, to be reused for identical requests.
+    """
+    payload = job.payload
+    user_settings = UserSettings.from_dict(payload["settings"])
+    cache_key = payload.get("cache_key")
+    section = payload.get("batch_item")
+    outputs = [Path(output) for output in encoded.outputs]
+    stage_latency.observe(encoded.duration, stage="encode")
+    if payload.get("estimate") and len(outputs) == 1:
+        estimate_model.record(payload["estimate"], encoded.size_mb, encoded.duration)
+    compression_queue.checkpoint(job.job_id, STAGE_UPLOADING)
+    # Outputs already sent before a restart are not sent twice
+    uploaded = list(payload.get("uploaded", []))
+
+    # Ladder mode : one upload per resolution, smallest first
+    if len(outputs) > 1:
+        await set_status(bot, job.chat_id, payload["message_id"],
+                         f"✅ Compression complete: {len(outputs)} resolutions in {encoded.duration}s", section)
+        for output_path in outputs:
+            if str(output_path) in uploaded:
+                continue
+            await upload_compressed_video(output_path, user_settings, job.user_id, job.chat_id, bot)
+            uploaded.append(str(output_path))
+            compression_queue.update_payload(job.job_id, uploaded=uploaded)
+        await report_sent(bot, job, f"✅ Sent: {len(outputs)} resolutions")
+        return None
+
+    compressed_path = outputs[0]
+    if str(compressed_path) in uploaded:
+        return None
+    if encoded.input_size:
+        compression_ratio.observe(compressed_path.stat().st_size / encoded.input_size)
+    if encoded.speed:
+        encode_speed.observe(encoded.speed)
+    await set_status(bot, job.chat_id, payload["message_id"],
+                     f"✅ Compression complete: {encoded.size_mb}MB in {encoded.duration}s", section)
+    if cache_key is not None:
+        result_cache.keep_output(cache_key, compressed_path)
+    result = await upload_compressed_video(compressed_path, user_settings, job.user_id, job.chat_id, bot)
+    await report_sent(bot, job, f"✅ Sent: {encoded.size_mb}MB in {encoded.duration}s")
+    return result
+
+
+async def report_sent(bot: Bot, job: QueuedJob, text: str) -> None:
+    """Show in a batch message that the video of a job was sent ; a single video is seen arriving."""
+    if batch_collector.is_shared(job.chat_id, job.payload["message_id"]):
+        await set_status(bot, job.chat_id, job.payload["message_id"], text, job.payload.get("batch_item"),
+                         finished=True)
+
+
+def resumable_result(job: QueuedJob) -> EncodeResult | None:
+    """Encoding of a job finished before a restart, if its outputs are still there to be uploaded."""
+    if job.stage not in (STAGE_ENCODED, STAGE_UPLOADING) or not job.result or job.result.get("error"):
+        return None
+    encoded = EncodeResult.from_dict(job.result)
+    uploaded = set(job.payload.get("uploaded", []))
+    if all(output in uploaded or Path(output).exists() for output in encoded.outputs):
+        return encoded
+    return None
+
+
+async def notify_resumed_jobs(bot: Bot, jobs: list[QueuedJob]) -> None:
+    """Tell the users that their jobs interrupted by a restart go on."""
+    for job in jobs:
+        if resumable_result(job) is not None:
+            text = f"🔄 The bot restarted: job #{job.job_id} was already compressed, sending it now."
+        else:
+            text = f"🔄 The bot restarted: job #{job.job_id} resumes from the {job.stage} step."
+        try:
+            await bot.send_message(chat_id=job.chat_id, text=text,
+                                   reply_to_message_id=job.payload.get("source_message_id"))
+        except TelegramError as e:
+            logger.warning(f"Cannot notify the resume of job {job.job_id}: {e}")
+
+
+async def run_queued_job(bot: Bot, job: QueuedJob) -> None:
+    """
+    Compress a job taken from the queue, then hand it over to its upload.
+    Called by the scheduler once the job reaches its turn. The upload runs
+    outside of the scheduler slot : the next job is encoded meanwhile.
+    """
+    payload = job.payload
+    file_path = Path(payload["input_path"])
+    compressed_path = Path(payload["output_path"])
+    section = payload.get("batch_item")
+    handed_over = False
+    # Original still being downloaded, encoded as it arrives
+    download = streaming_downloads.get(job.job_id)
+    # This task runs the job only
+    tracer.enter(job.job_id)
+
+    if job.started_at is not None:
+        stage_latency.observe(max(0.0, job.started_at - job.created_at), stage="queue_wait")
+        record("queue_wait", job.created_at, job.started_at)
+
+    encoded = resumable_result(job)
+    if encoded is None and download is None and not file_path.exists():
+        job_failures.inc(cause="missing_input")
+        await release_job(job)
+        await set_status(bot, job.chat_id, payload["message_id"], "✅ Quelque chose s'est mal passée\n", section,
+                         finished=True)
+        raise FileNotFoundError(f"Original video of job {job.job_id} is missing")
+
+    async def on_start(vcodec: str, preset: str) -> None:
+        await set_status(bot, job.chat_id, payload["message_id"],
+                         f"⚙️ Job #{job.job_id}\n"
+                         f"Begin compression ({vcodec}, preset {preset}).....", section)
+
+    def on_progress(progress: EncodeProgress) -> None:
+        job_progress[job.job_id] = progress
+        update_status(bot, job.chat_id, payload["message_id"],
+                      f"⚙️ Job #{job.job_id} compression\n{format_progress(progress)}", section)
+
+    # Encoding runs in the engine worker pool : the event loop stays free for other updates
     try:
-        size_mb, duration = compress_video(
-            input_path=file_path,
-            output_path=compressed_path,
-            resolution=user_settings["compresse_resolution"],
-            bitrate=user_settings["bitrate"],
-            tune=user_settings["tune"]
-        )
-        await context.bot.edit_message_text(chat_id=update.effective_chat.id,
-                                            message_id=upload_message.message_id,
-                                            text=f"✅ Compression complete: {size_mb}MB in {duration}s")
+        # Encoded before a restart : only the upload is left
+        if encoded is None:
+            encoded = await encode_job(compression_engine, compression_queue, preset_policy, job,
+                                       workers=job_scheduler.max_running,
+                                       on_progress=on_progress, on_start=on_start, download=download,
+                                       codecs=codec_policy)
+        handed_over = compression_queue.hand_over(job.job_id)
+        if handed_over:
+            start_upload(bot, compression_queue.get(job.job_id))
+    except (JobCancelled, asyncio.CancelledError):
+        if job_scheduler.stopping:
+            # Interrupted by a shutdown : the original, the encoded segments or the finished
+            # outputs are kept to resume the job from its last checkpoint on next start
+            raise
+        if payload.get("owns_input", True):
+            file_path.unlink(missing_ok=True)
+        compressed_path.unlink(missing_ok=True)
+        await set_status(bot, job.chat_id, payload["message_id"], "🚫 Compression cancelled.", section,
+                         finished=True)
+        raise
     except Exception as e:
-        await message.reply_text(f"❌ Compression failed: {str(e)}")
+        job_failures.inc(cause="target_size" if isinstance(e, TargetSizeError) else "encode")
+        await set_status(bot, job.chat_id, payload["message_id"], "❌ Compression failed.", section, finished=True)
+        await bot.send_message(chat_id=job.chat_id,
+                               text=f"❌ Compression failed: {str(e)}",
+                               reply_to_message_id=payload["source_message_id"])
+        raise
+    finally:
+        job_progress.pop(job.job_id, None)
+        # Once handed over, the upload cleans up after itself
+        if not handed_over:
+            await release_job(job, keep_files=job_scheduler.stopping)
+
+
+# === Envoi des résultats ===
+def start_upload(bot: Bot, job: QueuedJob) -> None:
+    """Upload an encoded job in its own task, without holding an encoding slot."""
+    task = detached_task(upload_job(bot, job), name=f"upload-{job.job_id}")
+    upload_tasks.add(task)
+    task.add_done_callback(upload_tasks.discard)
+
+
+async def upload_job(bot: Bot, job: QueuedJob) -> None:
+    """Upload the result of an encoded job, or report the failure of its encoding by a worker."""
+    tracer.enter(job.job_id)
+    payload = job.payload
+    cache_key = payload.get("cache_key")
+    result = None
+    interrupted = False
+    try:
+        error = job.result.get("error") if job.result else "no result"
+        stage = "encode"
+        try:
+            if error:
+                raise RuntimeError(error)
+            stage = "upload"
+            result = await deliver_job(bot, job, EncodeResult.from_dict(job.result))
+        except Exception as e:
+            logger.error(f"Job {job.job_id} failed: {e}")
+            job_failures.inc(cause=stage)
+            compression_queue.finish(job.job_id, status=FAILED, error=str(e))
+            await set_status(bot, job.chat_id, payload["message_id"], "❌ Compression failed.",
+                             payload.get("batch_item"), finished=True)
+            await bot.send_message(chat_id=job.chat_id,
+                                   text=f"❌ Compression failed: {str(e)}",
+                                   reply_to_message_id=payload["source_message_id"])
+            return
+        if cache_key is not None and result is not None:
+            result_cache.store(cache_key, result)
+        compression_queue.finish(job.job_id)
+    except asyncio.CancelledError:
+        # Bot stopping : the upload is done again on next start
+        interrupted = True
+        raise
+    finally:
+        await release_job(job, result, keep_files=interrupted)
+
+
+# === Remote workers ===
+async def watch_remote_jobs(bot: Bot) -> None:
+    """Relay the progress of the jobs encoded by the workers, and upload their results."""
+    while True:
+        try:
+            for job in await asyncio.to_thread(compression_queue.remote_running):
+                if job.job_id not in job_progress:
+                    job_progress[job.job_id] = EncodeProgress()
+                    stage_latency.observe(max(0.0, job.started_at - job.created_at), stage="queue_wait")
+                    update_status(bot, job.chat_id, job.payload["message_id"],
+                                  f"⚙️ Job #{job.job_id}\n"
+                                  f"Begin compression ({job.payload.get('vcodec', '?')}, "
+                                  f"preset {job.payload.get('preset', '?')}).....",
+                                  job.payload.get("batch_item"))
+                elif job.progress:
+                    progress = EncodeProgress(**job.progress)
+                    if progress != job_progress[job.job_id]:
+                        job_progress[job.job_id] = progress
+                        update_status(bot, job.chat_id, job.payload["message_id"],
+                                      f"⚙️ Job #{job.job_id} compression\n{format_progress(progress)}",
+                                      job.payload.get("batch_item"))
+            for job in await asyncio.to_thread(compression_queue.claim_encoded):
+                job_progress.pop(job.job_id, None)
+                start_upload(bot, job)
+            for job_id in await asyncio.to_thread(compression_queue.cancel_acknowledged, list(remote_cancels)):
+                await release_job(remote_cancels.pop(job_id))
+        except Exception as e:
+            logger.error(f"Cannot follow the remote jobs: {e}")
+        await asyncio.sleep(REMOTE_POLL_INTERVAL)
+
+
+def build_queue_message(user_id: str) -> tuple[str, InlineKeyboardMarkup | None]:
+    """
+        Generates the text and cancel buttons listing the user's queued jobs.
 
-    await upload_compressed_video(compressed_path, user_settings, update, context)
+        Args:
+            user_id (str): Telegram id of the user.
+
+        Returns:
+            tuple: The message text and its InlineKeyboardMarkup (None if the queue is empty).
+        """
+
+    jobs = compression_queue.user_jobs(user_id)
+    if not jobs:
+        return "📭 Aucune vidéo en attente.", None
+
+    lines = ["📋 Vos compressions :"]
+    keyboard = []
+    for job in jobs:
+        name = Path(job.payload["output_path"]).name
+        if job.status == RUNNING:
+            progress = job_progress.get(job.job_id)
+            percent = progress.percent if progress else None
+            state = f"{percent:.0f}%" if percent is not None else "en cours"
+            lines.append(f"⚙️ #{job.job_id} {name} : compression {state}")
+        elif job.status == AWAITING:
+            lines.append(f"👁 #{job.job_id} {name} : en attente de confirmation")
+        elif job.status in (ENCODED, UPLOADING):
+            lines.append(f"📤 #{job.job_id} {name} : envoi en cours")
+            continue
+        else:
+            position = compression_queue.position(job)
+            wait = compression_queue.estimated_wait(job, encode_slots())
+            lines.append(f"⏳ #{job.job_id} {name} : position {position + 1}, attente ~{format_duration(wait)}")
+        keyboard.append([InlineKeyboardButton(f"❌ Annuler #{job.job_id}", callback_data=f"cancel_job {job.job_id}")])
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+
+async def drop_job(job_id: int, bot: Bot) -> bool:
+    """
+    Cancel a pending or running job.
+    A running job cleans up after itself, a pending one is cleaned up here,
+    and one encoded by a worker once the worker has stopped.
+
+    Returns:
+        bool: False if the job was already over.
+    """
+    job = compression_queue.get(job_id)
+    if job is None:
+        return False
+    if compression_queue.cancel_pending(job_id):
+        if job.payload.get("owns_input", True):
+            Path(job.payload["input_path"]).unlink(missing_ok=True)
+        await release_job(job)
+        await set_status(bot, job.chat_id, job.payload["message_id"], "🚫 Compression cancelled.",
+                         job.payload.get("batch_item"), finished=True)
+        return True
+    if REMOTE_WORKERS:
+        # The worker stops the encoding at its next heartbeat, its files are removed once it has
+        if not compression_queue.cancel_running(job_id):
+            return False
+        job_progress.pop(job_id, None)
+        remote_cancels[job_id] = job
+        await set_status(bot, job.chat_id, job.payload["message_id"], "🚫 Compression cancelled.",
+                         job.payload.get("batch_item"), finished=True)
+        return True
+    return await job_scheduler.cancel(job_id)
+
+
+async def show_queue(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Commande /queue : Affiche la position et l'attente estimée des vidéos de l'utilisateur."""
+    text, reply_markup = build_queue_message(str(update.effective_user.id))
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=text, reply_markup=reply_markup)
+
+
+async def cancel_job(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Commande /cancel [numéro] : Annule une compression en attente ou en cours."""
+    user_id = str(update.effective_user.id)
+    jobs = compression_queue.user_jobs(user_id)
+
+    if context.args:
+        try:
+            job_id = int(context.args[0].lstrip("#"))
+        except ValueError:
+            await context.bot.send_message(chat_id=update.effective_chat.id, text="Usage : /cancel <numéro>")
+            return
+        job = next((job for job in jobs if job.job_id == job_id), None)
+    elif len(jobs) == 1:
+        job = jobs[0]
+    else:
+        # Nothing or several jobs : let the user choose from the list
+        await show_queue(update, context)
+        return
+
+    if job is None or not await drop_job(job.job_id, context.bot):
+        await context.bot.send_message(chat_id=update.effective_chat.id,
+                                       text="❌ Aucune compression en cours avec ce numéro.")
+        return
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=f"🚫 Tâche #{job.job_id} annulée.")
 
 
 async def help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -561,7 +1336,14 @@ async def help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "• Bitrate \\(e\\.g\\., 480k, 1000k\\)\n"
         "• Filename prefix\\/suffix\n"
         "• Thumbnail\n"
-        "• FFmpeg tune profile\n\n"
+        "• FFmpeg tune profile\n"
+        "• Video codec \\(H\\.264, HEVC, AV1, VP9, or auto: the smallest file the load allows\\)\n"
+        "• Target size: the bitrate is computed to fit the video in a size, never above the original\n"
+        "• Multi\\-resolution: several resolutions from a single upload\n"
+        "• Preview: a sample clip with the estimated size and time before compressing\n\n"
+        "📋 *Queue*\n"
+        "/queue \\- Show your videos waiting or being compressed\n"
+        "/cancel \\- Cancel a waiting or running compression\n\n"
         "▶️ *How to use*\n"
         "1\\. Set your preferences via /settings\\.\n"
         "2\\. Send me a video file \\(max \\~2000MB for upload\\)\\.\n"
@@ -577,14 +1359,70 @@ async def help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     )
 
 
+async def on_startup(application) -> None:
+    """Start feeding the queued jobs, including those interrupted by the last stop."""
+    await probe_encoders()
+    restore_speeds(preset_policy, compression_queue, codec_policy)
+    restore_estimates(estimate_model, compression_queue.recent_done(last=200))
+    bot_manager.store.start()
+    status_updater.start()
+    await metrics_server.start()
+    scratch_space.start(in_use=lambda: {Path(job.payload["scratch_dir"]) for job in compression_queue.unfinished()
+                                        if job.payload.get("scratch_dir")})
+    compression_queue.recover_uploads()
+    if REMOTE_WORKERS:
+        # Encodings are left to the workers, the bot only uploads their results
+        remote_tasks.add(asyncio.create_task(watch_remote_jobs(application.bot), name="remote-jobs"))
+    else:
+        job_scheduler.start(partial(run_queued_job, application.bot))
+    # Read before the scheduler claims them again
+    resumed = compression_queue.resumed()
+    if not REMOTE_WORKERS:
+        # Uploads interrupted by the restart, the workers results are taken by the watcher
+        for job in await asyncio.to_thread(compression_queue.claim_encoded):
+            start_upload(application.bot, job)
+    if resumed:
+        logger.warning(f"Resuming {len(resumed)} job(s) interrupted by the restart")
+        await notify_resumed_jobs(application.bot, resumed)
+    for job in compression_queue.awaiting():
+        start_preview_timer(application.bot, job.job_id, job.created_at + PREVIEW_CONFIRM_TIMEOUT - time.time())
+
+
+async def on_shutdown(application) -> None:
+    """Stop the running jobs when the bot stops : they will be resumed on next start."""
+    if not REMOTE_WORKERS:
+        await job_scheduler.stop()
+    for download in streaming_downloads.values():
+        download.cancel()
+    for task in [*remote_tasks, *upload_tasks, *preview_timers]:
+        task.cancel()
+    codec_policy.stop()
+    await asyncio.gather(*remote_tasks, *upload_tasks, *preview_timers, return_exceptions=True)
+    await compression_engine.shutdown()
+    await status_updater.stop()
+    await metrics_server.stop()
+    await scratch_space.stop()
+    await bot_manager.store.close()
+
+
 if __name__ == '__main__':
-    application = ApplicationBuilder().token(TOKEN).base_url("http://localhost:8081/bot").read_timeout(2000).write_timeout(2000).local_mode(True).build()
+    application = (ApplicationBuilder().token(TOKEN)
+                   .base_url(BOT_API_URL).base_file_url(BOT_API_FILE_URL)
+                   .read_timeout(2000).write_timeout(2000).local_mode(LOCAL_MODE)
+                   .rate_limiter(outbound_scheduler)
+                   .post_init(on_startup)
+                   .post_shutdown(on_shutdown)
+                   .build())
 
     start_handler = CommandHandler('start', start)
-    settings_handler = CommandHandler('settings', settings)
+    settings_handler = CommandHandler('settings', tracer.handler(settings))
     help_handler = CommandHandler('help', help)
-    main_router_handler = CallbackQueryHandler(callback_router)
-    video_handler = MessageHandler(filters.VIDEO | filters.ATTACHMENT, handle_video)
+    queue_handler = CommandHandler('queue', show_queue)
+    cancel_job_handler = CommandHandler('cancel', cancel_job)
+    main_router_handler = CallbackQueryHandler(tracer.handler(callback_router))
+    # Updates are processed one after the other for the conversations : only the videos, whose
+    # download can take minutes, run in their own task without holding the next updates
+    video_handler = MessageHandler(filters.VIDEO | filters.ATTACHMENT, tracer.handler(handle_video), block=False)
     cancel_handler = CallbackQueryHandler(cancel_callback, pattern="^cancel$")
 
     conv_handler_pre_suffix = ConversationHandler(
@@ -619,10 +1457,12 @@ if __name__ == '__main__':
     application.add_handler(start_handler)
     application.add_handler(settings_handler)
     application.add_handler(help_handler)
+    application.add_handler(queue_handler)
     application.add_handler(conv_handler_thumbnail)
     application.add_handler(conv_handler_pre_suffix)
     application.add_handler(main_router_handler)
     application.add_handler(cancel_handler)
+    application.add_handler(cancel_job_handler)
     application.add_handler(video_handler)
 
     application.run_polling()
\ No newline at end of file
@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import os
+import tempfile
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+from encoders import BACKENDS, DEFAULT_VCODEC, available_encoders, get_backend
+from engine import DEFAULT_PRESET, run_ffmpeg
+from preset_policy import JOB_ENCODE_SLO, PRESET_SPEED_FACTORS, QUEUE_LATENCY_TARGET
+from tracing import detached_task
+
+
+logger = logging.getLogger(__name__)
+
+# Codecs the "auto" mode may choose, among the available ones
+AUTO_VCODECS = os.environ.get("AUTO_VCODECS", "libx264,libx265,libsvtav1,libvpx-vp9").split(",")
+# Measure the speed of each codec on this host, in the background, when the first "auto" job is chosen
+CODEC_CALIBRATION = os.environ.get("CODEC_CALIBRATION", "1") == "1"
+# Synthetic clip encoded by the calibration : lavfi source, duration in seconds
+CALIBRATION_SOURCE = ("testsrc2=size=1280x720:rate=25", 4)
+
+
+@dataclass(frozen=True)
+class CodecChoice:
+    """Codec picked for a job, and why."""
+    vcodec: str
+    reason: str
+
+
+class CodecPolicy:
+    """
+    Chooses the codec of the jobs whose user selected the "auto" mode.
+
+    The codecs are tried from the most efficient (smallest output at the same
+    quality) to the least, and the first one is taken whose encoding :
+
+    * of the job itself stays under `job_slo` seconds, from its speed measured
+      on this host ;
+    * slows the draining of the queue down no more than `latency_target` allows.
+
+    Speeds are kept at the default preset : a job encoded with another preset
+    is converted with the preset speed factors. The codecs never measured are
+    calibrated in the background the first time they are needed, meanwhile
+    their speed is derived from the measured ones.
+    """
+
+    def __init__(self, candidates: list[str] | None = None,
+                 latency_target: float = QUEUE_LATENCY_TARGET,
+                 job_slo: float = JOB_ENCODE_SLO,
+                 smoothing: float = 0.3):
+        self.candidates = sorted((name for name in candidates or AUTO_VCODECS if name in BACKENDS),
+                                 key=lambda name: BACKENDS[name].efficiency)
+        self.latency_target = latency_target
+        self.job_slo = job_slo
+        self.smoothing = smoothing
+        # Moving average of the encoding speed (seconds of video per second) of each codec, at DEFAULT_PRESET
+        self.speeds: dict[str, float] = {}
+        self._calibration: asyncio.Task | None = None
+
+    def record(self, vcodec: str, preset: str, speed: float) -> None:
+        """Take the measured speed of a finished encoding into account."""
+        if speed <= 0 or vcodec not in BACKENDS or preset not in PRESET_SPEED_FACTORS:
+            return
+        speed *= PRESET_SPEED_FACTORS[DEFAULT_PRESET] / PRESET_SPEED_FACTORS[preset]
+        previous = self.speeds.get(vcodec)
+        self.speeds[vcodec] = speed if previous is None else previous + self.smoothing * (speed - previous)
+
+    def estimated_speed(self, vcodec: str) -> float | None:
+        """Expected encoding speed of a codec at the default preset : measured, or derived from the measured ones."""
+        if vcodec in self.speeds:
+            return self.speeds[vcodec]
+        derived = [speed * BACKENDS[vcodec].speed_factor / BACKENDS[measured].speed_factor
+                   for measured, speed in self.speeds.items()]
+        return sum(derived) / len(derived) if derived else None
+
+    def relative_speed(self, vcodec: str) -> float:
+        """Encoding speed of a codec relative to the default one."""
+        speed, default = self.estimated_speed(vcodec), self.estimated_speed(DEFAULT_VCODEC)
+        if speed and default:
+            return speed / default
+        return get_backend(vcodec).speed_factor / BACKENDS[DEFAULT_VCODEC].speed_factor
+
+    def choose(self, video_format: str, duration: float | None, pending: int, workers: int,
+               average_job_time: float) -> CodecChoice:
+        """
+        Pick the codec of a job about to start.
+
+        Args:
+            video_format (str): Container of the output.
+            duration (float): Duration of the video, in seconds.
+            pending (int): Number of jobs waiting in the queue.
+            workers (int): Number of jobs run in parallel.
+            average_job_time (float): Mean run time of the recent jobs.
+
+        Returns:
+            CodecChoice: The codec and the reason of the choice.
+        """
+        self.calibrate_later()
+        backlog = pending * average_job_time / max(1, workers)
+        rejected = None
+        for vcodec in self.candidates:
+            if vcodec not in available_encoders() or not BACKENDS[vcodec].fits(video_format):
+                continue
+            speed = self.estimated_speed(vcodec)
+            if duration and speed and duration / speed > self.job_slo:
+                rejected = (f"{vcodec} would encode in {duration / speed:.0f}s, "
+                            f"above the {self.job_slo:.0f}s job limit")
+                continue
+            slowdown = 1 / self.relative_speed(vcodec)
+            if backlog * slowdown > self.latency_target:
+                rejected = (f"{vcodec} would drain the queue in {backlog * slowdown:.0f}s, "
+                            f"above the {self.latency_target:.0f}s target")
+                continue
+            if rejected is None:
+                return CodecChoice(vcodec, f"smallest output, queue drains in {backlog:.0f}s")
+            return CodecChoice(vcodec, rejected)
+        return CodecChoice(DEFAULT_VCODEC, f"overloaded, {rejected}" if rejected else "no other codec available")
+
+    def calibrate_later(self) -> None:
+        """Start the calibration in the background, once, if a codec has never been measured."""
+        if not CODEC_CALIBRATION or self._calibration is not None:
+            return
+        if all(vcodec in self.speeds for vcodec in self.candidates if vcodec in available_encoders()):
+            return
+        self._calibration = detached_task(self.calibrate(), name="codec-calibration")
+
+    def stop(self) -> None:
+        """Stop a running calibration."""
+        if self._calibration is not None:
+            self._calibration.cancel()
+
+    async def calibrate(self) -> None:
+        """
+        Measure the speed of the available codecs not measured yet, on a short synthetic clip.
+
+        The clip is much simpler than real videos : the measures only seed the
+        estimates, the speeds of the real jobs replace them progressively.
+        """
+        source, length = CALIBRATION_SOURCE
+        for vcodec in self.candidates:
+            if vcodec in self.speeds or vcodec not in available_encoders():
+                continue
+            output_path = Path(tempfile.gettempdir()) / f"calibration_{os.getpid()}_{vcodec}.mkv"
+            command = ["ffmpeg", "-y", "-loglevel", "error", "-f", "lavfi", "-i", f"{source}:duration={length}",
+                       "-map", "0:v", *get_backend(vcodec).video_flags("1000k", "film", DEFAULT_PRESET),
+                       str(output_path)]
+            start_time = time.perf_counter()
+            try:
+                await run_ffmpeg(command)
+            except (OSError, RuntimeError) as e:
+                logger.warning(f"Calibration of {vcodec} failed: {e}")
+                continue
+            finally:
+                output_path.unlink(missing_ok=True)
+            self.record(vcodec, DEFAULT_PRESET, length / (time.perf_counter() - start_time))
+            logger.info(f"Calibrated {vcodec}: {self.speeds[vcodec]:.2f}x real time")
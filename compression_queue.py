@@ -0,0 +1,569 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+
+logger = logging.getLogger(__name__)
+
+JOBS_DB = os.environ.get("JOBS_DB", "compresse_jobs.db")
+# Number of jobs of the same user allowed to run at the same time
+MAX_JOBS_PER_USER = int(os.environ.get("MAX_JOBS_PER_USER", 1))
+# Users served in a higher priority tier, e.g. PRIORITY_USERS="1234:1,5678:2"
+PRIORITY_USERS = {
+    user_id: int(tier or 1)
+    for user_id, _, tier in (entry.strip().partition(":")
+                             for entry in os.environ.get("PRIORITY_USERS", "").split(",") if entry.strip())
+}
+
+# Previewed, waiting for the user to confirm it before entering the queue
+AWAITING = "awaiting"
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+# Cancelled while a worker process encodes it, until the worker has stopped
+CANCELLING = "cancelling"
+# Encoded (by a worker or by the bot itself), waiting for the upload of the result
+ENCODED = "encoded"
+UPLOADING = "uploading"
+
+# Checkpoints of a job, persisted to resume it after a restart
+STAGE_DOWNLOADED = "downloaded"
+STAGE_PROBING = "probing"
+STAGE_ENCODING = "encoding"
+STAGE_ENCODED = "encoded"
+STAGE_UPLOADING = "uploading"
+STAGE_DONE = "done"
+
+# Seconds a worker process holds a job without renewing its lease, and between two renewals
+WORKER_LEASE = float(os.environ.get("WORKER_LEASE", 60))
+WORKER_HEARTBEAT = float(os.environ.get("WORKER_HEARTBEAT", 10))
+
+# Duration used for wait estimations before any job has been completed
+DEFAULT_JOB_DURATION = 120.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    payload TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, priority, job_id);
+CREATE INDEX IF NOT EXISTS jobs_user ON jobs (user_id, status);
+CREATE TABLE IF NOT EXISTS user_turns (
+    user_id TEXT PRIMARY KEY,
+    last_served REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS workers (
+    worker_id TEXT PRIMARY KEY,
+    slots INTEGER NOT NULL,
+    last_seen REAL NOT NULL
+);
+"""
+
+# Columns added after the first release, created on the existing databases
+MIGRATIONS = {
+    "worker_id": "ALTER TABLE jobs ADD COLUMN worker_id TEXT",
+    "lease_until": "ALTER TABLE jobs ADD COLUMN lease_until REAL",
+    "progress": "ALTER TABLE jobs ADD COLUMN progress TEXT",
+    "result": "ALTER TABLE jobs ADD COLUMN result TEXT",
+    "stage": "ALTER TABLE jobs ADD COLUMN stage TEXT",
+    "encoded_at": "ALTER TABLE jobs ADD COLUMN encoded_at REAL",
+}
+
+
+def user_priority(user_id: str) -> int:
+    """Priority tier of a user : 0 by default, higher tiers are served first."""
+    return PRIORITY_USERS.get(str(user_id), 0)
+
+
+@dataclass
+class QueuedJob:
+    """A compression job stored in the queue database."""
+    job_id: int
+    user_id: str
+    chat_id: int
+    status: str
+    priority: int
+    payload: dict = field(default_factory=dict)
+    created_at: float = 0.0
+    started_at: float | None = None
+    finished_at: float | None = None
+    error: str | None = None
+    # Set while a worker process holds the job
+    worker_id: str | None = None
+    lease_until: float | None = None
+    progress: dict | None = None
+    result: dict | None = None
+    # Last checkpoint reached, see the STAGE_* constants
+    stage: str | None = None
+    # End of the encoding, before the upload
+    encoded_at: float | None = None
+
+    @classmethod
+    def from_row(cls, row: sqlite3.Row) -> "QueuedJob":
+        values = dict(row)
+        for name in ("payload", "progress", "result"):
+            if values.get(name) is not None:
+                values[name] = json.loads(values[name])
+        return cls(**values)
+
+
+class CompressionQueue:
+    """
+    Durable job queue stored in a SQLite database.
+
+    Jobs are served by priority tier, then round-robin between users : the user
+    served the longest time ago goes first, so one heavy user cannot delay
+    everybody else. A user never has more than `max_per_user` running jobs.
+
+    The database is also the transport of the worker processes : a worker
+    claims a job with a lease, renews it with heartbeats carrying the progress,
+    and stores the result for the bot to upload. A job whose lease expired
+    (crashed or unreachable worker) is claimed again by another one.
+
+    Each thread has its own connection : the transactions contending with the
+    workers for the database (`claim_next`, `claim_encoded`, `heartbeat`...)
+    are run by the event loops through `asyncio.to_thread`, so that waiting for
+    the write lock never stalls them.
+    """
+
+    def __init__(self, path: str = JOBS_DB, max_per_user: int = MAX_JOBS_PER_USER):
+        self.path = path
+        self.max_per_user = max(1, max_per_user)
+        self._local = threading.local()
+        self._connections: list[sqlite3.Connection] = []
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+        columns = {row["name"] for row in self._db.execute("PRAGMA table_info(jobs)")}
+        for column, statement in MIGRATIONS.items():
+            if column not in columns:
+                self._db.execute(statement)
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        """Connection of the current thread, opened on its first use."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            connection.row_factory = sqlite3.Row
+            self._local.connection = connection
+            self._connections.append(connection)
+        return connection
+
+    def close(self) -> None:
+        for connection in self._connections:
+            connection.close()
+        self._connections.clear()
+        self._local = threading.local()
+
+    def recover(self) -> list[QueuedJob]:
+        """
+        Put back in the queue the jobs left running by a previous process.
+
+        Returns:
+            list: The jobs that were interrupted.
+        """
+        rows = self._db.execute("SELECT * FROM jobs WHERE status = ?", (RUNNING,)).fetchall()
+        self._db.execute("UPDATE jobs SET status = ?, started_at = NULL, worker_id = NULL, lease_until = NULL, "
+                         "progress = NULL WHERE status = ?", (PENDING, RUNNING))
+        return [QueuedJob.from_row(row) for row in rows]
+
+    def recover_uploads(self) -> int:
+        """Put back the uploads interrupted by a restart of the bot. Returns their number."""
+        return self._db.execute("UPDATE jobs SET status = ? WHERE status = ?", (ENCODED, UPLOADING)).rowcount
+
+    def enqueue(self, user_id: str, chat_id: int, payload: dict, priority: int | None = None,
+                hold: bool = False) -> QueuedJob:
+        """Add a job to the queue, or keep it aside until `confirm` with `hold`."""
+        if priority is None:
+            priority = user_priority(user_id)
+        cursor = self._db.execute(
+            "INSERT INTO jobs (user_id, chat_id, status, priority, payload, created_at, stage) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (str(user_id), chat_id, AWAITING if hold else PENDING, priority, json.dumps(payload), time.time(),
+             STAGE_DOWNLOADED)
+        )
+        return self.get(cursor.lastrowid)
+
+    def confirm(self, job_id: int) -> bool:
+        """Put a held job in the queue. Returns False if it is not waiting for a confirmation anymore."""
+        cursor = self._db.execute("UPDATE jobs SET status = ?, created_at = ? WHERE job_id = ? AND status = ?",
+                                  (PENDING, time.time(), job_id, AWAITING))
+        return cursor.rowcount > 0
+
+    def awaiting(self) -> list[QueuedJob]:
+        """Jobs waiting for the confirmation of their user."""
+        rows = self._db.execute("SELECT * FROM jobs WHERE status = ? ORDER BY job_id", (AWAITING,)).fetchall()
+        return [QueuedJob.from_row(row) for row in rows]
+
+    def get(self, job_id: int) -> QueuedJob | None:
+        row = self._db.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return QueuedJob.from_row(row) if row else None
+
+    def update_payload(self, job_id: int, **values) -> None:
+        job = self.get(job_id)
+        if job is None:
+            return
+        job.payload.update(values)
+        self._db.execute("UPDATE jobs SET payload = ? WHERE job_id = ?", (json.dumps(job.payload), job_id))
+
+    def checkpoint(self, job_id: int, stage: str, result: dict | None = None) -> None:
+        """Record the stage reached by a job, with the result of its encoding once it is known."""
+        self._db.execute("UPDATE jobs SET stage = ?, result = COALESCE(?, result), "
+                         "encoded_at = CASE WHEN ? = ? THEN ? ELSE encoded_at END WHERE job_id = ?",
+                         (stage, json.dumps(result) if result is not None else None,
+                          stage, STAGE_ENCODED, time.time(), job_id))
+
+    def resumed(self) -> list[QueuedJob]:
+        """Jobs interrupted after their processing had started, waiting to be resumed."""
+        rows = self._db.execute("SELECT * FROM jobs WHERE status IN (?, ?) AND stage NOT IN (?, ?) ORDER BY job_id",
+                                (PENDING, ENCODED, STAGE_DOWNLOADED, STAGE_DONE)).fetchall()
+        return [QueuedJob.from_row(row) for row in rows]
+
+    def claim_next(self, worker_id: str | None = None, lease: float | None = None) -> QueuedJob | None:
+        """
+        Pick the next job to run and mark it as running.
+
+        Args:
+            worker_id (str): Worker process claiming the job, None for the bot itself.
+            lease (float): Seconds the worker holds the job without a heartbeat.
+
+        Returns:
+            QueuedJob | None: The claimed job, or None if nothing can be started.
+        """
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            expired = self._db.execute(
+                "UPDATE jobs SET status = ?, started_at = NULL, worker_id = NULL, lease_until = NULL, progress = NULL "
+                "WHERE status = ? AND lease_until < ?",
+                (PENDING, RUNNING, now)
+            ).rowcount
+            if expired:
+                logger.warning(f"{expired} job(s) of lost workers put back in the queue")
+            row = self._db.execute(
+                """
+                SELECT jobs.* FROM jobs
+                LEFT JOIN user_turns ON user_turns.user_id = jobs.user_id
+                WHERE jobs.status = :pending
+                  AND (SELECT COUNT(*) FROM jobs AS running
+                       WHERE running.user_id = jobs.user_id AND running.status = :running) < :max_per_user
+                ORDER BY jobs.priority DESC, COALESCE(user_turns.last_served, 0), jobs.job_id
+                LIMIT 1
+                """,
+                {"pending": PENDING, "running": RUNNING, "max_per_user": self.max_per_user}
+            ).fetchone()
+            if row is None:
+                self._db.execute("COMMIT")
+                return None
+            self._db.execute("UPDATE jobs SET status = ?, started_at = ?, worker_id = ?, lease_until = ? "
+                             "WHERE job_id = ?",
+                             (RUNNING, now, worker_id, now + lease if lease else None, row["job_id"]))
+            self._db.execute("INSERT INTO user_turns (user_id, last_served) VALUES (?, ?) "
+                             "ON CONFLICT (user_id) DO UPDATE SET last_served = excluded.last_served",
+                             (row["user_id"], now))
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        return self.get(row["job_id"])
+
+    def finish(self, job_id: int, status: str = DONE, error: str | None = None) -> None:
+        self._db.execute("UPDATE jobs SET status = ?, finished_at = ?, error = ?, "
+                         "stage = CASE WHEN ? = ? THEN ? ELSE stage END WHERE job_id = ?",
+                         (status, time.time(), error, status, DONE, STAGE_DONE, job_id))
+
+    def heartbeat(self, job_id: int, worker_id: str, lease: float, progress: dict | None = None) -> bool:
+        """
+        Renew the lease of a job and store its progress.
+
+        Returns:
+            bool: False if the worker lost the job (cancelled, or reclaimed after its lease expired).
+        """
+        cursor = self._db.execute(
+            "UPDATE jobs SET lease_until = ?, progress = COALESCE(?, progress) "
+            "WHERE job_id = ? AND worker_id = ? AND status = ?",
+            (time.time() + lease, json.dumps(progress) if progress is not None else None, job_id, worker_id, RUNNING)
+        )
+        return cursor.rowcount > 0
+
+    def complete(self, job_id: int, worker_id: str, result: dict) -> bool:
+        """
+        Hand the result of an encoding (or its "error") over to the bot.
+
+        Returns:
+            bool: False if the worker had lost the job.
+        """
+        cursor = self._db.execute(
+            "UPDATE jobs SET status = ?, result = ?, lease_until = NULL WHERE job_id = ? AND worker_id = ? AND status = ?",
+            (ENCODED, json.dumps(result), job_id, worker_id, RUNNING)
+        )
+        return cursor.rowcount > 0
+
+    def release(self, job_id: int, worker_id: str) -> None:
+        """Give a job back to the queue, e.g. when its worker stops."""
+        self._db.execute("UPDATE jobs SET status = ?, started_at = NULL, worker_id = NULL, lease_until = NULL, "
+                         "progress = NULL WHERE job_id = ? AND worker_id = ? AND status = ?",
+                         (PENDING, job_id, worker_id, RUNNING))
+
+    def hand_over(self, job_id: int) -> bool:
+        """
+        Move a job encoded by the bot itself to its upload, freeing its place among the running jobs.
+
+        Returns:
+            bool: False if the job was cancelled meanwhile.
+        """
+        cursor = self._db.execute("UPDATE jobs SET status = ? WHERE job_id = ? AND status = ?",
+                                  (UPLOADING, job_id, RUNNING))
+        return cursor.rowcount > 0
+
+    def claim_encoded(self) -> list[QueuedJob]:
+        """Take the encoded jobs waiting for their upload : results of the workers, uploads interrupted by a restart."""
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self._db.execute("SELECT * FROM jobs WHERE status = ? ORDER BY job_id", (ENCODED,)).fetchall()
+            self._db.execute("UPDATE jobs SET status = ? WHERE status = ?", (UPLOADING, ENCODED))
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        return [QueuedJob.from_row(row) for row in rows]
+
+    def remote_running(self) -> list[QueuedJob]:
+        """Jobs being encoded by worker processes."""
+        rows = self._db.execute("SELECT * FROM jobs WHERE status = ? AND worker_id IS NOT NULL ORDER BY job_id",
+                                (RUNNING,)).fetchall()
+        return [QueuedJob.from_row(row) for row in rows]
+
+    def cancel_running(self, job_id: int) -> bool:
+        """
+        Cancel a job held by a worker, which notices it at its next heartbeat.
+        The job is cancelling until the worker confirms it stopped with `acknowledge_cancel`.
+        """
+        cursor = self._db.execute("UPDATE jobs SET status = ? WHERE job_id = ? AND status = ?",
+                                  (CANCELLING, job_id, RUNNING))
+        return cursor.rowcount > 0
+
+    def acknowledge_cancel(self, job_id: int, worker_id: str) -> bool:
+        """Confirm a worker has stopped a cancelled job and left its files. Returns False if it was not cancelled."""
+        cursor = self._db.execute("UPDATE jobs SET status = ?, finished_at = ?, lease_until = NULL "
+                                  "WHERE job_id = ? AND worker_id = ? AND status = ?",
+                                  (CANCELLED, time.time(), job_id, worker_id, CANCELLING))
+        return cursor.rowcount > 0
+
+    def cancel_acknowledged(self, job_ids: list[int]) -> list[int]:
+        """
+        Among jobs cancelled with `cancel_running`, those whose worker has stopped,
+        or whose lease expired (lost worker) : their files can be removed.
+        """
+        if not job_ids:
+            return []
+        now = time.time()
+        self._db.execute("UPDATE jobs SET status = ?, finished_at = ? WHERE status = ? AND lease_until < ?",
+                         (CANCELLED, now, CANCELLING, now))
+        placeholders = ", ".join("?" * len(job_ids))
+        rows = self._db.execute(f"SELECT job_id FROM jobs WHERE job_id IN ({placeholders}) AND status != ?",
+                                (*job_ids, CANCELLING)).fetchall()
+        return [row["job_id"] for row in rows]
+
+    # === Workers ===
+    def register_worker(self, worker_id: str, slots: int) -> None:
+        """Announce a worker and the number of jobs it runs at once, repeated as a heartbeat."""
+        self._db.execute("INSERT INTO workers (worker_id, slots, last_seen) VALUES (?, ?, ?) "
+                         "ON CONFLICT (worker_id) DO UPDATE SET slots = excluded.slots, last_seen = excluded.last_seen",
+                         (worker_id, slots, time.time()))
+
+    def unregister_worker(self, worker_id: str) -> None:
+        self._db.execute("DELETE FROM workers WHERE worker_id = ?", (worker_id,))
+
+    def worker_slots(self, max_age: float) -> int:
+        """Jobs the workers seen in the last `max_age` seconds can run at once."""
+        row = self._db.execute("SELECT SUM(slots) FROM workers WHERE last_seen > ?",
+                               (time.time() - max_age,)).fetchone()
+        return row[0] or 0
+
+    def cancel_pending(self, job_id: int) -> bool:
+        """Cancel a job which has not started yet. Returns False if it is not pending anymore."""
+        cursor = self._db.execute("UPDATE jobs SET status = ?, finished_at = ? WHERE job_id = ? AND status IN (?, ?)",
+                                  (CANCELLED, time.time(), job_id, PENDING, AWAITING))
+        return cursor.rowcount > 0
+
+    def user_jobs(self, user_id: str) -> list[QueuedJob]:
+        """Unfinished jobs of a user, oldest first."""
+        rows = self._db.execute("SELECT * FROM jobs WHERE user_id = ? AND status IN (?, ?, ?, ?, ?) ORDER BY job_id",
+                                (str(user_id), AWAITING, PENDING, RUNNING, ENCODED, UPLOADING)).fetchall()
+        return [QueuedJob.from_row(row) for row in rows]
+
+    def recent_done(self, last: int = 50) -> list[QueuedJob]:
+        """Last completed jobs, most recent first."""
+        rows = self._db.execute("SELECT * FROM jobs WHERE status = ? ORDER BY finished_at DESC LIMIT ?",
+                                (DONE, last)).fetchall()
+        return [QueuedJob.from_row(row) for row in rows]
+
+    def unfinished(self) -> list[QueuedJob]:
+        """Unfinished jobs of every user, cancelled ones still stopping included."""
+        rows = self._db.execute("SELECT * FROM jobs WHERE status IN (?, ?, ?, ?, ?, ?) ORDER BY job_id",
+                                (AWAITING, PENDING, RUNNING, CANCELLING, ENCODED, UPLOADING)).fetchall()
+        return [QueuedJob.from_row(row) for row in rows]
+
+    def count(self, status: str) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)).fetchone()[0]
+
+    def pending_order(self) -> list[int]:
+        """
+        Predict the order in which pending jobs will be started.
+
+        Replays the scheduling rules : tiers by priority, then inside a tier one
+        job per user per round, users ordered by their last turn.
+        """
+        rows = self._db.execute(
+            "SELECT jobs.job_id, jobs.user_id, jobs.priority, COALESCE(user_turns.last_served, 0) AS last_served "
+            "FROM jobs LEFT JOIN user_turns ON user_turns.user_id = jobs.user_id "
+            "WHERE jobs.status = ? ORDER BY jobs.job_id",
+            (PENDING,)
+        ).fetchall()
+        tiers: dict[int, dict[str, list]] = {}
+        for row in rows:
+            tiers.setdefault(row["priority"], {}).setdefault(row["user_id"], []).append(row)
+
+        order = []
+        for priority in sorted(tiers, reverse=True):
+            users = sorted(tiers[priority].values(), key=lambda jobs: (jobs[0]["last_served"], jobs[0]["job_id"]))
+            for turn in range(max(len(jobs) for jobs in users)):
+                order.extend(jobs[turn]["job_id"] for jobs in users if turn < len(jobs))
+        return order
+
+    def position(self, job: QueuedJob) -> int:
+        """Number of pending jobs expected to start before this one."""
+        if job.status != PENDING:
+            return 0
+        order = self.pending_order()
+        return order.index(job.job_id) if job.job_id in order else 0
+
+    def average_duration(self, last: int = 50) -> float:
+        """
+        Mean time the last encoded jobs held an encoding slot, in seconds : from
+        their start to the end of their encoding, their upload runs outside of the slots.
+        """
+        row = self._db.execute(
+            "SELECT AVG(encoded_at - started_at) FROM "
+            "(SELECT encoded_at, started_at FROM jobs WHERE status IN (?, ?, ?) AND encoded_at >= started_at "
+            "ORDER BY encoded_at DESC LIMIT ?)",
+            (ENCODED, UPLOADING, DONE, last)
+        ).fetchone()
+        return row[0] or DEFAULT_JOB_DURATION
+
+    def estimated_wait(self, job: QueuedJob, workers: int) -> float:
+        """Estimated time in seconds before the job starts, given the number of parallel workers."""
+        if job.status != PENDING:
+            return 0.0
+        running = self.count(RUNNING)
+        rounds = (self.position(job) + running) / max(1, workers)
+        return rounds * self.average_duration()
+
+
+class QueueScheduler:
+    """
+    Feeds jobs from a CompressionQueue to an async runner, with at most
+    `max_running` jobs in progress.
+    """
+
+    def __init__(self, queue: CompressionQueue, max_running: int):
+        self.queue = queue
+        self.max_running = max(1, max_running)
+        self._runner: Callable[[QueuedJob], Awaitable[None]] | None = None
+        self._tasks: dict[int, asyncio.Task] = {}
+        self._wakeup = asyncio.Event()
+        self._loop_task: asyncio.Task | None = None
+        self._stopping = False
+
+    def start(self, runner: Callable[[QueuedJob], Awaitable[None]]) -> None:
+        """Start dispatching jobs to `runner`, recovering those interrupted by a restart."""
+        self._runner = runner
+        interrupted = self.queue.recover()
+        if interrupted:
+            logger.warning(f"{len(interrupted)} interrupted job(s) put back in the queue")
+        self._loop_task = asyncio.create_task(self._dispatch_loop(), name="queue-scheduler")
+
+    def notify(self) -> None:
+        """Wake up the scheduler after a job has been added."""
+        self._wakeup.set()
+
+    def is_running(self, job_id: int) -> bool:
+        return job_id in self._tasks
+
+    @property
+    def stopping(self) -> bool:
+        """True once the scheduler is stopping : the interrupted jobs will be resumed on next start."""
+        return self._stopping
+
+    @property
+    def running(self) -> int:
+        """Number of jobs in progress."""
+        return len(self._tasks)
+
+    async def cancel(self, job_id: int) -> bool:
+        """Cancel a pending or running job. Returns False if the job is already over."""
+        if self.queue.cancel_pending(job_id):
+            return True
+        task = self._tasks.get(job_id)
+        if task is None:
+            return False
+        self.queue.finish(job_id, status=CANCELLED)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return True
+
+    async def stop(self) -> None:
+        """Stop dispatching; running jobs are interrupted and will be resumed on next start."""
+        self._stopping = True
+        if self._loop_task:
+            self._loop_task.cancel()
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.queue.recover()
+
+    async def _dispatch_loop(self) -> None:
+        while True:
+            self._wakeup.clear()
+            while len(self._tasks) < self.max_running:
+                job = await asyncio.to_thread(self.queue.claim_next)
+                if job is None:
+                    break
+                self._tasks[job.job_id] = asyncio.create_task(self._run(job), name=f"job-{job.job_id}")
+            await self._wakeup.wait()
+
+    async def _run(self, job: QueuedJob) -> None:
+        status, error = DONE, None
+        try:
+            await self._runner(job)
+        except asyncio.CancelledError:
+            status = CANCELLED
+            raise
+        except Exception as e:
+            logger.error(f"Job {job.job_id} failed: {e}")
+            status, error = FAILED, str(e)
+        finally:
+            self._tasks.pop(job.job_id, None)
+            current = self.queue.get(job.job_id)
+            # Jobs interrupted by a shutdown stay running, to be recovered on next start
+            if current is not None and current.status == RUNNING and not self._stopping:
+                self.queue.finish(job.job_id, status=status, error=error)
+            self._wakeup.set()
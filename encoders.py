@@ -0,0 +1,166 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+
+from probe import CONTAINER_CODECS, ENCODER_CODECS, parse_bitrate
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_VCODEC = "libx264"
+# Setting value letting the bot choose the codec of each job
+AUTO_VCODEC = "auto"
+
+
+@dataclass(frozen=True)
+class EncoderBackend:
+    """
+    A video encoder of ffmpeg and how the settings of the bot map to its flags.
+
+    The bot speaks in x264 terms (presets from ultrafast to veryslow, tunes) ;
+    each backend translates them, and drops what its encoder does not know.
+    """
+    name: str
+    # Label of the settings menu
+    label: str
+    # Preset of the encoder for each x264 preset, None when it uses the x264 names
+    presets: dict[str, str] | None = None
+    # Tunes the encoder accepts, the others are dropped
+    tunes: frozenset[str] = frozenset()
+    # Bitrate needed for the quality of x264 at the same settings
+    efficiency: float = 1.0
+    # Encoding speed relative to x264 at the same preset, until it has been measured
+    speed_factor: float = 1.0
+    # Flags always given to the encoder
+    extra: tuple[str, ...] = ()
+    # Whether the encoder honours -maxrate/-bufsize with a target bitrate
+    vbv: bool = True
+    # Whether the encoder supports the two-pass mode of ffmpeg (-pass, -passlogfile)
+    two_pass: bool = False
+
+    @property
+    def codec(self) -> str:
+        """Name of the codec produced, as reported by ffprobe."""
+        return ENCODER_CODECS[self.name]
+
+    def fits(self, video_format: str) -> bool:
+        """Whether a file of this container can hold the output of the encoder."""
+        accepted = CONTAINER_CODECS.get(video_format, CONTAINER_CODECS["mkv"])["video"]
+        return accepted is None or self.codec in accepted
+
+    def video_flags(self, bitrate: str, tune: str, preset: str, stream: str = "v:0",
+                    maxrate: str | None = None) -> list[str]:
+        """
+        Encoder flags of the video output stream `stream`.
+
+        Args:
+            bitrate (str): Target bitrate (e.g. "480k").
+            tune (str): x264 tune of the user settings.
+            preset (str): x264 preset chosen for the job.
+            stream (str): Output stream specifier.
+            maxrate (str): Peak bitrate, with a VBV buffer of two seconds at that rate.
+        """
+        flags = [f"-c:{stream}", self.name, f"-b:{stream}", bitrate]
+        if maxrate and self.vbv:
+            flags += [f"-maxrate:{stream}", maxrate, f"-bufsize:{stream}", f"{2 * parse_bitrate(maxrate) // 1000}k"]
+        if tune in self.tunes:
+            flags += [f"-tune:{stream}", tune]
+        return [*flags, *self.preset_flags(self.presets[preset] if self.presets else preset, stream), *self.extra]
+
+    def preset_flags(self, preset: str, stream: str) -> list[str]:
+        return [f"-preset:{stream}", preset]
+
+    def pass_flags(self, number: int, log_prefix: str) -> list[str]:
+        """Flags of one pass of a two-pass encoding, sharing the statistics through `log_prefix`."""
+        return ["-pass", str(number), "-passlogfile", log_prefix]
+
+
+class VP9Backend(EncoderBackend):
+    """libvpx-vp9 has no preset : its speed is set with -deadline and -cpu-used."""
+
+    def preset_flags(self, preset: str, stream: str) -> list[str]:
+        return [f"-deadline:{stream}", "good", f"-cpu-used:{stream}", preset]
+
+
+X264_TUNES = frozenset({"film", "animation", "grain", "stillimage", "fastdecode", "zerolatency", "psnr", "ssim"})
+X265_TUNES = frozenset({"animation", "grain", "fastdecode", "zerolatency", "psnr", "ssim"})
+
+BACKENDS = {backend.name: backend for backend in (
+    EncoderBackend("libx264", "H.264 (x264)", tunes=X264_TUNES, two_pass=True),
+    EncoderBackend("libx265", "HEVC (x265)", tunes=X265_TUNES, efficiency=0.6, speed_factor=0.3,
+                   # Tag expected by Apple players and Telegram clients for HEVC in MP4
+                   extra=("-tag:v", "hvc1", "-x265-params", "log-level=error")),
+    EncoderBackend("libsvtav1", "AV1 (SVT-AV1)",
+                   presets={"ultrafast": "12", "superfast": "11", "veryfast": "10", "faster": "9", "fast": "8",
+                            "medium": "7", "slow": "6", "slower": "5", "veryslow": "4"},
+                   efficiency=0.5, speed_factor=0.5, vbv=False),
+    VP9Backend("libvpx-vp9", "VP9 (libvpx)",
+               presets={"ultrafast": "5", "superfast": "5", "veryfast": "4", "faster": "4", "fast": "3",
+                        "medium": "2", "slow": "1", "slower": "1", "veryslow": "0"},
+               efficiency=0.7, speed_factor=0.25, extra=("-row-mt", "1"), two_pass=True),
+)}
+
+
+def get_backend(vcodec: str) -> EncoderBackend:
+    """Backend of an encoder, x264 flags for an encoder the bot does not know."""
+    return BACKENDS.get(vcodec) or BACKENDS[DEFAULT_VCODEC]
+
+
+# Encoders of BACKENDS found by `probe_encoders`
+_available = frozenset({DEFAULT_VCODEC})
+
+
+async def probe_encoders(timeout: float = 30) -> frozenset[str]:
+    """
+    List the encoders of BACKENDS the installed ffmpeg was built with, once at
+    startup : the handlers only read the result, with `available_encoders`.
+    """
+    global _available
+    try:
+        process = await asyncio.create_subprocess_exec("ffmpeg", "-hide_banner", "-encoders",
+                                                       stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.DEVNULL)
+        try:
+            stdout, _ = await asyncio.wait_for(process.communicate(), timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise
+    except (OSError, asyncio.TimeoutError) as e:
+        logger.warning(f"Cannot list the ffmpeg encoders, only {DEFAULT_VCODEC} used: {e!r}")
+        return _available
+    listed = {line.split()[1] for line in stdout.decode(errors="replace").splitlines() if len(line.split()) > 1}
+    _available = frozenset(name for name in BACKENDS if name in listed) | {DEFAULT_VCODEC}
+    return _available
+
+
+def available_encoders() -> frozenset[str]:
+    """Encoders of BACKENDS the installed ffmpeg was built with, only the default one before `probe_encoders`."""
+    return _available
+
+
+def menu_codecs() -> list[str]:
+    """Choices of the codec menu : the available encoders, then the automatic choice."""
+    return [name for name in BACKENDS if name in available_encoders()] + [AUTO_VCODEC]
+
+
+def resolve_vcodec(vcodec: str, video_format: str) -> str:
+    """
+    Encoder to use for a codec setting : the default one when the setting is
+    "auto" (chosen later by `codec_policy.CodecPolicy`), unknown, not
+    installed, or not accepted by the container.
+    """
+    if vcodec == AUTO_VCODEC:
+        return DEFAULT_VCODEC
+    if vcodec not in BACKENDS or vcodec not in available_encoders():
+        logger.warning(f"Encoder {vcodec} not available, {DEFAULT_VCODEC} used")
+        return DEFAULT_VCODEC
+    if not BACKENDS[vcodec].fits(video_format):
+        logger.info(f"{vcodec} cannot be stored in {video_format}, {DEFAULT_VCODEC} used")
+        return DEFAULT_VCODEC
+    return vcodec
+
+
+def scaled_bitrate(bitrate: str, vcodec: str) -> str:
+    """Bitrate giving with `vcodec` the quality x264 reaches at `bitrate`."""
+    return f"{max(1, round(parse_bitrate(bitrate) * get_backend(vcodec).efficiency / 1000))}k"
@@ -0,0 +1,535 @@
+import asyncio
+import itertools
+import logging
+import os
+import time
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Awaitable, Callable
+
+from encoders import DEFAULT_VCODEC, get_backend
+from probe import EncodePlan, StreamPlan, probe_duration
+from progress import EncodeProgress, ProgressParser
+from tracing import record, span
+
+
+logger = logging.getLogger(__name__)
+
+# Number of ffmpeg processes allowed to run at the same time
+DEFAULT_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+COMPRESS_WORKERS = int(os.environ.get("COMPRESS_WORKERS", DEFAULT_WORKERS))
+
+DEFAULT_PRESET = "faster"
+
+# Makes ffmpeg report its progress on stdout, read by the engine
+PROGRESS_ARGS = ["-progress", "pipe:1", "-nostats"]
+# Input of the commands whose input is written to ffmpeg by the engine (see `CompressionJob.feed_input`)
+PIPE_INPUT = "pipe:0"
+
+# Number of CPUs shared by the encodings, 0 for every CPU the bot may use
+ENCODER_CPU_BUDGET = int(os.environ.get("ENCODER_CPU_BUDGET", 0))
+# Pin each encoding to its own CPUs
+ENCODER_CPU_AFFINITY = os.environ.get("ENCODER_CPU_AFFINITY", "0") == "1"
+# Niceness of the ffmpeg processes : the event loop of the bot keeps the priority
+ENCODER_NICENESS = int(os.environ.get("ENCODER_NICENESS", 10))
+
+
+class JobCancelled(Exception):
+    """Raised when a compression job has been cancelled before the end of the encoding."""
+
+
+def build_ffmpeg_command(input_path: Path,
+                         output_path: Path,
+                         vcodec: str = DEFAULT_VCODEC,
+                         resolution: str = "1280:720",
+                         bitrate: str = "480k",
+                         crf: str = "28",
+                         tune: str = "animation",
+                         preset: str = DEFAULT_PRESET,
+                         plan: EncodePlan | None = None,
+                         maxrate: str | None = None
+                         ) -> list[str]:
+    """
+    Build the FFmpeg command line used to compress a video.
+
+    Without a plan every stream is kept and the video is scaled to `resolution`.
+    With a plan (see `probe.plan_encode`) only the planned streams are mapped,
+    each one copied or encoded as decided, and the video is scaled only if needed.
+
+    Args:
+        input_path (Path): Path to original video.
+        output_path (Path): Path to save compressed video.
+        vcodec (str): ffmpeg encoder, see `encoders.BACKENDS`.
+        resolution (str): Resolution to scale (e.g., "1280:720").
+        bitrate (str): Target bitrate (e.g. 480k, "800k", etc).
+        crf (str): Constant rate factor (unused while a bitrate is given).
+        tune (str): x264 tune (e.g. "film", "animation"), dropped by the encoders without it.
+        preset (str): x264 compression preset (e.g. fast, faster, slow), mapped to the encoder's own.
+        plan (EncodePlan): Streams to copy or encode, from the probe of the input.
+        maxrate (str): Peak video bitrate, to keep the output under a size.
+
+    Returns:
+        list: The ffmpeg arguments, ready for execution.
+    """
+    if plan is not None:
+        return [
+            "ffmpeg",
+            "-n",
+            "-loglevel", "error",
+            "-i", str(input_path),
+            *video_arguments(plan, vcodec, bitrate, tune, preset, maxrate),
+            *stream_arguments(plan.others, input_index=0, first_output=1 if plan.video else 0),
+            *PROGRESS_ARGS,
+            str(output_path)
+        ]
+    return [
+        "ffmpeg",
+        "-n",
+        "-loglevel", "error",
+        "-i", str(input_path),
+        "-map", "0",
+        "-vf", f"scale={resolution}",
+        *get_backend(vcodec).video_flags(bitrate, tune, preset, stream="v", maxrate=maxrate),
+        *PROGRESS_ARGS,
+        str(output_path)
+    ]
+
+
+@dataclass(frozen=True)
+class Rendition:
+    """One output of a ladder encoding."""
+    output_path: Path
+    bitrate: str
+    # Scale filter of this output, None keeps the size of the input
+    scale: str | None = None
+
+
+def build_ladder_command(input_path: Path,
+                         renditions: list[Rendition],
+                         vcodec: str = DEFAULT_VCODEC,
+                         tune: str = "animation",
+                         preset: str = DEFAULT_PRESET,
+                         plan: EncodePlan | None = None
+                         ) -> list[str]:
+    """
+    Build one FFmpeg command encoding several renditions of a video.
+
+    The input is decoded once and the frames are shared with the `split`
+    filter, then each rendition is scaled and encoded in its own output.
+
+    Args:
+        input_path (Path): Path to original video.
+        renditions (list): Outputs to produce.
+        vcodec (str): ffmpeg encoder, see `encoders.BACKENDS`.
+        tune (str): x264 tune (e.g. "film", "animation"), dropped by the encoders without it.
+        preset (str): x264 compression preset (e.g. fast, faster, slow), mapped to the encoder's own.
+        plan (EncodePlan): Streams of the input, from `probe.plan_encode` ; the
+            video is always re-encoded, the other streams follow the plan.
+
+    Returns:
+        list: The ffmpeg arguments, ready for execution.
+    """
+    video = f"0:{plan.video.index}" if plan is not None and plan.video else "0:v:0"
+    branches = "".join(f"[s{index}]" for index in range(len(renditions)))
+    graph = [f"[{video}]split={len(renditions)}{branches}"]
+    for index, rendition in enumerate(renditions):
+        graph.append(f"[s{index}]{rendition.scale or 'null'}[v{index}]")
+
+    command = ["ffmpeg", "-n", "-loglevel", "error", "-i", str(input_path),
+               "-filter_complex", ";".join(graph), *PROGRESS_ARGS]
+    for index, rendition in enumerate(renditions):
+        command += ["-map", f"[v{index}]", *get_backend(vcodec).video_flags(rendition.bitrate, tune, preset)]
+        if plan is not None:
+            command += stream_arguments(plan.others, input_index=0, first_output=1)
+        else:
+            command += ["-map", "0:a?", "-c:a", "copy"]
+        command.append(str(rendition.output_path))
+    return command
+
+
+def video_arguments(plan: EncodePlan, vcodec: str, bitrate: str, tune: str, preset: str,
+                    maxrate: str | None = None) -> list[str]:
+    """Arguments mapping the planned video stream of the first input as output stream 0."""
+    if plan.video is None:
+        return []
+    arguments = ["-map", f"0:{plan.video.index}"]
+    if plan.copy_video:
+        return [*arguments, "-c:v:0", "copy"]
+    arguments += get_backend(vcodec).video_flags(bitrate, tune, preset, maxrate=maxrate)
+    if plan.scale:
+        arguments += ["-vf", plan.scale]
+    return arguments
+
+
+def stream_arguments(streams: list[StreamPlan], input_index: int, first_output: int) -> list[str]:
+    """Arguments mapping the planned streams of an input, each one copied or encoded as planned."""
+    arguments = []
+    for output_index, stream in enumerate(streams, start=first_output):
+        arguments += ["-map", f"{input_index}:{stream.index}", f"-c:{output_index}", stream.codec]
+    return arguments
+
+
+def with_threads(ffmpeg_cmd: list[str], threads: int, outputs: list[Path] | None = None) -> list[str]:
+    """
+    Limit the encoder threads of each output and the filter threads of a command.
+
+    Args:
+        ffmpeg_cmd (list): The command, ending with its output path.
+        threads (int): Threads shared by the outputs.
+        outputs (list): Other output paths of the command, each one followed by its options.
+    """
+    if "-threads" in ffmpeg_cmd:
+        return ffmpeg_cmd
+    extra = {str(path) for path in outputs or ()}
+    per_output = str(max(1, threads // (len(extra) + 1)))
+    command = [ffmpeg_cmd[0], "-filter_threads", str(threads)]
+    last = len(ffmpeg_cmd) - 1
+    for position, argument in enumerate(ffmpeg_cmd[1:], start=1):
+        if position == last or argument in extra:
+            command += ["-threads", per_output]
+        command.append(argument)
+    return command
+
+
+def limit_process(pid: int, niceness: int, cpus: list[int] | None = None) -> None:
+    """
+    Lower the priority of a spawned process and bind it to `cpus`, each of its threads included.
+
+    Done from the parent right after the spawn : the threads ffmpeg creates
+    later inherit the settings. A preexec_fn would run them in the child, which
+    is not safe in a process running threads (asyncio.to_thread).
+    """
+    priority = None
+    if niceness and hasattr(os, "setpriority"):
+        priority = min(19, os.getpriority(os.PRIO_PROCESS, 0) + niceness)
+    if priority is None and not cpus:
+        return
+    try:
+        threads = [int(tid) for tid in os.listdir(f"/proc/{pid}/task")]
+    except OSError:
+        threads = [pid]
+    for tid in threads:
+        try:
+            if priority is not None:
+                os.setpriority(os.PRIO_PROCESS, tid, priority)
+            if cpus:
+                os.sched_setaffinity(tid, cpus)
+        except OSError:
+            # Thread or process already gone
+            pass
+
+
+class CpuBudget:
+    """
+    Splits a budget of CPUs between the running encodings.
+
+    Each encoding runs as many threads as the budget divided by the number of
+    encodings allowed at once, instead of one per core of the machine : together
+    they never run more threads than the budget. With `pin`, each one is also
+    bound to its own CPUs, and the sets are recomputed whenever an encoding
+    starts or ends so that the running ones always cover the budget.
+    """
+
+    def __init__(self, budget: int = ENCODER_CPU_BUDGET, pin: bool = ENCODER_CPU_AFFINITY,
+                 niceness: int = ENCODER_NICENESS):
+        if hasattr(os, "sched_getaffinity"):
+            available = sorted(os.sched_getaffinity(0))
+        else:
+            available = list(range(os.cpu_count() or 1))
+        self.cpus = available[:budget] if budget > 0 else available
+        self.pin = pin and hasattr(os, "sched_setaffinity")
+        self.niceness = niceness
+        self._running: dict[int, asyncio.subprocess.Process] = {}
+
+    def shares(self, job_ids: list[int]) -> dict[int, list[int]]:
+        """Disjoint CPU sets for the jobs, oldest job first ; CPUs are shared only when jobs outnumber them."""
+        count = len(job_ids)
+        shares = {}
+        for position, job_id in enumerate(sorted(job_ids)):
+            if count <= len(self.cpus):
+                shares[job_id] = self.cpus[position * len(self.cpus) // count:(position + 1) * len(self.cpus) // count]
+            else:
+                shares[job_id] = [self.cpus[position % len(self.cpus)]]
+        return shares
+
+    def threads(self, workers: int) -> int:
+        """Threads of each encoding when `workers` of them run at once."""
+        return max(1, len(self.cpus) // max(1, workers))
+
+    def next_share(self, job_id: int) -> list[int]:
+        """CPUs of a job about to start, next to the running ones."""
+        return self.shares([*self._running, job_id])[job_id]
+
+    def started(self, job_id: int, process: asyncio.subprocess.Process) -> None:
+        limit_process(process.pid, self.niceness)
+        self._running[job_id] = process
+        self.rebalance()
+
+    def finished(self, job_id: int) -> None:
+        if self._running.pop(job_id, None) is not None:
+            self.rebalance()
+
+    def rebalance(self) -> None:
+        """Pin every thread of the running encodings to their current share."""
+        if not self.pin:
+            return
+        for job_id, cpus in self.shares(list(self._running)).items():
+            limit_process(self._running[job_id].pid, 0, cpus)
+
+
+@dataclass(eq=False)
+class CompressionJob:
+    """A compression submitted to the engine."""
+    job_id: int
+    input_path: Path
+    output_path: Path
+    options: dict = field(default_factory=dict)
+    command: list[str] | None = None
+    task: asyncio.Task | None = None
+    process: asyncio.subprocess.Process | None = None
+    submitted_at: float = field(default_factory=time.monotonic)
+    started_at: float | None = None
+    progress: EncodeProgress = field(default_factory=EncodeProgress)
+    on_progress: Callable[[EncodeProgress], None] | None = None
+    cpus: list[int] = field(default_factory=list)
+    # Other outputs written by the command, besides output_path
+    extra_outputs: list[Path] = field(default_factory=list)
+    # Writes the input to the stdin of ffmpeg, for commands reading PIPE_INPUT
+    feed_input: Callable[[asyncio.StreamWriter], Awaitable[None]] | None = None
+    # False for the short encodings run beside the slots (previews), still within the CPU budget
+    slot: bool = True
+
+    @property
+    def running(self) -> bool:
+        return self.started_at is not None and self.task is not None and not self.task.done()
+
+    def cancel(self) -> bool:
+        """Request the cancellation of the job. Returns False if the job is already finished."""
+        if self.task is None or self.task.done():
+            return False
+        return self.task.cancel()
+
+    async def result(self) -> tuple[float, float]:
+        """Wait for the end of the job and return (compressed_file_size_MB, compression_duration_sec)."""
+        try:
+            return await self.task
+        except asyncio.CancelledError:
+            # Job cancelled before it even started, while the caller itself is still alive
+            if self.task.cancelled() and not asyncio.current_task().cancelling():
+                raise JobCancelled(f"Compression job {self.job_id} cancelled") from None
+            raise
+
+
+class CompressionEngine:
+    """
+    Runs ffmpeg compressions as asyncio subprocesses, with at most
+    `max_workers` encoder processes alive at the same time.
+
+    Jobs beyond that limit wait for a free slot without blocking the event loop,
+    so the bot keeps answering commands and callbacks while videos are encoded.
+    """
+
+    def __init__(self, max_workers: int = COMPRESS_WORKERS, cpu_budget: CpuBudget | None = None):
+        self.max_workers = max(1, max_workers)
+        self.cpu_budget = cpu_budget or CpuBudget()
+        self._slots = asyncio.Semaphore(self.max_workers)
+        self._jobs: dict[int, CompressionJob] = {}
+        self._ids = itertools.count(1)
+
+    @property
+    def active_jobs(self) -> int:
+        return sum(1 for job in self._jobs.values() if job.running)
+
+    @property
+    def waiting_jobs(self) -> int:
+        return sum(1 for job in self._jobs.values() if job.started_at is None)
+
+    def get_job(self, job_id: int) -> CompressionJob | None:
+        return self._jobs.get(job_id)
+
+    def progress(self) -> dict[int, EncodeProgress]:
+        """Progress of the running jobs, by job id."""
+        return {job_id: job.progress for job_id, job in self._jobs.items() if job.running}
+
+    def submit(self, input_path: Path, output_path: Path,
+               on_progress: Callable[[EncodeProgress], None] | None = None,
+               command: list[str] | None = None,
+               total_duration: float | None = None,
+               extra_outputs: list[Path] | None = None,
+               feed_input: Callable[[asyncio.StreamWriter], Awaitable[None]] | None = None,
+               slot: bool = True,
+               **options) -> CompressionJob:
+        """
+        Queue a compression and return immediately.
+
+        Args:
+            input_path (Path): Path to original video.
+            output_path (Path): Path to save compressed video.
+            on_progress (Callable): Called with the job progress each time ffmpeg reports it.
+            command (list): Complete ffmpeg command to run instead of the one built from the options.
+                It must contain PROGRESS_ARGS.
+            total_duration (float): Duration of the input if already known, to avoid probing it again.
+            extra_outputs (list): Other files written by `command`, removed as well if the job is cancelled.
+            feed_input (Callable): Writes the input to ffmpeg when `command` reads it from PIPE_INPUT ;
+                the stdin of ffmpeg is closed once it returns.
+            slot (bool): Wait for one of the `max_workers` slots, False to start right away.
+            **options: Encoding options accepted by `build_ffmpeg_command`.
+
+        Returns:
+            CompressionJob: The submitted job, whose `result()` can be awaited.
+        """
+        job = CompressionJob(job_id=next(self._ids),
+                             input_path=input_path,
+                             output_path=output_path,
+                             options=options,
+                             command=command,
+                             on_progress=on_progress,
+                             extra_outputs=list(extra_outputs or []),
+                             feed_input=feed_input,
+                             slot=slot)
+        job.progress.total_duration = total_duration
+        self._jobs[job.job_id] = job
+        job.task = asyncio.create_task(self._run(job), name=f"compression-{job.job_id}")
+        job.task.add_done_callback(lambda _: self._jobs.pop(job.job_id, None))
+        return job
+
+    async def compress(self, input_path: Path, output_path: Path,
+                       on_progress: Callable[[EncodeProgress], None] | None = None,
+                       **options) -> tuple[float, float]:
+        """Submit a compression and wait for its result."""
+        job = self.submit(input_path, output_path, on_progress=on_progress, **options)
+        return await job.result()
+
+    def cancel(self, job_id: int) -> bool:
+        job = self._jobs.get(job_id)
+        return job.cancel() if job else False
+
+    async def shutdown(self) -> None:
+        """Cancel every pending or running job and wait for their processes to exit."""
+        tasks = [job.task for job in self._jobs.values() if job.task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, job: CompressionJob) -> tuple[float, float]:
+        ffmpeg_cmd = job.command or build_ffmpeg_command(job.input_path, job.output_path, **job.options)
+        try:
+            if job.progress.total_duration is None:
+                with span("probe"):
+                    job.progress.total_duration = await probe_duration(job.input_path)
+            submitted = time.time()
+            async with self._slots if job.slot else nullcontext():
+                job.started_at = job.progress.started_at = time.monotonic()
+                start_time = time.time()
+                record("engine.slot_wait", submitted, start_time)
+                with span("ffmpeg.encode", output=job.output_path.name):
+                    await self._execute(job, ffmpeg_cmd)
+                duration = time.time() - start_time
+        except asyncio.CancelledError:
+            for output_path in (job.output_path, *job.extra_outputs):
+                output_path.unlink(missing_ok=True)
+            raise JobCancelled(f"Compression job {job.job_id} cancelled") from None
+
+        size_mb = job.output_path.stat().st_size / (1024 * 1024)
+
+        return round(size_mb, 2), round(duration, 2)
+
+    async def _execute(self, job: CompressionJob, ffmpeg_cmd: list[str]) -> None:
+        """Run ffmpeg for the job and raise RuntimeError if it fails."""
+        job.cpus = self.cpu_budget.next_share(job.job_id)
+        threads = self.cpu_budget.threads(self.max_workers)
+        job.process = await asyncio.create_subprocess_exec(*with_threads(ffmpeg_cmd, threads, job.extra_outputs),
+                                                           stdin=asyncio.subprocess.PIPE if job.feed_input else None,
+                                                           stdout=asyncio.subprocess.PIPE,
+                                                           stderr=asyncio.subprocess.PIPE)
+        self.cpu_budget.started(job.job_id, job.process)
+        reader = asyncio.create_task(self._read_progress(job))
+        feeder = asyncio.create_task(self._feed_input(job)) if job.feed_input else None
+        try:
+            stderr = await job.process.stderr.read()
+            await job.process.wait()
+            await reader
+            feed_error = None
+            if feeder:
+                # ffmpeg may exit before the end of its input, on an error of its own
+                feeder.cancel()
+                await asyncio.wait([feeder])
+                feed_error = None if feeder.cancelled() else feeder.result()
+        except asyncio.CancelledError:
+            reader.cancel()
+            if feeder:
+                feeder.cancel()
+            await terminate_process(job.process)
+            raise
+        finally:
+            self.cpu_budget.finished(job.job_id)
+
+        if feed_error is not None:
+            raise RuntimeError(f"Input of ffmpeg failed: {feed_error}") from feed_error
+        if job.process.returncode != 0:
+            raise RuntimeError(f"FFmpeg failed:\n{stderr.decode(errors='replace')}")
+
+    @staticmethod
+    async def _feed_input(job: CompressionJob) -> Exception | None:
+        """Write the input of the job to ffmpeg, returning the error which stopped it if any."""
+        stdin = job.process.stdin
+        try:
+            await job.feed_input(stdin)
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg exited before reading all its input : its own error is reported
+            return None
+        except Exception as e:
+            logger.warning(f"Input of job {job.job_id} failed: {e}")
+            # Without its input ffmpeg must not leave a truncated output looking finished
+            await terminate_process(job.process)
+            return e
+        finally:
+            stdin.close()
+        return None
+
+
+    @staticmethod
+    async def _read_progress(job: CompressionJob) -> None:
+        parser = ProgressParser(job.progress)
+        async for line in job.process.stdout:
+            if parser.feed(line.decode(errors="replace")) and job.on_progress:
+                try:
+                    job.on_progress(job.progress)
+                except Exception as e:
+                    logger.warning(f"Progress callback of job {job.job_id} failed: {e}")
+
+
+async def run_ffmpeg(ffmpeg_cmd: list[str]) -> None:
+    """
+    Run a short ffmpeg command (remux, cut...) outside of the worker slots.
+
+    Raises:
+        RuntimeError: If FFmpeg fails.
+    """
+    with span("ffmpeg.run", output=Path(ffmpeg_cmd[-1]).name):
+        process = await asyncio.create_subprocess_exec(*ffmpeg_cmd,
+                                                       stdout=asyncio.subprocess.DEVNULL,
+                                                       stderr=asyncio.subprocess.PIPE)
+        limit_process(process.pid, ENCODER_NICENESS)
+        try:
+            _, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            await terminate_process(process)
+            raise
+    if process.returncode != 0:
+        raise RuntimeError(f"FFmpeg failed:\n{stderr.decode(errors='replace')}")
+
+
+async def terminate_process(process: asyncio.subprocess.Process, timeout: float = 5) -> None:
+    """Stop a subprocess, killing it if it does not exit in time after SIGTERM."""
+    if process.returncode is not None:
+        return
+    try:
+        process.terminate()
+        await asyncio.wait_for(process.wait(), timeout)
+    except ProcessLookupError:
+        pass
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
@@ -0,0 +1,546 @@
+"""
+End-to-end load test of the bot, fully offline.
+
+Starts a stand-in for the local Bot API server on the port of BOT_API_URL,
+runs the unmodified bot_compress.py against it in a scratch directory, and
+simulates users sending synthetic videos while pressing the settings buttons.
+The stand-in serves getUpdates, getFile (the file written on its disk as the
+real server does in --local mode), file downloads, sendVideo/sendDocument and
+message edits, with urlencoded or multipart requests.
+
+    python loadtest.py --users 10 --videos 3 --presses 5
+    python loadtest.py --users 50 --videos 1 --download-rate 20 --output load.json
+    python loadtest.py --users 5 --videos 4 --album --max-error-rate 0.05
+
+Reports end-to-end latency percentiles (video received by the bot -> compressed
+video sent back), throughput, error rates, and the latency of the settings
+buttons and of the settings store under load. Exits with status 1 when the
+error rate is above --max-error-rate.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from email import policy
+from email.parser import BytesParser
+from pathlib import Path
+from typing import Callable
+from urllib.parse import parse_qsl, unquote, urlparse
+
+from local_files import BOT_API_URL
+
+
+TOKEN = "123456:LOADTEST"
+BOT_SCRIPT = Path(__file__).with_name("bot_compress.py")
+# Chat and user ids of the simulated users
+USER_ID_BASE = 10_000
+# Buttons pressed in turn by every user, on the settings menu sent by /settings
+PRESSES = ["change_bitrate", "set bitrate 480k", "tune", "set tune film", "upload_type", "upload_type"]
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot",
+            "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False}
+
+
+def make_video(work_dir: Path, duration: float, size: str) -> Path:
+    """Synthetic video sent by every simulated user, generated once."""
+    path = work_dir / f"source_{size}_{duration:g}s.mp4"
+    if not path.exists():
+        subprocess.run(["ffmpeg", "-y", "-loglevel", "error",
+                        "-f", "lavfi", "-i", f"testsrc2=size={size}:rate=25",
+                        "-f", "lavfi", "-i", "sine=frequency=440",
+                        "-t", str(duration), "-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p",
+                        "-c:a", "aac", "-shortest", str(path)], check=True)
+    return path
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def percentiles(values: list[float]) -> dict:
+    """Nearest-rank percentiles of a list of seconds."""
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def rank(q: float) -> float:
+        return round(ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))], 3)
+    return {"p50": rank(0.5), "p90": rank(0.9), "p95": rank(0.95), "p99": rank(0.99),
+            "max": round(ordered[-1], 3), "mean": round(sum(ordered) / len(ordered), 3)}
+
+
+def decode_value(value: str):
+    """Parameters are sent JSON encoded, except plain strings."""
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def parse_parameters(content_type: str, body: bytes, query: str) -> tuple[dict, int]:
+    """
+    Parameters of a Bot API request, urlencoded or multipart.
+
+    Returns:
+        tuple: The parameters, and the number of bytes of the files uploaded in the request.
+    """
+    params = {name: decode_value(value) for name, value in parse_qsl(query)}
+    uploaded = 0
+    if content_type.startswith("multipart/form-data"):
+        message = BytesParser(policy=policy.HTTP).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            data = part.get_payload(decode=True) or b""
+            if part.get_filename():
+                params[name] = f"attach://{name}"
+                uploaded += len(data)
+            else:
+                params[name] = decode_value(data.decode())
+    elif body:
+        params.update((name, decode_value(value)) for name, value in parse_qsl(body.decode()))
+    return params, uploaded
+
+
+class FakeBotApi:
+    """
+    Stand-in for the local Bot API server, on an asyncio server : enough of
+    the protocol for the bot, and a hook seeing every answered request.
+
+    Files are "downloaded from Telegram" at `download_rate` MB/s when the bot
+    calls getFile, and uploads take `upload_rate` MB/s, 0 meaning instantly.
+    """
+
+    def __init__(self, files_dir: Path, host: str, port: int,
+                 download_rate: float = 0.0, upload_rate: float = 0.0):
+        self.files_dir = files_dir
+        self.host = host
+        self.port = port
+        self.download_rate = download_rate
+        self.upload_rate = upload_rate
+        self.on_request: Callable[[str, dict, object], None] | None = None
+        self.requests: Counter[str] = Counter()
+        self.errors: Counter[str] = Counter()
+        self.uploaded_bytes = 0
+        self.polling = asyncio.Event()
+        self._files: dict[str, Path] = {}
+        self._updates: list[dict] = []
+        self._new_update = asyncio.Event()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._server: asyncio.Server | None = None
+
+    async def start(self) -> None:
+        self.files_dir.mkdir(parents=True, exist_ok=True)
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+
+    async def stop(self) -> None:
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    def add_file(self, file_id: str, source: Path) -> None:
+        self._files[file_id] = source
+
+    def next_message_id(self) -> int:
+        return next(self._message_ids)
+
+    def push_update(self, **content) -> dict:
+        """Queue an update for the next getUpdates of the bot."""
+        update = {"update_id": next(self._update_ids), **content}
+        self._updates.append(update)
+        self._new_update.set()
+        return update
+
+    def message(self, chat_id: int, message_id: int | None = None, **fields) -> dict:
+        return {"message_id": message_id or self.next_message_id(), "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, **fields}
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # HTTP/1.1 with keep-alive : the bot pools its connections
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while (line := await reader.readline()).strip():
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                verb, target, _ = request_line.decode("latin-1").split(" ", 2)
+                status, content_type, payload = await self._route(target, headers, body)
+                writer.write(f"HTTP/1.1 {status}\r\n"
+                             f"Content-Type: {content_type}\r\n"
+                             f"Content-Length: {len(payload)}\r\n"
+                             "Connection: keep-alive\r\n\r\n".encode() + payload)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        except asyncio.CancelledError:
+            # Connection still open when the load test ends
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, target: str, headers: dict, body: bytes) -> tuple[str, str, bytes]:
+        url = urlparse(target)
+        parts = url.path.strip("/").split("/")
+        if len(parts) >= 3 and parts[0] == "file" and parts[1] == f"bot{TOKEN}":
+            path = self.files_dir / unquote("/".join(parts[2:]))
+            self.requests["download"] += 1
+            if not path.is_file():
+                self.errors["download"] += 1
+                return "404 Not Found", "text/plain", b"Not found"
+            return "200 OK", "application/octet-stream", path.read_bytes()
+        if len(parts) != 2 or parts[0] != f"bot{TOKEN}":
+            self.errors["unauthorized"] += 1
+            return "401 Unauthorized", "application/json", json.dumps(
+                {"ok": False, "error_code": 401, "description": "Unauthorized"}).encode()
+
+        method = parts[1]
+        params, uploaded = parse_parameters(headers.get("content-type", ""), body, url.query)
+        self.requests[method] += 1
+        try:
+            result = await self._call(method, params, uploaded)
+        except KeyError as e:
+            self.errors[method] += 1
+            return "400 Bad Request", "application/json", json.dumps(
+                {"ok": False, "error_code": 400, "description": f"Bad Request: {e} not found"}).encode()
+        if self.on_request is not None:
+            self.on_request(method, params, result)
+        return "200 OK", "application/json", json.dumps({"ok": True, "result": result}).encode()
+
+    async def _call(self, method: str, params: dict, uploaded: int):
+        if method == "getMe":
+            return BOT_USER
+        if method == "getUpdates":
+            return await self._get_updates(params)
+        if method == "getFile":
+            return await self._get_file(params["file_id"])
+        if method == "sendMessage":
+            return self.message(params["chat_id"], text=params.get("text", ""))
+        if method == "editMessageText":
+            return self.message(params["chat_id"], params["message_id"], text=params.get("text", ""))
+        if method in ("sendVideo", "sendDocument"):
+            kind = "video" if method == "sendVideo" else "document"
+            size = uploaded + self._local_size(params.get(kind))
+            self.uploaded_bytes += size
+            if self.upload_rate:
+                await asyncio.sleep(size / (self.upload_rate * 1024 * 1024))
+            attachment = {"file_id": f"sent_{self.requests[method]}", "file_unique_id": f"sent_{self.requests[method]}",
+                          "file_size": size}
+            if kind == "video":
+                attachment.update(width=0, height=0, duration=0)
+            return self.message(params["chat_id"], caption=params.get("caption", ""), **{kind: attachment})
+        # deleteWebhook, answerCallbackQuery, deleteMessage, editMessageReplyMarkup...
+        return True
+
+    async def _get_updates(self, params: dict) -> list[dict]:
+        self.polling.set()
+        offset = int(params.get("offset") or 0)
+        # Updates before the offset are confirmed by the bot
+        self._updates = [update for update in self._updates if update["update_id"] >= offset]
+        if not self._updates:
+            self._new_update.clear()
+            try:
+                await asyncio.wait_for(self._new_update.wait(), timeout=float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:int(params.get("limit") or 100)]
+
+    async def _get_file(self, file_id: str) -> dict:
+        source = self._files[file_id]
+        size = source.stat().st_size
+        if self.download_rate:
+            await asyncio.sleep(size / (self.download_rate * 1024 * 1024))
+        # Like the real server in --local mode : a file of its own, given by its absolute path
+        path = self.files_dir / f"{file_id}{source.suffix}"
+        if not path.exists():
+            try:
+                os.link(source, path)
+            except OSError:
+                shutil.copy(source, path)
+        return {"file_id": file_id, "file_unique_id": file_id, "file_size": size, "file_path": str(path.absolute())}
+
+    @staticmethod
+    def _local_size(value) -> int:
+        """Size of a file given by its file:// URI in local mode."""
+        if isinstance(value, str) and value.startswith("file://"):
+            path = Path(unquote(urlparse(value).path))
+            return path.stat().st_size if path.exists() else 0
+        return 0
+
+
+@dataclass
+class LoadStats:
+    videos_sent: int = 0
+    delivered: int = 0
+    failed: int = 0
+    timed_out: int = 0
+    latencies: list[float] = field(default_factory=list)
+    presses: int = 0
+    press_timeouts: int = 0
+    press_latencies: list[float] = field(default_factory=list)
+    menus_missing: int = 0
+    first_sent: float | None = None
+    last_delivered: float | None = None
+
+
+class LoadTest:
+    """Simulated users, and the matching of the requests of the bot with what they wait for."""
+
+    def __init__(self, server: FakeBotApi, source: Path, args: argparse.Namespace):
+        self.server = server
+        self.source = source
+        self.args = args
+        self.stats = LoadStats()
+        # Waiters : compressed video by its name, settings menu and its edits by chat
+        self._deliveries: dict[str, asyncio.Future] = {}
+        self._source_messages: dict[int, str] = {}
+        self._menus: dict[int, asyncio.Future] = {}
+        self._menu_ids: dict[int, int] = {}
+        self._edits: dict[int, asyncio.Future] = {}
+        server.on_request = self.observe
+
+    def observe(self, method: str, params: dict, result) -> None:
+        chat_id = params.get("chat_id")
+        if method in ("sendVideo", "sendDocument"):
+            caption = params.get("caption", "")
+            for name, waiter in self._deliveries.items():
+                if name in caption and not waiter.done():
+                    waiter.set_result(True)
+                    break
+        elif method == "sendMessage":
+            text = params.get("text", "")
+            reply_to = params.get("reply_to_message_id") or (params.get("reply_parameters") or {}).get("message_id")
+            name = self._source_messages.get(reply_to)
+            if text.startswith("❌") and name in self._deliveries and not self._deliveries[name].done():
+                self._deliveries[name].set_result(False)
+            if params.get("reply_markup") and chat_id in self._menus and not self._menus[chat_id].done():
+                self._menus[chat_id].set_result(result["message_id"])
+        elif method == "editMessageText" and self._menu_ids.get(chat_id) == params.get("message_id"):
+            waiter = self._edits.get(chat_id)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(True)
+
+    async def simulate_user(self, index: int) -> None:
+        chat_id = USER_ID_BASE + index
+        user = {"id": chat_id, "is_bot": False, "first_name": f"user{index}"}
+        self._menus[chat_id] = asyncio.get_running_loop().create_future()
+        self.server.push_update(message=self.server.message(chat_id, text="/settings", **{"from": user},
+                                                            entities=[{"type": "bot_command", "offset": 0,
+                                                                       "length": 9}]))
+        try:
+            self._menu_ids[chat_id] = await asyncio.wait_for(self._menus[chat_id], timeout=self.args.timeout)
+        except asyncio.TimeoutError:
+            self.stats.menus_missing += 1
+        await asyncio.gather(self._send_videos(index, chat_id, user), self._press_buttons(chat_id, user))
+
+    async def _send_videos(self, index: int, chat_id: int, user: dict) -> None:
+        size = self.source.stat().st_size
+        width, height = (int(value) for value in self.args.size.split("x"))
+        album = {"media_group_id": f"album_{index}"} if self.args.album else {}
+        waiters = []
+        for number in range(self.args.videos):
+            name = f"lt_u{index}_v{number}"
+            self.server.add_file(name, self.source)
+            waiter = self._deliveries[name] = asyncio.get_running_loop().create_future()
+            message = self.server.message(chat_id, **{"from": user}, **album, video={
+                "file_id": name, "file_unique_id": name, "width": width, "height": height,
+                "duration": int(self.args.duration), "file_name": f"{name}.mp4", "mime_type": "video/mp4",
+                "file_size": size})
+            self._source_messages[message["message_id"]] = name
+            sent_at = time.monotonic()
+            self.stats.first_sent = self.stats.first_sent or sent_at
+            self.stats.videos_sent += 1
+            self.server.push_update(message=message)
+            waiters.append(asyncio.create_task(self._wait_delivery(waiter, sent_at)))
+            if number + 1 < self.args.videos:
+                await asyncio.sleep(self.args.interval)
+        await asyncio.gather(*waiters)
+
+    async def _wait_delivery(self, waiter: asyncio.Future, sent_at: float) -> None:
+        try:
+            delivered = await asyncio.wait_for(waiter, timeout=self.args.timeout)
+        except asyncio.TimeoutError:
+            self.stats.timed_out += 1
+            return
+        if not delivered:
+            self.stats.failed += 1
+            return
+        now = time.monotonic()
+        self.stats.delivered += 1
+        self.stats.latencies.append(now - sent_at)
+        self.stats.last_delivered = now
+
+    async def _press_buttons(self, chat_id: int, user: dict) -> None:
+        message_id = self._menu_ids.get(chat_id)
+        if message_id is None:
+            return
+        for number in range(self.args.presses):
+            self._edits[chat_id] = asyncio.get_running_loop().create_future()
+            self.server.push_update(callback_query={
+                "id": f"{chat_id}_{number}", "from": user, "chat_instance": str(chat_id),
+                "data": PRESSES[number % len(PRESSES)],
+                "message": self.server.message(chat_id, message_id, text="🛠 Paramètres")})
+            pressed_at = time.monotonic()
+            self.stats.presses += 1
+            try:
+                await asyncio.wait_for(self._edits[chat_id], timeout=self.args.timeout)
+                self.stats.press_latencies.append(time.monotonic() - pressed_at)
+            except asyncio.TimeoutError:
+                self.stats.press_timeouts += 1
+            await asyncio.sleep(self.args.press_interval)
+
+
+async def scrape_settings_store(port: int) -> dict:
+    """Count and mean latency of the settings store operations, from the metrics of the bot."""
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        await writer.drain()
+        text = (await reader.read()).decode()
+        writer.close()
+    except OSError:
+        return {}
+    sums, counts = {}, {}
+    for line in text.splitlines():
+        for suffix, target in (("_sum", sums), ("_count", counts)):
+            prefix = f"compressbot_settings_seconds{suffix}{{operation=\""
+            if line.startswith(prefix):
+                operation = line[len(prefix):].split("\"", 1)[0]
+                target[operation] = float(line.rsplit(" ", 1)[1])
+    return {operation: {"count": int(count), "mean_ms": round(1000 * sums.get(operation, 0) / count, 3)}
+            for operation, count in counts.items() if count}
+
+
+async def stop_bot(process: asyncio.subprocess.Process) -> None:
+    if process.returncode is not None:
+        return
+    # Graceful stop, as with Ctrl+C : running jobs are checkpointed
+    process.send_signal(signal.SIGINT)
+    try:
+        await asyncio.wait_for(process.wait(), timeout=30)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+
+
+async def run_load_test(args: argparse.Namespace, work_dir: Path) -> dict:
+    url = urlparse(args.api_url)
+    source = make_video(work_dir, args.duration, args.size)
+    server = FakeBotApi(work_dir / "server", url.hostname or "127.0.0.1", url.port or 8081,
+                        download_rate=args.download_rate, upload_rate=args.upload_rate)
+    load_test = LoadTest(server, source, args)
+    await server.start()
+
+    bot_dir = work_dir / "bot"
+    bot_dir.mkdir(exist_ok=True)
+    metrics_port = free_port()
+    environment = {**os.environ, "TOKEN": TOKEN, "BOT_API_URL": f"{url.scheme}://{url.netloc}/bot",
+                   "BOT_API_LOCAL_MODE": "1", "METRICS_PORT": str(metrics_port), "METRICS_HOST": "127.0.0.1"}
+    with (work_dir / "bot.log").open("wb") as log:
+        process = await asyncio.create_subprocess_exec(sys.executable, str(BOT_SCRIPT), cwd=bot_dir, env=environment,
+                                                       stdout=log, stderr=subprocess.STDOUT)
+    try:
+        exited = asyncio.create_task(process.wait())
+        polling = asyncio.create_task(server.polling.wait())
+        await asyncio.wait({exited, polling}, timeout=args.startup_timeout, return_when=asyncio.FIRST_COMPLETED)
+        exited.cancel()
+        polling.cancel()
+        if not server.polling.is_set():
+            raise RuntimeError(f"The bot did not start polling, see {work_dir / 'bot.log'}")
+
+        started = time.monotonic()
+        await asyncio.gather(*(load_test.simulate_user(index) for index in range(args.users)))
+        wall_time = time.monotonic() - started
+        store = await scrape_settings_store(metrics_port)
+    finally:
+        await stop_bot(process)
+        await server.stop()
+
+    stats = load_test.stats
+    span = (stats.last_delivered or time.monotonic()) - (stats.first_sent or started)
+    errors = stats.failed + stats.timed_out
+    return {
+        "config": {name: value for name, value in vars(args).items() if name not in ("output", "work_dir")},
+        "wall_time": round(wall_time, 2),
+        "videos": {"sent": stats.videos_sent, "delivered": stats.delivered, "failed": stats.failed,
+                   "timed_out": stats.timed_out,
+                   "error_rate": round(errors / stats.videos_sent, 4) if stats.videos_sent else 0.0,
+                   "latency": percentiles(stats.latencies)},
+        "throughput": {"videos_per_minute": round(60 * stats.delivered / span, 2) if span > 0 else 0.0,
+                       "input_mb_per_s": round(stats.delivered * source.stat().st_size / (1024 * 1024) / span, 3)
+                       if span > 0 else 0.0,
+                       "output_mb": round(server.uploaded_bytes / (1024 * 1024), 2)},
+        "settings": {"presses": stats.presses, "timed_out": stats.press_timeouts, "menus_missing": stats.menus_missing,
+                     "latency": percentiles(stats.press_latencies), "store": store},
+        "api": {"requests": dict(server.requests), "errors": dict(server.errors)},
+    }
+
+
+def print_report(report: dict) -> None:
+    videos, settings = report["videos"], report["settings"]
+    print(f"Videos: {videos['delivered']}/{videos['sent']} delivered, {videos['failed']} failed, "
+          f"{videos['timed_out']} timed out (error rate {videos['error_rate']:.1%})")
+    print(f"End-to-end latency (s): {videos['latency']}")
+    print(f"Throughput: {report['throughput']}")
+    print(f"Settings buttons: {settings['presses']} presses, {settings['timed_out']} timed out, "
+          f"latency (s) {settings['latency']}")
+    for operation, measure in settings["store"].items():
+        print(f"Settings store {operation}: {measure['count']} calls, {measure['mean_ms']} ms on average")
+    print(f"Bot API requests: {report['api']['requests']}, errors: {report['api']['errors']}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=5)
+    parser.add_argument("--videos", type=int, default=2, help="videos sent by each user")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between two videos of a user")
+    parser.add_argument("--album", action="store_true", help="send the videos of a user as an album")
+    parser.add_argument("--presses", type=int, default=6, help="settings buttons pressed by each user")
+    parser.add_argument("--press-interval", type=float, default=0.5)
+    parser.add_argument("--duration", type=float, default=5, help="length of the synthetic video, in seconds")
+    parser.add_argument("--size", default="640x360", help="size of the synthetic video")
+    parser.add_argument("--download-rate", type=float, default=0.0,
+                        help="MB/s of the simulated downloads from Telegram, 0 for instant")
+    parser.add_argument("--upload-rate", type=float, default=0.0,
+                        help="MB/s of the simulated uploads to Telegram, 0 for instant")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds to wait for each answer of the bot")
+    parser.add_argument("--startup-timeout", type=float, default=60)
+    parser.add_argument("--api-url", default=BOT_API_URL, help="where the stand-in server listens")
+    parser.add_argument("--work-dir", type=Path, default=None, help="kept after the run, temporary if not set")
+    parser.add_argument("--output", type=Path, default=None, help="save the report as JSON")
+    parser.add_argument("--max-error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or Path(tempfile.mkdtemp(prefix="loadtest_"))
+    work_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        report = asyncio.run(run_load_test(args, work_dir))
+    except BaseException:
+        print(f"Load test aborted, bot log and databases kept in {work_dir}", file=sys.stderr)
+        raise
+    if args.work_dir is None:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print_report(report)
+    if args.output is not None:
+        args.output.write_text(json.dumps(report, indent=2))
+    return 1 if report["videos"]["error_rate"] > args.max_error_rate else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,82 @@
+import errno
+import logging
+import os
+from dataclasses import dataclass
+from pathlib import Path
+
+from telegram import File
+
+
+logger = logging.getLogger(__name__)
+
+BOT_API_URL = os.environ.get("BOT_API_URL", "http://localhost:8081/bot")
+# Where the files are downloaded from outside of local mode, next to the API of the same server
+BOT_API_FILE_URL = os.environ.get("BOT_API_FILE_URL", BOT_API_URL.removesuffix("/bot") + "/file/bot")
+# The Bot API server runs with --local : files are exchanged through its disk
+LOCAL_MODE = os.environ.get("BOT_API_LOCAL_MODE", "1") not in ("0", "false", "False")
+
+
+@dataclass(frozen=True)
+class LocalInput:
+    """A video available on the local disk."""
+    path: Path
+    # False when the path belongs to the Bot API server and must not be deleted by the bot
+    owned: bool = True
+
+
+def link_server_file(telegram_file: File, destination: Path) -> LocalInput | None:
+    """
+    Get the server copy of a file without copying its content.
+
+    In local mode, the Bot API server has already written the file to its disk
+    and `file_path` is its absolute path. The file is hardlinked to `destination`,
+    or used in place if both paths are not on the same filesystem.
+
+    Returns:
+        LocalInput | None: The local file, or None if it must be downloaded.
+    """
+    if not LOCAL_MODE or not telegram_file.file_path:
+        return None
+    source = Path(telegram_file.file_path)
+    if not source.is_absolute() or not source.is_file():
+        return None
+
+    destination.unlink(missing_ok=True)
+    try:
+        os.link(source, destination)
+        return LocalInput(destination, owned=True)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EACCES, errno.EMLINK):
+            raise
+        logger.info(f"Cannot hardlink {source} ({e.strerror}), reading it in place")
+        return LocalInput(source, owned=False)
+
+
+async def fetch_video(telegram_file: File, destination: Path) -> LocalInput:
+    """
+    Make a Telegram file available locally, through the zero-copy path when possible.
+
+    Args:
+        telegram_file (File): File returned by get_file.
+        destination (Path): Where the bot wants the file.
+
+    Returns:
+        LocalInput: The local path of the video and whether the bot owns it.
+    """
+    local_input = link_server_file(telegram_file, destination)
+    if local_input is not None:
+        return local_input
+    await telegram_file.download_to_drive(custom_path=destination)
+    return LocalInput(destination, owned=True)
+
+
+def upload_input(path: Path) -> str | Path:
+    """
+    Value to give to send_video/send_document for a local file.
+
+    In local mode the server reads `file://` paths itself, so the bytes are never
+    streamed through the bot. The file must be readable by the server process.
+    """
+    if LOCAL_MODE:
+        return path.absolute().as_uri()
+    return path
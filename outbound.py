@@ -0,0 +1,311 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Coroutine
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+
+logger = logging.getLogger(__name__)
+
+# Requests per second sent to Telegram by the whole bot
+OUTBOUND_GLOBAL_RATE = float(os.environ.get("OUTBOUND_GLOBAL_RATE", 25))
+# Requests per second to a private chat, and how many may be sent at once above it
+OUTBOUND_CHAT_RATE = float(os.environ.get("OUTBOUND_CHAT_RATE", 1))
+OUTBOUND_CHAT_BURST = float(os.environ.get("OUTBOUND_CHAT_BURST", 3))
+# Requests per second to a group chat, Telegram allows 20 per minute
+OUTBOUND_GROUP_RATE = float(os.environ.get("OUTBOUND_GROUP_RATE", 20 / 60))
+# Attempts of a request answered with "Too Many Requests" before the error is raised
+OUTBOUND_MAX_RETRIES = int(os.environ.get("OUTBOUND_MAX_RETRIES", 5))
+# Seconds without flood error before the global rate is raised again after a slow down
+OUTBOUND_RECOVERY_DELAY = 10.0
+
+# Priority classes, served in this order
+PRIORITY_RESULT = 0
+PRIORITY_STATUS = 1
+PRIORITY_MENU = 2
+
+# Requests delivering a compressed video to the user
+RESULT_ENDPOINTS = {"sendVideo", "sendDocument", "sendMediaGroup", "sendAnimation", "copyMessage"}
+
+
+def request_priority(endpoint: str, data: dict[str, Any], rate_limit_args: dict | None) -> int:
+    """Priority class of a request : explicit in `rate_limit_args`, or guessed from the endpoint."""
+    if rate_limit_args and "priority" in rate_limit_args:
+        return rate_limit_args["priority"]
+    if endpoint in RESULT_ENDPOINTS:
+        return PRIORITY_RESULT
+    if data.get("reply_markup") is not None or endpoint == "editMessageReplyMarkup":
+        return PRIORITY_MENU
+    return PRIORITY_STATUS
+
+
+def edit_merge_key(data: dict[str, Any]) -> tuple:
+    """
+    Identity of a text edit : every parameter but the text (message, keyboard,
+    parse mode, entities...). Only edits differing in their text alone replace
+    each other, so that a newer edit never drops the keyboard of an older one.
+    """
+    return tuple(sorted((name, json.dumps(value, sort_keys=True, default=_to_json))
+                        for name, value in data.items() if name != "text"))
+
+
+def _to_json(value: Any) -> Any:
+    return value.to_dict() if hasattr(value, "to_dict") else str(value)
+
+
+def retry_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+
+
+class TokenBucket:
+    """`rate` tokens per second, at most `capacity` saved up for bursts."""
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Seconds before a token can be taken."""
+        self._refill(now)
+        missing = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(missing, self.blocked_until - now)
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, seconds: float) -> None:
+        """Give no token for `seconds`, after a flood error."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+
+@dataclass(eq=False)
+class _Request:
+    priority: int
+    seq: int
+    chat_id: int | str
+    callback: Callable[..., Coroutine]
+    args: Any
+    kwargs: dict[str, Any]
+    merge_key: tuple | None
+    waiters: list[asyncio.Future] = field(default_factory=list)
+    attempts: int = 0
+    task: asyncio.Task | None = None
+
+    @property
+    def abandoned(self) -> bool:
+        return all(waiter.done() for waiter in self.waiters)
+
+
+class OutboundScheduler(BaseRateLimiter[dict]):
+    """
+    Single exit of the requests sent to Telegram by the bot, plugged in as the
+    rate limiter of the application.
+
+    * Each chat has a token bucket (slower for groups) and the whole bot
+      another one : requests wait for a token of both instead of running into
+      flood errors.
+    * Waiting requests are served by priority class : compressed videos, then
+      status edits, then menus ; in the order they were made inside a class.
+    * An edit of a message waiting for its turn is replaced by a newer edit
+      of the same message changing only its text, both callers getting the
+      result of the last one.
+    * A request answered with "Too Many Requests" is sent again after the
+      delay asked by Telegram, its chat is paused meanwhile, and the global
+      rate is halved until no flood error happened for a while.
+
+    Requests outside of any chat (file downloads, callback answers) are not delayed.
+    """
+
+    def __init__(self, global_rate: float = OUTBOUND_GLOBAL_RATE,
+                 chat_rate: float = OUTBOUND_CHAT_RATE,
+                 chat_burst: float = OUTBOUND_CHAT_BURST,
+                 group_rate: float = OUTBOUND_GROUP_RATE,
+                 max_retries: int = OUTBOUND_MAX_RETRIES):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, capacity=global_rate)
+        self._chats: dict[int | str, TokenBucket] = {}
+        self._queued: dict[int, _Request] = {}
+        self._edits: dict[tuple, _Request] = {}
+        self._running: set[_Request] = set()
+        self._seq = itertools.count()
+        self._last_flood = 0.0
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+
+    @property
+    def queued(self) -> int:
+        """Requests waiting for their turn."""
+        return len(self._queued)
+
+    async def initialize(self) -> None:
+        # Called by every initialization of the bot, the updater initializes it again
+        if self._task is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._dispatch_loop(), name="outbound-scheduler")
+
+    async def shutdown(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        for request in [*self._queued.values(), *self._running]:
+            for waiter in request.waiters:
+                waiter.cancel()
+            if request.task:
+                request.task.cancel()
+        self._queued.clear()
+        self._edits.clear()
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None or self._task is None:
+            return await callback(*args, **kwargs)
+
+        future = asyncio.get_running_loop().create_future()
+        merge_key = edit_merge_key(data) if endpoint == "editMessageText" else None
+        request = _Request(priority=request_priority(endpoint, data, rate_limit_args), seq=next(self._seq),
+                           chat_id=chat_id, callback=callback, args=args, kwargs=kwargs,
+                           merge_key=merge_key, waiters=[future])
+        previous = self._edits.get(merge_key) if merge_key else None
+        if previous is not None:
+            # Superseded edit : replaced by this one, at its place in the queue
+            del self._queued[previous.seq]
+            request.seq = previous.seq
+            request.priority = min(request.priority, previous.priority)
+            request.waiters[:0] = previous.waiters
+        self._enqueue(request)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            self._abandon(future)
+            raise
+
+    def _enqueue(self, request: _Request) -> None:
+        self._queued[request.seq] = request
+        if request.merge_key:
+            self._edits[request.merge_key] = request
+        self._wakeup.set()
+
+    def _dequeue(self, request: _Request) -> None:
+        self._queued.pop(request.seq, None)
+        if request.merge_key and self._edits.get(request.merge_key) is request:
+            del self._edits[request.merge_key]
+
+    def _abandon(self, future: asyncio.Future) -> None:
+        """Drop or stop the request of a cancelled caller, unless other callers still wait for it."""
+        for request in [*self._queued.values(), *self._running]:
+            if future in request.waiters and request.abandoned:
+                self._dequeue(request)
+                if request.task:
+                    request.task.cancel()
+                return
+
+    def _chat_bucket(self, chat_id: int | str) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Group and channel ids are negative
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = self.group_rate if is_group else self.chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, capacity=1 if is_group else self.chat_burst)
+        return bucket
+
+    def _slow_down(self, seconds: float) -> None:
+        self._last_flood = time.monotonic()
+        self._global.rate = max(1.0, self._global.rate / 2)
+        logger.warning(f"Flood control: retry in {seconds:.0f}s, global rate lowered to {self._global.rate:.1f}/s")
+
+    def _recover(self, now: float) -> None:
+        if self._global.rate < self.global_rate and now - self._last_flood > OUTBOUND_RECOVERY_DELAY:
+            self._global.rate = min(self.global_rate, self._global.rate * 1.5)
+            self._last_flood = now
+
+    async def _dispatch_loop(self) -> None:
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            best, wait = None, None
+            for request in list(self._queued.values()):
+                if request.abandoned:
+                    self._dequeue(request)
+                    continue
+                delay = self._chat_bucket(request.chat_id).delay(now)
+                if delay > 0:
+                    wait = delay if wait is None else min(wait, delay)
+                elif best is None or (request.priority, request.seq) < (best.priority, best.seq):
+                    best = request
+            if best is None:
+                # Woken up by a new request, or when a chat gets a token back
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self._recover(now)
+            global_delay = self._global.delay(now)
+            if global_delay > 0:
+                # A more urgent request may arrive meanwhile : the choice is made again
+                await asyncio.sleep(global_delay)
+                continue
+            self._global.take(now)
+            self._chat_bucket(best.chat_id).take(now)
+            self._dequeue(best)
+            self._running.add(best)
+            best.task = asyncio.create_task(self._send(best))
+
+    async def _send(self, request: _Request) -> None:
+        try:
+            result = await request.callback(*request.args, **request.kwargs)
+        except RetryAfter as e:
+            seconds = retry_seconds(e)
+            self._chat_bucket(request.chat_id).block(seconds)
+            self._slow_down(seconds)
+            request.attempts += 1
+            if request.attempts > self.max_retries:
+                self._resolve(request, error=e)
+                return
+            newer = self._edits.get(request.merge_key) if request.merge_key else None
+            if newer is not None:
+                newer.waiters[:0] = request.waiters
+            else:
+                self._enqueue(request)
+        except asyncio.CancelledError:
+            self._resolve(request, cancelled=True)
+        except Exception as e:
+            self._resolve(request, error=e)
+        else:
+            self._resolve(request, result=result)
+        finally:
+            self._running.discard(request)
+
+    @staticmethod
+    def _resolve(request: _Request, result: Any = None, error: BaseException | None = None,
+                 cancelled: bool = False) -> None:
+        for waiter in request.waiters:
+            if waiter.done():
+                continue
+            if cancelled:
+                waiter.cancel()
+            elif error is not None:
+                waiter.set_exception(error)
+            else:
+                waiter.set_result(result)
@@ -0,0 +1,520 @@
+import logging
+import time
+from dataclasses import asdict, dataclass, field, replace
+from pathlib import Path
+from typing import Awaitable, Callable
+
+from codec_policy import CodecPolicy
+from compression_queue import (PENDING, STAGE_ENCODED, STAGE_ENCODING, STAGE_PROBING, CompressionQueue,
+                               QueuedJob)
+from encoders import AUTO_VCODEC, DEFAULT_VCODEC, get_backend, resolve_vcodec, scaled_bitrate
+from engine import (DEFAULT_PRESET, CompressionEngine, Rendition, build_ffmpeg_command, build_ladder_command,
+                    run_ffmpeg)
+from preset_policy import ADAPTIVE_PRESET, PresetPolicy
+from probe import (CONTAINER_CODECS, EncodePlan, MediaInfo, StreamPlan, fit_resolution, plan_encode, probe_duration,
+                   probe_media)
+from progress import EncodeProgress
+from segments import SegmentError, compress_segmented, should_segment
+from settings_store import UserSettings
+from streaming import StreamError, StreamingDownload, compress_streaming
+from target_size import TARGET_SIZE_ATTEMPTS, TARGET_TWO_PASS, TargetSizeError, parse_size, size_target
+from thumbnails import add_cover_output, cover_path
+from tracing import span
+
+
+logger = logging.getLogger(__name__)
+
+
+def encode_options(user_settings: UserSettings) -> dict:
+    """Engine options matching the user settings. The "auto" codec is chosen by `encode_job`."""
+    return {
+        "vcodec": resolve_vcodec(user_settings.vcodec, user_settings.video_format),
+        "resolution": user_settings.compresse_resolution,
+        "bitrate": user_settings.bitrate,
+        "tune": user_settings.tune,
+        "preset": DEFAULT_PRESET
+    }
+
+
+def parse_renditions(value: str) -> list[tuple[str, str]]:
+    """(resolution, bitrate) pairs of the ladder mode setting, smallest resolution first."""
+    pairs = [tuple(entry.split("@", 1)) for entry in value.split(",") if "@" in entry]
+    return sorted(pairs, key=lambda pair: int(pair[0].split(":")[1]))
+
+
+def rendition_path(output_path: Path, resolution: str) -> Path:
+    return output_path.with_name(f"{output_path.stem} [{resolution.split(':')[1]}p]{output_path.suffix}")
+
+
+async def compress_video(engine: CompressionEngine,
+                         input_path: Path,
+                         output_path: Path,
+                         on_progress: Callable[[EncodeProgress], None] | None = None,
+                         segments_dir: Path | None = None,
+                         download: StreamingDownload | None = None,
+                         cover: Path | None = None,
+                         target_size: int | None = None,
+                         **options) -> tuple[float, float]:
+    """
+    Compress a video with the engine, in parallel segments when it is long enough.
+
+    The input is probed first to take the cheapest path : a plain remux when
+    nothing needs re-encoding, compatible tracks copied, no upscaling.
+    An input still being downloaded is encoded as it arrives, or once complete
+    if ffmpeg cannot read it that way. A single pass encoding also writes the
+    cover frame of the video to `cover`, from the frames it decodes anyway.
+    With a `target_size`, the bitrate is derived from it, see `compress_to_size`.
+
+    Args:
+        engine (CompressionEngine): Engine running the encodings.
+        input_path (Path): Path to original video.
+        output_path (Path): Path to save compressed video.
+        on_progress (Callable): Called with the encoding progress.
+        segments_dir (Path): Where the segments are kept to resume an interrupted encoding.
+        download (StreamingDownload): Download of `input_path`, if it may still be in progress.
+        cover (Path): Where to write the cover frame, if wanted.
+        target_size (int): Size in bytes the output must not exceed, instead of the bitrate option.
+        **options: Encoding options, see `encode_options`.
+
+    Returns:
+        tuple: (compressed_file_size_MB, compression_duration_sec)
+
+    Raises:
+        RuntimeError: If FFmpeg or the download fails.
+        TargetSizeError: If the video cannot be brought under `target_size`.
+        JobCancelled: If the job is cancelled.
+    """
+    if download is not None:
+        if download.streamable and not download.finished:
+            try:
+                with span("streaming"):
+                    return await compress_streaming(engine, download, output_path, on_progress=on_progress,
+                                                    cover=cover, **options)
+            except StreamError as e:
+                logger.warning(f"{e}, the complete file is compressed instead")
+        with span("download.wait"):
+            await download.wait()
+
+    info: MediaInfo | None = None
+    plan: EncodePlan | None = None
+    try:
+        info = await probe_media(input_path)
+        plan = plan_encode(info, video_format=output_path.suffix.lstrip(".").lower(),
+                           resolution=options["resolution"], bitrate=options["bitrate"], vcodec=options["vcodec"])
+        logger.info(f"Encode plan of {input_path.name}: {plan}")
+    except (OSError, RuntimeError, KeyError, ValueError) as e:
+        logger.warning(f"Cannot probe {input_path}, every stream re-encoded: {e}")
+
+    if target_size is not None:
+        if info is None:
+            raise TargetSizeError(f"Cannot probe {input_path.name}, no bitrate can be derived from the target size")
+        return await compress_to_size(engine, input_path, output_path, info, plan, target_size,
+                                      on_progress=on_progress, segments_dir=segments_dir, cover=cover, **options)
+    return await encode_planned(engine, input_path, output_path, plan, info.duration if info else None,
+                                on_progress=on_progress, segments_dir=segments_dir, cover=cover, **options)
+
+
+async def encode_planned(engine: CompressionEngine,
+                         input_path: Path,
+                         output_path: Path,
+                         plan: EncodePlan | None,
+                         duration: float | None,
+                         on_progress: Callable[[EncodeProgress], None] | None = None,
+                         segments_dir: Path | None = None,
+                         cover: Path | None = None,
+                         two_pass: bool = False,
+                         **options) -> tuple[float, float]:
+    """
+    Run the encoding of a probed video : a remux, parallel segments, or a single pass.
+
+    Args:
+        plan (EncodePlan): Streams to copy or encode, None if the input could not be probed.
+        duration (float): Duration of the input.
+        two_pass (bool): Encode a single pass output in two passes, if its encoder supports it.
+
+    See `compress_video` for the other arguments and the result.
+    """
+    if plan is not None and plan.remux_only:
+        start_time = time.time()
+        await run_ffmpeg(build_ffmpeg_command(input_path, output_path, plan=plan, **options))
+        size_mb = output_path.stat().st_size / (1024 * 1024)
+        return round(size_mb, 2), round(time.time() - start_time, 2)
+
+    options["plan"] = plan
+    if should_segment(duration, engine.max_workers):
+        try:
+            with span("segments"):
+                return await compress_segmented(engine, input_path, output_path, duration,
+                                                on_progress=on_progress, work_dir=segments_dir, **options)
+        except SegmentError as e:
+            logger.warning(f"Segmented compression of {input_path} failed, single pass instead: {e}")
+            output_path.unlink(missing_ok=True)
+    if two_pass and plan is not None and plan.video is not None and get_backend(options["vcodec"]).two_pass:
+        # The pass statistics are numbered by output stream : no cover output, it is extracted before the upload
+        return await encode_two_pass(engine, input_path, output_path, duration, on_progress=on_progress, **options)
+    command, extra_outputs = None, None
+    if cover is not None:
+        command = add_cover_output(build_ffmpeg_command(input_path, output_path, **options), plan, cover, duration)
+        extra_outputs = [cover]
+    return await engine.compress(input_path, output_path, on_progress=on_progress, total_duration=duration,
+                                 command=command, extra_outputs=extra_outputs, **options)
+
+
+async def encode_two_pass(engine: CompressionEngine,
+                          input_path: Path,
+                          output_path: Path,
+                          duration: float | None,
+                          on_progress: Callable[[EncodeProgress], None] | None = None,
+                          **options) -> tuple[float, float]:
+    """
+    Encode a video in two passes : the first one only analyses the video, the
+    second one spends the bitrate where the first one found it most needed.
+
+    Returns:
+        tuple: (compressed_file_size_MB, compression_duration_sec of both passes)
+    """
+    backend = get_backend(options["vcodec"])
+    log_prefix = str(output_path.with_name(f".{output_path.stem}.passlog"))
+    analysis = output_path.with_name(f".{output_path.stem}.pass1")
+    first = build_ffmpeg_command(input_path, analysis, **{**options, "plan": replace(options["plan"], others=[])})
+    first = [*first[:-1], *backend.pass_flags(1, log_prefix), "-f", "null", str(analysis)]
+    second = build_ffmpeg_command(input_path, output_path, **options)
+    second = [*second[:-1], *backend.pass_flags(2, log_prefix), second[-1]]
+    try:
+        with span("two_pass.analysis"):
+            # The null muxer writes nothing : the job reports an empty output
+            analysis.touch()
+            _, first_duration = await engine.compress(input_path, analysis, on_progress=on_progress,
+                                                      total_duration=duration, command=first)
+        size_mb, second_duration = await engine.compress(input_path, output_path, on_progress=on_progress,
+                                                         total_duration=duration, command=second)
+    finally:
+        analysis.unlink(missing_ok=True)
+        for log in output_path.parent.iterdir():
+            if log.name.startswith(Path(log_prefix).name):
+                log.unlink(missing_ok=True)
+    return size_mb, round(first_duration + second_duration, 2)
+
+
+def copy_plan(info: MediaInfo, plan: EncodePlan | None, video_format: str) -> EncodePlan | None:
+    """Plan copying the video of the input as is, None if the container cannot hold it."""
+    video = info.video
+    accepted = CONTAINER_CODECS.get(video_format, CONTAINER_CODECS["mkv"])["video"]
+    if video is None or plan is None or (accepted is not None and video.codec_name not in accepted):
+        return None
+    return replace(plan, video=StreamPlan(video.index, "video", "copy"), scale=None,
+                   notes=["original already within the target size : copied"])
+
+
+async def compress_to_size(engine: CompressionEngine,
+                           input_path: Path,
+                           output_path: Path,
+                           info: MediaInfo,
+                           plan: EncodePlan | None,
+                           target_size: int,
+                           on_progress: Callable[[EncodeProgress], None] | None = None,
+                           segments_dir: Path | None = None,
+                           cover: Path | None = None,
+                           **options) -> tuple[float, float]:
+    """
+    Compress a video under a target size.
+
+    The video bitrate is computed from the probed duration and the bitrate of
+    the audio tracks, and capped by the VBV of the encoder (or spread by a
+    two-pass encoding with TARGET_TWO_PASS). The size of the output is checked :
+    an output above the target is encoded again with a corrected bitrate. The
+    target is lowered to the size of the input, which is copied as is when no
+    encoding gets under it : the output is never larger than the original.
+
+    Args:
+        info (MediaInfo): Probed input.
+        plan (EncodePlan): Streams of the input with the user settings, for the audio bitrate.
+        target_size (int): Size in bytes the output must not exceed.
+
+    See `compress_video` for the other arguments and the result.
+
+    Raises:
+        TargetSizeError: If no encoding fits in the target.
+    """
+    start_time = time.time()
+    target = size_target(info, plan, target_size)
+    video_format = output_path.suffix.lstrip(".").lower()
+    bitrate = target.video_bitrate
+    for attempt in range(1, TARGET_SIZE_ATTEMPTS + 1):
+        options.update(bitrate=f"{bitrate // 1000}k", maxrate=f"{bitrate // 1000}k")
+        plan = plan_encode(info, video_format=video_format, resolution=options["resolution"],
+                           bitrate=options["bitrate"], vcodec=options["vcodec"])
+        logger.info(f"{input_path.name} aims at {target.max_bytes} bytes with a video bitrate of "
+                    f"{options['bitrate']} (attempt {attempt}): {plan}")
+        output_path.unlink(missing_ok=True)
+        # The segments of an earlier attempt used another bitrate : only the first one can be resumed
+        await encode_planned(engine, input_path, output_path, plan, info.duration, on_progress=on_progress,
+                             segments_dir=segments_dir if attempt == 1 else None, cover=cover,
+                             two_pass=TARGET_TWO_PASS, **options)
+        size = output_path.stat().st_size
+        if target.fits(size):
+            return round(size / (1024 * 1024), 2), round(time.time() - start_time, 2)
+        logger.warning(f"{output_path.name} is {size} bytes, above its {target.max_bytes} bytes target")
+        if attempt < TARGET_SIZE_ATTEMPTS:
+            bitrate = target.corrected_bitrate(bitrate, size)
+
+    output_path.unlink(missing_ok=True)
+    original = copy_plan(info, plan, video_format) if info.size <= target_size else None
+    if original is not None:
+        await run_ffmpeg(build_ffmpeg_command(input_path, output_path, **{**options, "plan": original}))
+        size = output_path.stat().st_size
+        if target.fits(size):
+            return round(size / (1024 * 1024), 2), round(time.time() - start_time, 2)
+        output_path.unlink(missing_ok=True)
+    raise TargetSizeError(f"{input_path.name} does not fit in {target.max_bytes / (1024 * 1024):.1f}MB "
+                          f"after {TARGET_SIZE_ATTEMPTS} encodings")
+
+
+async def compress_ladder(engine: CompressionEngine,
+                          input_path: Path,
+                          output_path: Path,
+                          renditions: list[tuple[str, str]],
+                          on_progress: Callable[[EncodeProgress], None] | None = None,
+                          **options) -> tuple[list[Path], float]:
+    """
+    Compress a video in several resolutions with a single decoding.
+
+    Args:
+        engine (CompressionEngine): Engine running the encoding.
+        input_path (Path): Path to original video.
+        output_path (Path): Path the renditions are named after.
+        renditions (list): (resolution, bitrate) pairs.
+        on_progress (Callable): Called with the encoding progress.
+        **options: Encoding options, see `encode_options`.
+
+    Returns:
+        tuple: (paths of the renditions in the order of `renditions`, compression_duration_sec)
+
+    Raises:
+        RuntimeError: If FFmpeg fails.
+        JobCancelled: If the job is cancelled.
+    """
+    info, plan = None, None
+    try:
+        info = await probe_media(input_path)
+        plan = plan_encode(info, video_format=output_path.suffix.lstrip(".").lower(),
+                           resolution=renditions[0][0], bitrate=renditions[0][1], vcodec=options["vcodec"])
+    except (OSError, RuntimeError, KeyError, ValueError) as e:
+        logger.warning(f"Cannot probe {input_path}, every stream re-encoded: {e}")
+    if info is not None and info.video is None:
+        raise RuntimeError("No video stream to compress")
+
+    ladder = [Rendition(output_path=rendition_path(output_path, resolution),
+                        bitrate=bitrate,
+                        scale=fit_resolution(info.video, resolution) if info else f"scale={resolution}")
+              for resolution, bitrate in renditions]
+    for rendition in ladder:
+        rendition.output_path.unlink(missing_ok=True)
+    command = build_ladder_command(input_path, ladder, vcodec=options["vcodec"], tune=options["tune"],
+                                   preset=options["preset"], plan=plan)
+    job = engine.submit(input_path, ladder[0].output_path,
+                        on_progress=on_progress,
+                        command=command,
+                        total_duration=info.duration if info else None,
+                        extra_outputs=[rendition.output_path for rendition in ladder[1:]])
+    _, duration = await job.result()
+    return [rendition.output_path for rendition in ladder], duration
+
+
+def record_speed(policy: PresetPolicy, codecs: CodecPolicy | None, vcodec: str, preset: str, speed: float) -> None:
+    """Feed the policies with the speed of an encoding, the preset policy in x264 terms."""
+    if codecs is None:
+        policy.record(preset, speed)
+        return
+    policy.record(preset, speed / codecs.relative_speed(vcodec))
+    codecs.record(vcodec, preset, speed)
+
+
+def restore_speeds(policy: PresetPolicy, queue: CompressionQueue, codecs: CodecPolicy | None = None) -> None:
+    """Feed the policies with the encoding speeds measured before a restart, oldest first."""
+    for done in reversed(queue.recent_done()):
+        if done.payload.get("preset") and done.payload.get("encode_speed"):
+            record_speed(policy, codecs, done.payload.get("vcodec", DEFAULT_VCODEC), done.payload["preset"],
+                         done.payload["encode_speed"])
+
+
+def choose_options(user_settings: UserSettings,
+                   duration: float | None,
+                   queue: CompressionQueue,
+                   policy: PresetPolicy,
+                   workers: int,
+                   codecs: CodecPolicy | None = None,
+                   vcodec: str | None = None,
+                   preset: str | None = None) -> tuple[dict, dict]:
+    """
+    Engine options of a job, with the codec ("auto" setting) and the preset picked from the load.
+
+    Args:
+        user_settings (UserSettings): Settings of the job.
+        duration (float): Duration of the video in seconds, if known.
+        queue (CompressionQueue): Queue giving the load.
+        policy (PresetPolicy): Preset policy of this process.
+        workers (int): Number of jobs encoded in parallel.
+        codecs (CodecPolicy): Codec policy of this process, for the "auto" codec setting.
+        vcodec (str): Codec to keep instead of choosing one.
+        preset (str): Preset to keep instead of choosing one.
+
+    Returns:
+        tuple[dict, dict]: The options (see `encode_options`), and the choices made with their reasons.
+    """
+    options = encode_options(user_settings)
+    choices = {}
+    if vcodec:
+        options["vcodec"] = vcodec
+    elif user_settings.vcodec == AUTO_VCODEC and codecs is not None:
+        choice = codecs.choose(video_format=user_settings.video_format,
+                               duration=duration,
+                               pending=queue.count(PENDING),
+                               workers=workers,
+                               average_job_time=queue.average_duration())
+        options["vcodec"] = choice.vcodec
+        choices.update(vcodec=choice.vcodec, vcodec_reason=choice.reason)
+    else:
+        choices.update(vcodec=options["vcodec"])
+    if user_settings.vcodec == AUTO_VCODEC:
+        # Same quality as x264 at the bitrate of the user, in a smaller file
+        options["bitrate"] = scaled_bitrate(options["bitrate"], options["vcodec"])
+
+    if preset:
+        options["preset"] = preset
+    elif ADAPTIVE_PRESET:
+        choice = policy.choose(duration=duration,
+                               pending=queue.count(PENDING),
+                               workers=workers,
+                               average_job_time=queue.average_duration(),
+                               speed_factor=codecs.relative_speed(options["vcodec"]) if codecs else 1.0)
+        options["preset"] = choice.preset
+        choices.update(preset=choice.preset, preset_reason=choice.reason)
+    return options, choices
+
+
+@dataclass
+class EncodeResult:
+    """Outcome of the encoding of a queued job, handed to the upload."""
+    outputs: list[str] = field(default_factory=list)
+    size_mb: float = 0.0
+    duration: float = 0.0
+    input_size: int = 0
+    media_duration: float | None = None
+    preset: str = DEFAULT_PRESET
+    vcodec: str = DEFAULT_VCODEC
+
+    @property
+    def speed(self) -> float | None:
+        """Seconds of video encoded per second."""
+        if not self.media_duration or not self.duration:
+            return None
+        return self.media_duration / self.duration
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "EncodeResult":
+        return cls(**{name: value for name, value in data.items() if name in cls.__dataclass_fields__})
+
+
+async def encode_job(engine: CompressionEngine,
+                     queue: CompressionQueue,
+                     policy: PresetPolicy,
+                     job: QueuedJob,
+                     workers: int,
+                     on_progress: Callable[[EncodeProgress], None] | None = None,
+                     on_start: Callable[[str, str], Awaitable[None]] | None = None,
+                     download: StreamingDownload | None = None,
+                     codecs: CodecPolicy | None = None) -> EncodeResult:
+    """
+    Encoding part of a queued job, shared by the bot and the workers.
+
+    Picks the codec ("auto" setting) and the preset from the load, compresses
+    the video (ladder mode or single output), records the measured speed, and
+    deletes the original. The stages reached are checkpointed in the queue : a
+    job interrupted by a restart keeps its codec and preset and only encodes
+    the segments it is missing.
+
+    Args:
+        engine (CompressionEngine): Engine running the encodings.
+        queue (CompressionQueue): Queue of the job, used for the load and to record the choices.
+        policy (PresetPolicy): Preset policy of this process.
+        job (QueuedJob): The job to encode.
+        workers (int): Number of jobs encoded in parallel.
+        on_progress (Callable): Called with the encoding progress.
+        on_start (Callable): Called with the chosen codec and preset before the encoding starts.
+        download (StreamingDownload): Download of the original, if it may still be in progress.
+        codecs (CodecPolicy): Codec policy of this process, for the "auto" codec setting.
+
+    Raises:
+        RuntimeError: If FFmpeg or the download fails.
+        TargetSizeError: If the video cannot be brought under the target size of the user.
+        JobCancelled: If the job is cancelled.
+    """
+    payload = job.payload
+    file_path = Path(payload["input_path"])
+    compressed_path = Path(payload["output_path"])
+    user_settings = UserSettings.from_dict(payload["settings"])
+
+    # Leftover of a run interrupted by a restart : ffmpeg -n refuses to overwrite it
+    compressed_path.unlink(missing_ok=True)
+
+    # The ladder mode has the bitrates of its renditions
+    target_size = None if user_settings.renditions else parse_size(user_settings.target_size)
+    # Only a single output can be encoded while the original is downloaded, and its size
+    # can only be checked against a target with the complete original to encode it again
+    streaming = download is not None and not download.finished and not user_settings.renditions \
+        and target_size is None
+    if download is not None and not streaming:
+        await download.wait()
+
+    queue.checkpoint(job.job_id, STAGE_PROBING)
+    media_duration = download.duration if streaming else await probe_duration(file_path)
+    # A resumed job keeps the codec and the preset of its encoded segments, a previewed job those of its samples
+    options, choices = choose_options(user_settings, media_duration, queue, policy, workers, codecs=codecs,
+                                      vcodec=payload.get("vcodec"), preset=payload.get("preset"))
+    if choices:
+        queue.update_payload(job.job_id, **choices)
+    if "vcodec_reason" in choices:
+        logger.info(f"Job {job.job_id} uses codec {choices['vcodec']}: {choices['vcodec_reason']}")
+    if "preset_reason" in choices:
+        logger.info(f"Job {job.job_id} uses preset {choices['preset']}: {choices['preset_reason']}")
+    renditions = parse_renditions(user_settings.renditions)
+    if user_settings.vcodec == AUTO_VCODEC:
+        renditions = [(resolution, scaled_bitrate(bitrate, options["vcodec"])) for resolution, bitrate in renditions]
+
+    queue.checkpoint(job.job_id, STAGE_ENCODING)
+    if on_start is not None:
+        await on_start(options["vcodec"], options["preset"])
+
+    input_size = (download.total_size or 0) if streaming else file_path.stat().st_size
+    result = EncodeResult(input_size=input_size, media_duration=media_duration,
+                          preset=options["preset"], vcodec=options["vcodec"])
+    if renditions:
+        outputs, result.duration = await compress_ladder(engine, file_path, compressed_path, renditions,
+                                                         on_progress=on_progress, **options)
+        result.outputs = [str(path) for path in outputs]
+        result.size_mb = round(sum(path.stat().st_size for path in outputs) / (1024 * 1024), 2)
+    else:
+        result.size_mb, result.duration = await compress_video(
+            engine, file_path, compressed_path, on_progress=on_progress,
+            segments_dir=compressed_path.parent / f".segments_{job.job_id}",
+            download=download if streaming else None,
+            # A custom thumbnail makes the cover useless
+            cover=cover_path(compressed_path) if user_settings.thumbnail != "Exist" else None,
+            target_size=target_size, **options)
+        result.outputs = [str(compressed_path)]
+        queue.update_payload(job.job_id, output_mb=result.size_mb, encode_seconds=result.duration)
+        # The ladder encodes several outputs at once, its speed says nothing about the preset ;
+        # neither does a target size, whose output may have been encoded twice, nor parallel segments
+        if result.speed and target_size is None and not should_segment(media_duration, engine.max_workers):
+            record_speed(policy, codecs, options["vcodec"], options["preset"], result.speed)
+            queue.update_payload(job.job_id, encode_speed=round(result.speed, 3))
+
+    # Checkpoint before deleting the original : from now on the job only has to be uploaded
+    queue.checkpoint(job.job_id, STAGE_ENCODED, result=result.to_dict())
+    if payload.get("owns_input", True):
+        file_path.unlink(missing_ok=True)
+    return result
@@ -0,0 +1,118 @@
+import logging
+import os
+from dataclasses import dataclass
+
+from engine import DEFAULT_PRESET
+
+
+logger = logging.getLogger(__name__)
+
+# Adapt the x264 preset of each job to the load, instead of always using DEFAULT_PRESET
+ADAPTIVE_PRESET = os.environ.get("ADAPTIVE_PRESET", "1") == "1"
+# Fastest and slowest presets the policy may choose
+PRESET_FASTEST = os.environ.get("PRESET_FASTEST", "veryfast")
+PRESET_SLOWEST = os.environ.get("PRESET_SLOWEST", "medium")
+# Seconds the queued jobs should need to drain, above it faster presets are used
+QUEUE_LATENCY_TARGET = float(os.environ.get("QUEUE_LATENCY_TARGET", 600))
+# Maximum encoding time of a single job, in seconds
+JOB_ENCODE_SLO = float(os.environ.get("JOB_ENCODE_SLO", 1800))
+
+# x264 presets, fastest first
+X264_PRESETS = ["ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow", "slower", "veryslow"]
+# Typical encoding speed of each preset relative to "faster", used until it has been measured
+PRESET_SPEED_FACTORS = {
+    "ultrafast": 3.0,
+    "superfast": 2.2,
+    "veryfast": 1.5,
+    "faster": 1.0,
+    "fast": 0.75,
+    "medium": 0.6,
+    "slow": 0.35,
+    "slower": 0.15,
+    "veryslow": 0.07,
+}
+
+
+@dataclass(frozen=True)
+class PresetChoice:
+    """Preset picked for a job, and why."""
+    preset: str
+    reason: str
+
+
+class PresetPolicy:
+    """
+    Chooses the encoder preset of each job from the load of the bot.
+
+    The slowest preset (smallest output at the same quality) is taken as long as :
+
+    * the encoding of the job itself stays under `job_slo` seconds, from the
+      measured speed of that preset on recent jobs ;
+    * the jobs waiting in the queue, slowed down by the same factor, can be
+      drained by the workers in less than `latency_target` seconds.
+
+    When the queue grows, presets get faster ; when the bot is idle, slower.
+    """
+
+    def __init__(self, default: str = DEFAULT_PRESET,
+                 fastest: str = PRESET_FASTEST,
+                 slowest: str = PRESET_SLOWEST,
+                 latency_target: float = QUEUE_LATENCY_TARGET,
+                 job_slo: float = JOB_ENCODE_SLO,
+                 smoothing: float = 0.3):
+        self.default = default
+        self.candidates = X264_PRESETS[X264_PRESETS.index(fastest):X264_PRESETS.index(slowest) + 1]
+        self.latency_target = latency_target
+        self.job_slo = job_slo
+        self.smoothing = smoothing
+        # Moving average of the encoding speed (seconds of video per second) of each preset
+        self.speeds: dict[str, float] = {}
+
+    def record(self, preset: str, speed: float) -> None:
+        """Take the measured speed of a finished encoding into account."""
+        if speed <= 0 or preset not in PRESET_SPEED_FACTORS:
+            return
+        previous = self.speeds.get(preset)
+        self.speeds[preset] = speed if previous is None else previous + self.smoothing * (speed - previous)
+
+    def estimated_speed(self, preset: str) -> float | None:
+        """Expected encoding speed of a preset : measured, or derived from the measured ones."""
+        if preset in self.speeds:
+            return self.speeds[preset]
+        derived = [speed * PRESET_SPEED_FACTORS[preset] / PRESET_SPEED_FACTORS[measured]
+                   for measured, speed in self.speeds.items()]
+        return sum(derived) / len(derived) if derived else None
+
+    def choose(self, duration: float | None, pending: int, workers: int, average_job_time: float,
+               speed_factor: float = 1.0) -> PresetChoice:
+        """
+        Pick the preset of a job about to start.
+
+        Args:
+            duration (float): Duration of the video, in seconds.
+            pending (int): Number of jobs waiting in the queue.
+            workers (int): Number of jobs run in parallel.
+            average_job_time (float): Mean run time of the recent jobs, with the default preset.
+            speed_factor (float): Speed of the codec of the job relative to x264, whose speeds are recorded.
+
+        Returns:
+            PresetChoice: The preset and the reason of the choice.
+        """
+        backlog = pending * average_job_time / max(1, workers)
+        rejected = None
+        for preset in reversed(self.candidates):
+            slowdown = PRESET_SPEED_FACTORS[self.default] / PRESET_SPEED_FACTORS[preset]
+            speed = self.estimated_speed(preset)
+            speed = speed * speed_factor if speed else None
+            if duration and speed and duration / speed > self.job_slo:
+                rejected = (f"{preset} would encode in {duration / speed:.0f}s, "
+                            f"above the {self.job_slo:.0f}s job limit")
+                continue
+            if backlog * slowdown > self.latency_target:
+                rejected = (f"{preset} would drain the queue in {backlog * slowdown:.0f}s, "
+                            f"above the {self.latency_target:.0f}s target")
+                continue
+            if rejected is None:
+                return PresetChoice(preset, f"spare capacity, queue drains in {backlog:.0f}s")
+            return PresetChoice(preset, rejected)
+        return PresetChoice(self.candidates[0], f"overloaded, {rejected}")
@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import os
+from collections import deque
+from dataclasses import dataclass
+from pathlib import Path
+
+from engine import CompressionEngine, build_ffmpeg_command
+from probe import plan_encode, probe_media
+from segments import should_segment
+from target_size import size_target
+
+
+logger = logging.getLogger(__name__)
+
+# Number and length in seconds of the windows encoded to preview a job
+PREVIEW_SAMPLES = int(os.environ.get("PREVIEW_SAMPLES", 3))
+PREVIEW_SAMPLE_LENGTH = float(os.environ.get("PREVIEW_SAMPLE_LENGTH", 4))
+# Previews encoded at the same time, outside of the engine slots but within its CPU budget
+PREVIEW_CONCURRENCY = int(os.environ.get("PREVIEW_CONCURRENCY", 1))
+# Seconds a previewed job waits for the user to confirm it before being dropped
+PREVIEW_CONFIRM_TIMEOUT = float(os.environ.get("PREVIEW_CONFIRM_TIMEOUT", 3600))
+# Past jobs needed before their errors are used to correct the estimates
+ESTIMATE_MIN_HISTORY = 3
+
+MB = 1024 * 1024
+
+_preview_slots = asyncio.Semaphore(max(1, PREVIEW_CONCURRENCY))
+
+
+@dataclass(frozen=True)
+class Estimate:
+    """Predicted outcome of a job."""
+    size_mb: float
+    seconds: float
+    input_mb: float
+
+    @property
+    def bigger(self) -> bool:
+        """True when the compressed file would not be smaller than the original."""
+        return self.size_mb >= self.input_mb
+
+    def to_dict(self) -> dict:
+        return {"size_mb": round(self.size_mb, 2), "seconds": round(self.seconds, 1), "input_mb": round(self.input_mb, 2)}
+
+
+@dataclass(frozen=True)
+class Preview:
+    """Sample encoding of a job : a short clip and the estimate extrapolated from the samples."""
+    clip: Path
+    raw: Estimate
+    estimate: Estimate
+
+
+def sample_windows(duration: float, count: int = PREVIEW_SAMPLES,
+                   length: float = PREVIEW_SAMPLE_LENGTH) -> list[tuple[float, float]]:
+    """
+    (start, length) of `count` windows spread over the video, the whole video if it is too short.
+    """
+    if duration <= count * length:
+        return [(0.0, duration)]
+    step = duration / count
+    return [(step * i + (step - length) / 2, length) for i in range(count)]
+
+
+def windowed(ffmpeg_cmd: list[str], start: float, length: float) -> list[str]:
+    """Restrict an ffmpeg command to a window of its input, seeking before decoding."""
+    index = ffmpeg_cmd.index("-i")
+    return [*ffmpeg_cmd[:index], "-ss", f"{start:.3f}", "-t", f"{length:.3f}", *ffmpeg_cmd[index:]]
+
+
+class EstimateModel:
+    """
+    Correction of the sample estimates, fitted on the past jobs.
+
+    Sampling misses what a full encoding does differently : rate control
+    settling, segments in parallel, ffmpeg start-up paid on every sample. The
+    model keeps (raw estimate, actual value) pairs of the last jobs and fits a
+    factor per measure by least squares, applied to the next estimates.
+    """
+
+    def __init__(self, history: int = 200):
+        self.size_pairs: deque[tuple[float, float]] = deque(maxlen=history)
+        self.time_pairs: deque[tuple[float, float]] = deque(maxlen=history)
+        self.size_factor = 1.0
+        self.time_factor = 1.0
+
+    def record(self, raw: dict, output_mb: float, encode_seconds: float) -> None:
+        """Take the actual outcome of a previewed job into account."""
+        if raw.get("size_mb") and output_mb:
+            self.size_pairs.append((raw["size_mb"], output_mb))
+            self.size_factor = self._fit(self.size_pairs)
+        if raw.get("seconds") and encode_seconds:
+            self.time_pairs.append((raw["seconds"], encode_seconds))
+            self.time_factor = self._fit(self.time_pairs)
+
+    @staticmethod
+    def _fit(pairs: deque[tuple[float, float]]) -> float:
+        if len(pairs) < ESTIMATE_MIN_HISTORY:
+            return 1.0
+        # Slope of actual = factor * estimate, through the origin
+        factor = sum(estimate * actual for estimate, actual in pairs) / sum(estimate ** 2 for estimate, _ in pairs)
+        return min(4.0, max(0.25, factor))
+
+    def correct(self, raw: Estimate) -> Estimate:
+        return Estimate(size_mb=raw.size_mb * self.size_factor,
+                        seconds=raw.seconds * self.time_factor,
+                        input_mb=raw.input_mb)
+
+
+def restore_estimates(model: EstimateModel, jobs: list) -> None:
+    """Fit the model on the previewed jobs completed before a restart, given most recent first."""
+    for job in reversed(jobs):
+        if job.payload.get("estimate") and job.payload.get("output_mb"):
+            model.record(job.payload["estimate"], job.payload["output_mb"], job.payload.get("encode_seconds", 0))
+
+
+async def preview_job(engine: CompressionEngine,
+                      input_path: Path,
+                      work_dir: Path,
+                      video_format: str,
+                      model: EstimateModel,
+                      target_size: int | None = None,
+                      **options) -> Preview:
+    """
+    Encode a few windows of a video with the job options and extrapolate the full job.
+
+    In target size mode, the windows are encoded at the bitrate derived from
+    the target, and the size estimate is the target itself.
+
+    Args:
+        engine (CompressionEngine): Engine running the samples, without waiting for a slot.
+            Long videos are encoded in parallel segments, one per engine worker.
+        input_path (Path): Path to original video.
+        work_dir (Path): Where the samples are written.
+        video_format (str): Container of the output.
+        model (EstimateModel): Corrections learnt from the past jobs.
+        target_size (int): Size in bytes the output must not exceed, instead of the bitrate option.
+        **options: Encoding options, see `pipeline.encode_options`.
+
+    Returns:
+        Preview: The middle sample as a preview clip, and the estimates.
+
+    Raises:
+        RuntimeError: If the video cannot be probed, FFmpeg fails, or the target size is not reachable.
+    """
+    info = await probe_media(input_path)
+    if not info.duration:
+        raise RuntimeError("Unknown duration, no preview possible")
+    plan = plan_encode(info, video_format=video_format, resolution=options["resolution"],
+                       bitrate=options["bitrate"], vcodec=options["vcodec"])
+    target = None
+    if target_size is not None:
+        target = size_target(info, plan, target_size)
+        options.update(bitrate=f"{target.video_bitrate // 1000}k", maxrate=f"{target.video_bitrate // 1000}k")
+        plan = plan_encode(info, video_format=video_format, resolution=options["resolution"],
+                           bitrate=options["bitrate"], vcodec=options["vcodec"])
+    windows = sample_windows(info.duration)
+
+    samples = []
+    encode_time = 0.0
+    async with _preview_slots:
+        for index, (start, length) in enumerate(windows):
+            sample_path = work_dir / f"preview_{index}.{video_format}"
+            sample_path.unlink(missing_ok=True)
+            command = windowed(build_ffmpeg_command(input_path, sample_path, plan=plan, **options), start, length)
+            _, sample_time = await engine.compress(input_path, sample_path, command=command,
+                                                   total_duration=length, slot=False)
+            encode_time += sample_time
+            samples.append(sample_path)
+
+    sampled = sum(length for _, length in windows)
+    output_bytes = sum(path.stat().st_size for path in samples)
+    seconds = encode_time / sampled * info.duration
+    if should_segment(info.duration, engine.max_workers):
+        seconds /= engine.max_workers
+    raw = Estimate(size_mb=output_bytes / sampled * info.duration / MB,
+                   seconds=seconds,
+                   input_mb=input_path.stat().st_size / MB)
+
+    clip = samples[len(samples) // 2]
+    for path in samples:
+        if path != clip:
+            path.unlink(missing_ok=True)
+    logger.info(f"Preview of {input_path.name}: {raw}")
+    estimate = model.correct(raw)
+    if target is not None:
+        # The encoding is checked against the target : the size is known, not extrapolated
+        estimate = Estimate(size_mb=target.max_bytes / MB, seconds=estimate.seconds, input_mb=estimate.input_mb)
+    return Preview(clip=clip, raw=raw, estimate=estimate)
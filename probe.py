@@ -0,0 +1,304 @@
+import asyncio
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from tracing import span
+
+
+logger = logging.getLogger(__name__)
+
+
+async def run_ffprobe(input_path: Path, *args: str) -> dict:
+    """
+    Run ffprobe on a file and return its JSON output.
+
+    Raises:
+        RuntimeError: If ffprobe fails.
+    """
+    with span("ffprobe", input=Path(input_path).name):
+        process = await asyncio.create_subprocess_exec("ffprobe", "-v", "error", "-of", "json", *args,
+                                                       str(input_path),
+                                                       stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.PIPE)
+        stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(f"FFprobe failed:\n{stderr.decode(errors='replace')}")
+    return json.loads(stdout or b"{}")
+
+
+async def probe_duration(input_path: Path) -> float | None:
+    """Duration of a media file in seconds, or None if it cannot be known."""
+    try:
+        info = await run_ffprobe(input_path, "-show_entries", "format=duration")
+        return float(info["format"]["duration"])
+    except (OSError, RuntimeError, KeyError, ValueError) as e:
+        logger.warning(f"Cannot probe duration of {input_path}: {e}")
+        return None
+
+
+# Codec name produced by each encoder the bot can use
+ENCODER_CODECS = {
+    "libx264": "h264",
+    "libx265": "hevc",
+    "libsvtav1": "av1",
+    "libvpx-vp9": "vp9",
+}
+
+# Name of each output format in the ffprobe format_name list
+CONTAINER_FORMATS = {
+    "mp4": "mp4",
+    "mkv": "matroska",
+    "avi": "avi",
+    "ts": "mpegts",
+}
+
+# Codecs each container can hold without re-encoding, None means anything
+CONTAINER_CODECS = {
+    "mp4": {
+        "video": {"h264", "hevc", "av1", "vp9", "mpeg4"},
+        "audio": {"aac", "mp3", "ac3", "eac3", "opus", "alac"},
+        "subtitle": {"mov_text"},
+    },
+    "mkv": {"video": None, "audio": None, "subtitle": None},
+    "avi": {
+        "video": {"h264", "mpeg4", "mjpeg", "msmpeg4v3"},
+        "audio": {"mp3", "ac3", "pcm_s16le"},
+        "subtitle": set(),
+    },
+    "ts": {
+        "video": {"h264", "hevc", "mpeg2video"},
+        "audio": {"aac", "mp3", "mp2", "ac3", "eac3", "opus"},
+        "subtitle": {"dvb_subtitle"},
+    },
+}
+
+# Encoder used for an audio track the container cannot hold as is
+CONTAINER_AUDIO_ENCODERS = {"mp4": "aac", "mkv": "libopus", "avi": "libmp3lame", "ts": "aac"}
+
+# Text subtitles that can be converted to mov_text for mp4
+TEXT_SUBTITLES = {"subrip", "ass", "ssa", "webvtt", "text", "mov_text"}
+
+# Audio tracks above this bitrate (or lossless) are re-encoded even if the container could hold them
+AUDIO_COPY_MAX_BITRATE = int(os.environ.get("AUDIO_COPY_MAX_KBPS", 256)) * 1000
+LOSSLESS_AUDIO = {"flac", "alac", "truehd", "mlp"}
+
+
+@dataclass(frozen=True)
+class StreamInfo:
+    """A stream of a media file, as reported by ffprobe."""
+    index: int
+    codec_type: str
+    codec_name: str
+    width: int = 0
+    height: int = 0
+    bit_rate: int | None = None
+    rotation: int = 0
+    attached_pic: bool = False
+
+    @property
+    def display_size(self) -> tuple[int, int]:
+        """Width and height once the rotation metadata is applied, as ffmpeg filters see them."""
+        if abs(self.rotation) % 180 == 90:
+            return self.height, self.width
+        return self.width, self.height
+
+
+@dataclass(frozen=True)
+class MediaInfo:
+    """Format and streams of a media file."""
+    format_names: tuple[str, ...]
+    duration: float | None
+    size: int
+    bit_rate: int | None
+    streams: tuple[StreamInfo, ...]
+
+    @property
+    def video(self) -> StreamInfo | None:
+        """The main video stream, cover pictures excluded."""
+        return next((s for s in self.streams if s.codec_type == "video" and not s.attached_pic), None)
+
+    def video_bit_rate(self) -> int | None:
+        """Bitrate of the main video stream, estimated from the whole file if the stream does not tell it."""
+        video = self.video
+        if video is None:
+            return None
+        if video.bit_rate:
+            return video.bit_rate
+        total = self.bit_rate or (int(self.size * 8 / self.duration) if self.duration else None)
+        if total is None:
+            return None
+        others = sum(s.bit_rate or 0 for s in self.streams if s is not video)
+        return max(0, total - others)
+
+    def is_format(self, video_format: str) -> bool:
+        return CONTAINER_FORMATS.get(video_format) in self.format_names
+
+
+def _to_int(value) -> int | None:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _rotation(stream: dict) -> int:
+    for side_data in stream.get("side_data_list", []):
+        if "rotation" in side_data:
+            return _to_int(side_data["rotation"]) or 0
+    return _to_int(stream.get("tags", {}).get("rotate")) or 0
+
+
+async def probe_media(input_path: Path) -> MediaInfo:
+    """
+    Read the format and streams of a media file.
+
+    Raises:
+        RuntimeError: If ffprobe fails.
+    """
+    info = await run_ffprobe(input_path, "-show_format", "-show_streams")
+    media_format = info.get("format", {})
+    streams = tuple(
+        StreamInfo(index=stream["index"],
+                   codec_type=stream.get("codec_type", ""),
+                   codec_name=stream.get("codec_name", ""),
+                   width=stream.get("width", 0),
+                   height=stream.get("height", 0),
+                   bit_rate=_to_int(stream.get("bit_rate")),
+                   rotation=_rotation(stream),
+                   attached_pic=bool(stream.get("disposition", {}).get("attached_pic")))
+        for stream in info.get("streams", [])
+    )
+    duration = media_format.get("duration")
+    return MediaInfo(format_names=tuple(media_format.get("format_name", "").split(",")),
+                     duration=float(duration) if duration not in (None, "N/A") else None,
+                     size=_to_int(media_format.get("size")) or 0,
+                     bit_rate=_to_int(media_format.get("bit_rate")),
+                     streams=streams)
+
+
+def parse_bitrate(bitrate: str) -> int:
+    """Bits per second of an ffmpeg bitrate such as "480k" or "2M"."""
+    multipliers = {"k": 1_000, "m": 1_000_000}
+    unit = bitrate[-1].lower()
+    if unit in multipliers:
+        return int(float(bitrate[:-1]) * multipliers[unit])
+    return int(float(bitrate))
+
+
+@dataclass(frozen=True)
+class StreamPlan:
+    """What happens to one input stream : copied as is or re-encoded."""
+    index: int
+    codec_type: str
+    codec: str
+
+
+@dataclass
+class EncodePlan:
+    """
+    Cheapest way to produce the requested output from a probed input.
+
+    `video` is None when the input has no video, `scale` is None when the
+    video keeps its size. Streams the target container cannot hold are left out.
+    """
+    video: StreamPlan | None
+    others: list[StreamPlan]
+    scale: str | None = None
+    notes: list[str] = field(default_factory=list)
+
+    @property
+    def copy_video(self) -> bool:
+        return self.video is not None and self.video.codec == "copy"
+
+    @property
+    def remux_only(self) -> bool:
+        """True when nothing is re-encoded."""
+        return (self.video is None or self.copy_video) and all(s.codec == "copy" for s in self.others)
+
+    def video_only(self) -> "EncodePlan":
+        """Same plan for a file holding only the video stream."""
+        video = StreamPlan(0, "video", self.video.codec) if self.video else None
+        return EncodePlan(video=video, others=[], scale=self.scale, notes=self.notes)
+
+
+def fit_resolution(stream: StreamInfo, resolution: str) -> str | None:
+    """
+    Scale filter bringing the video inside the `resolution` box, or None if it already fits.
+
+    The box is turned for portrait videos, and the video is never stretched nor upscaled.
+    """
+    box_width, box_height = (int(value) for value in resolution.split(":"))
+    width, height = stream.display_size
+    if height > width:
+        box_width, box_height = min(box_width, box_height), max(box_width, box_height)
+    if width <= box_width and height <= box_height:
+        return None
+    return f"scale={box_width}:{box_height}:force_original_aspect_ratio=decrease:force_divisible_by=2"
+
+
+def plan_encode(info: MediaInfo,
+                video_format: str,
+                resolution: str,
+                bitrate: str,
+                vcodec: str = "libx264") -> EncodePlan:
+    """
+    Build the cheapest valid plan for a video and the user settings.
+
+    * the video is copied when it already has the target codec, fits the
+      resolution and does not exceed the bitrate ; it is never upscaled
+    * audio and subtitle tracks are copied when the container can hold them,
+      converted (mp4 text subtitles, audio) or dropped otherwise
+    * data streams, and attachments outside of mkv, are dropped
+
+    Args:
+        info (MediaInfo): Probed input.
+        video_format (str): Output container (mp4, mkv, avi, ts).
+        resolution (str): Maximum resolution (e.g., "1280:720").
+        bitrate (str): Target video bitrate (e.g. "480k").
+        vcodec (str): Video encoder used if the video must be re-encoded.
+
+    Returns:
+        EncodePlan: The streams to copy or encode.
+    """
+    codecs = CONTAINER_CODECS.get(video_format, CONTAINER_CODECS["mkv"])
+    notes = []
+
+    video_plan, scale = None, None
+    video = info.video
+    if video is not None:
+        scale = fit_resolution(video, resolution)
+        source_bit_rate = info.video_bit_rate()
+        container_accepts = codecs["video"] is None or video.codec_name in codecs["video"]
+        if scale is None and video.codec_name == ENCODER_CODECS.get(vcodec) and container_accepts \
+                and source_bit_rate is not None and source_bit_rate <= parse_bitrate(bitrate):
+            video_plan = StreamPlan(video.index, "video", "copy")
+            notes.append("video already within the target size and bitrate : copied")
+        else:
+            video_plan = StreamPlan(video.index, "video", vcodec)
+            if scale is None:
+                notes.append("video not upscaled")
+
+    others = []
+    for stream in info.streams:
+        if stream.codec_type == "audio":
+            lossy_and_small = stream.codec_name not in LOSSLESS_AUDIO \
+                              and not stream.codec_name.startswith("pcm_") \
+                              and (stream.bit_rate or 0) <= AUDIO_COPY_MAX_BITRATE
+            if (codecs["audio"] is None or stream.codec_name in codecs["audio"]) and lossy_and_small:
+                others.append(StreamPlan(stream.index, "audio", "copy"))
+            else:
+                others.append(StreamPlan(stream.index, "audio", CONTAINER_AUDIO_ENCODERS[video_format]))
+        elif stream.codec_type == "subtitle":
+            if codecs["subtitle"] is None or stream.codec_name in codecs["subtitle"]:
+                others.append(StreamPlan(stream.index, "subtitle", "copy"))
+            elif video_format == "mp4" and stream.codec_name in TEXT_SUBTITLES:
+                others.append(StreamPlan(stream.index, "subtitle", "mov_text"))
+            else:
+                notes.append(f"{stream.codec_name} subtitles dropped, unsupported by {video_format}")
+        elif stream.codec_type == "attachment" and video_format == "mkv":
+            others.append(StreamPlan(stream.index, "attachment", "copy"))
+
+    return EncodePlan(video=video_plan, others=others, scale=scale, notes=notes)
@@ -0,0 +1,194 @@
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass
+
+from telegram import Bot
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+
+logger = logging.getLogger(__name__)
+
+# Minimum seconds between two status edits in the same chat
+STATUS_CHAT_INTERVAL = float(os.environ.get("STATUS_CHAT_INTERVAL", 5))
+
+
+@dataclass
+class EncodeProgress:
+    """State of a running ffmpeg encoding, read from its -progress output."""
+    total_duration: float | None = None
+    out_time: float = 0.0
+    frame: int = 0
+    fps: float = 0.0
+    speed: float = 0.0
+    finished: bool = False
+    started_at: float = 0.0
+
+    @property
+    def percent(self) -> float | None:
+        if not self.total_duration:
+            return None
+        return min(100.0, 100 * self.out_time / self.total_duration)
+
+    @property
+    def eta(self) -> float | None:
+        """Seconds left before the end of the encoding."""
+        if not self.total_duration or not self.speed:
+            return None
+        return max(0.0, (self.total_duration - self.out_time) / self.speed)
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at if self.started_at else 0.0
+
+
+class ProgressParser:
+    """
+    Incremental parser of the `-progress` stream of ffmpeg.
+
+    ffmpeg writes blocks of key=value lines, each one ended by a `progress=` line.
+    """
+
+    def __init__(self, progress: EncodeProgress):
+        self.progress = progress
+        self._block: dict[str, str] = {}
+
+    def feed(self, line: str) -> bool:
+        """
+        Read one line of output.
+
+        Returns:
+            bool: True when a block is complete and the progress has been updated.
+        """
+        key, _, value = line.strip().partition("=")
+        if not key:
+            return False
+        if key != "progress":
+            self._block[key] = value
+            return False
+
+        block, self._block = self._block, {}
+        progress = self.progress
+        out_time_us = block.get("out_time_us") or block.get("out_time_ms")
+        if out_time_us and out_time_us.lstrip("-").isdigit():
+            progress.out_time = max(0.0, int(out_time_us) / 1_000_000)
+        progress.frame = _to_number(block.get("frame"), int, progress.frame)
+        progress.fps = _to_number(block.get("fps"), float, progress.fps)
+        progress.speed = _to_number(block.get("speed", "").rstrip("x"), float, progress.speed)
+        progress.finished = value == "end"
+        return True
+
+
+def _to_number(value: str | None, kind: type, default):
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def format_progress(progress: EncodeProgress, width: int = 12) -> str:
+    """Human readable summary of an encoding progress."""
+    percent = progress.percent
+    if percent is None:
+        minutes, seconds = divmod(int(progress.out_time), 60)
+        return f"{minutes:02d}:{seconds:02d} encoded • {progress.fps:.0f} fps • x{progress.speed:.2f}"
+    filled = int(width * percent / 100)
+    eta = progress.eta
+    eta_text = f"{int(eta) // 60} min {int(eta) % 60:02d} s" if eta is not None else "?"
+    return (f"[{'█' * filled}{'░' * (width - filled)}] {percent:.1f}%\n"
+            f"🎞 {progress.fps:.0f} fps • x{progress.speed:.2f} • ETA {eta_text}")
+
+
+class StatusUpdater:
+    """
+    Throttled editor of the status messages.
+
+    Only the latest text of each message is kept : edits arriving faster than
+    they can be sent replace each other. Each chat is edited at most once every
+    `chat_interval` seconds ; the global rate, the priority against the other
+    requests and the flood errors are left to the outbound scheduler of the bot.
+    """
+
+    def __init__(self, chat_interval: float = STATUS_CHAT_INTERVAL):
+        self.chat_interval = chat_interval
+        self._pending: dict[tuple[int, int], tuple[Bot, str]] = {}
+        self._chat_ready_at: dict[int, float] = {}
+        self._sent: dict[tuple[int, int], str] = {}
+        self._locks: dict[tuple[int, int], asyncio.Lock] = {}
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._in_flight: set[asyncio.Task] = set()
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._send_loop(), name="status-updater")
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def update(self, bot: Bot, chat_id: int, message_id: int, text: str) -> None:
+        """Schedule an edit of a status message, replacing any edit of it not sent yet."""
+        key = (chat_id, message_id)
+        if self._sent.get(key) == text:
+            self._pending.pop(key, None)
+            return
+        self._pending[key] = (bot, text)
+        self._wakeup.set()
+
+    async def set_final(self, bot: Bot, chat_id: int, message_id: int, text: str, **kwargs) -> None:
+        """
+        Edit a status message right away, dropping the progress edits not sent yet.
+        Waits for an edit in flight, so that it cannot land after this one.
+        """
+        key = (chat_id, message_id)
+        self._pending.pop(key, None)
+        async with self._lock(key):
+            # An edit in flight may have put its text back after a flood error
+            self._pending.pop(key, None)
+            await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, **kwargs)
+        self._sent.pop(key, None)
+        self._locks.pop(key, None)
+        self._chat_ready_at[chat_id] = time.monotonic() + self.chat_interval
+
+    def _lock(self, key: tuple[int, int]) -> asyncio.Lock:
+        return self._locks.setdefault(key, asyncio.Lock())
+
+    async def _send_loop(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self._pending:
+                now = time.monotonic()
+                ready = [key for key in self._pending if self._chat_ready_at.get(key[0], 0) <= now]
+                if not ready:
+                    next_time = min(self._chat_ready_at.get(chat_id, 0) for chat_id, _ in self._pending)
+                    await asyncio.sleep(max(0.05, next_time - now))
+                    continue
+                for key in ready:
+                    # Another message of the same chat may have been edited in this round
+                    if key not in self._pending or self._chat_ready_at.get(key[0], 0) > time.monotonic():
+                        continue
+                    self._chat_ready_at[key[0]] = time.monotonic() + self.chat_interval
+                    # Edits run in their own task : a slow request does not delay the other chats
+                    task = asyncio.create_task(self._send(key, *self._pending.pop(key)))
+                    self._in_flight.add(task)
+                    task.add_done_callback(self._in_flight.discard)
+
+    async def _send(self, key: tuple[int, int], bot: Bot, text: str) -> None:
+        chat_id, message_id = key
+        async with self._lock(key):
+            try:
+                await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text)
+                self._sent[key] = text
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+                self._chat_ready_at[chat_id] = time.monotonic() + retry_after
+                # Keep the text, unless a newer one arrived in the meantime
+                self._pending.setdefault(key, (bot, text))
+            except BadRequest as e:
+                # "Message is not modified" or message deleted by the user
+                logger.debug(f"Status edit of {key} ignored: {e}")
+            except TelegramError as e:
+                logger.warning(f"Status edit of {key} failed: {e}")
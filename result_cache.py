@@ -0,0 +1,166 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+
+logger = logging.getLogger(__name__)
+
+RESULT_CACHE_DB = os.environ.get("RESULT_CACHE_DB", "compresse_cache.db")
+# Directory keeping compressed outputs for reuse, disabled when empty
+OUTPUT_CACHE_DIR = os.environ.get("OUTPUT_CACHE_DIR", "")
+OUTPUT_CACHE_MAX_MB = float(os.environ.get("OUTPUT_CACHE_MAX_MB", 10_000))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    file_id TEXT NOT NULL,
+    upload_type TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    last_hit REAL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+def encode_key(file_unique_id: str, params: dict) -> str:
+    """
+    Cache key of an encoding : the same source file encoded with the same
+    effective parameters always gives the same output.
+    """
+    canonical = json.dumps(params, sort_keys=True, separators=(",", ":"))
+    digest = hashlib.sha256(canonical.encode()).hexdigest()[:32]
+    return f"{file_unique_id}:{digest}"
+
+
+@dataclass(frozen=True)
+class CachedResult:
+    """A compressed output already sent to Telegram."""
+    file_id: str
+    upload_type: str
+
+
+class ResultCache:
+    """
+    Cache of the compression results.
+
+    * The Telegram file_id of each output already sent : a hit is answered
+      with no download, no encoding and no upload.
+    * Optionally, the output files themselves in `output_dir`, evicted in
+      least recently used order above `max_bytes` : a hit skips the encoding.
+
+    Identical encodings submitted while one is in progress wait for it
+    instead of running again.
+    """
+
+    def __init__(self, path: str = RESULT_CACHE_DB,
+                 output_dir: str = OUTPUT_CACHE_DIR,
+                 max_bytes: int = int(OUTPUT_CACHE_MAX_MB * 1024 * 1024)):
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+        self.output_dir = Path(output_dir) if output_dir else None
+        self.max_bytes = max_bytes
+        if self.output_dir:
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+        self._inflight: dict[str, asyncio.Future] = {}
+        self.counters = {"hits": 0, "output_hits": 0, "misses": 0, "coalesced": 0}
+
+    # === Telegram file_id level ===
+    def lookup(self, key: str, upload_type: str) -> CachedResult | None:
+        row = self._db.execute("SELECT file_id, upload_type FROM results WHERE key = ?",
+                               (f"{key}:{upload_type}",)).fetchone()
+        if row is None:
+            return None
+        self._db.execute("UPDATE results SET hits = hits + 1, last_hit = ? WHERE key = ?",
+                         (time.time(), f"{key}:{upload_type}"))
+        self.counters["hits"] += 1
+        return CachedResult(*row)
+
+    def store(self, key: str, result: CachedResult) -> None:
+        self._db.execute("INSERT OR REPLACE INTO results (key, file_id, upload_type, created_at) VALUES (?, ?, ?, ?)",
+                         (f"{key}:{result.upload_type}", result.file_id, result.upload_type, time.time()))
+
+    def forget(self, key: str, upload_type: str) -> None:
+        """Drop a file_id refused by Telegram."""
+        self._db.execute("DELETE FROM results WHERE key = ?", (f"{key}:{upload_type}",))
+
+    # === Output files level ===
+    def _output_path(self, key: str, suffix: str) -> Path:
+        return self.output_dir / f"{key.replace(':', '_')}{suffix}"
+
+    def fetch_output(self, key: str, destination: Path) -> bool:
+        """
+        Put a cached output at `destination` (hardlink, or copy across filesystems).
+
+        Returns:
+            bool: False if the output is not cached.
+        """
+        if self.output_dir is None:
+            return False
+        cached = self._output_path(key, destination.suffix)
+        if not cached.exists():
+            return False
+        destination.unlink(missing_ok=True)
+        try:
+            os.link(cached, destination)
+        except OSError:
+            shutil.copyfile(cached, destination)
+        # The modification time orders the eviction
+        os.utime(cached)
+        self.counters["output_hits"] += 1
+        return True
+
+    def keep_output(self, key: str, output_path: Path) -> None:
+        """Keep a copy of a fresh output, evicting the oldest ones if the cache is full."""
+        if self.output_dir is None or not output_path.exists():
+            return
+        cached = self._output_path(key, output_path.suffix)
+        cached.unlink(missing_ok=True)
+        try:
+            os.link(output_path, cached)
+        except OSError:
+            shutil.copyfile(output_path, cached)
+        os.utime(cached)
+        self._evict()
+
+    def _evict(self) -> None:
+        files = sorted((entry.stat().st_mtime, entry.stat().st_size, entry)
+                       for entry in self.output_dir.iterdir() if entry.is_file())
+        total = sum(size for _, size, _ in files)
+        for _, size, entry in files:
+            if total <= self.max_bytes:
+                break
+            entry.unlink(missing_ok=True)
+            total -= size
+
+    # === In-flight coalescing ===
+    def leader(self, key: str) -> asyncio.Future | None:
+        """Future of the identical encoding in progress, if any."""
+        future = self._inflight.get(key)
+        if future is not None:
+            self.counters["coalesced"] += 1
+        return future
+
+    def begin(self, key: str) -> None:
+        self._inflight.setdefault(key, asyncio.get_running_loop().create_future())
+
+    def end(self, key: str, result: CachedResult | None) -> None:
+        """Release the jobs waiting for this encoding ; they get None if it failed."""
+        future = self._inflight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    def miss(self) -> None:
+        self.counters["misses"] += 1
+
+    def stats(self) -> dict:
+        lookups = self.counters["hits"] + self.counters["output_hits"] + self.counters["misses"]
+        hit_ratio = (self.counters["hits"] + self.counters["output_hits"]) / lookups if lookups else 0.0
+        return {**self.counters, "hit_ratio": round(hit_ratio, 3), "in_flight": len(self._inflight)}
@@ -0,0 +1,218 @@
+import asyncio
+import logging
+import os
+import shutil
+import time
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Awaitable, Callable
+
+
+logger = logging.getLogger(__name__)
+
+# Directory holding the originals and outputs of the jobs, e.g. on a tmpfs or a fast NVMe
+SCRATCH_ROOT = os.environ.get("SCRATCH_ROOT", "scratch")
+# Bytes a user's jobs may hold at the same time, 0 for no limit
+SCRATCH_USER_QUOTA_MB = float(os.environ.get("SCRATCH_USER_QUOTA_MB", 6000))
+# Bytes all the jobs may hold at the same time, 0 for no limit
+SCRATCH_GLOBAL_QUOTA_MB = float(os.environ.get("SCRATCH_GLOBAL_QUOTA_MB", 0))
+# Space reserved by a job, as a multiple of its input : original, output and segments
+SCRATCH_EXPANSION_FACTOR = float(os.environ.get("SCRATCH_EXPANSION_FACTOR", 3))
+# Free space always left on the scratch filesystem
+SCRATCH_MIN_FREE_MB = float(os.environ.get("SCRATCH_MIN_FREE_MB", 500))
+# Seconds a job waits for space to be freed before being refused
+SCRATCH_ADMISSION_WAIT = float(os.environ.get("SCRATCH_ADMISSION_WAIT", 300))
+# Unknown job directories untouched for this many seconds are removed by the janitor
+SCRATCH_ORPHAN_AGE = float(os.environ.get("SCRATCH_ORPHAN_AGE", 6 * 3600))
+SCRATCH_JANITOR_INTERVAL = float(os.environ.get("SCRATCH_JANITOR_INTERVAL", 600))
+
+MB = 1024 * 1024
+
+
+class ScratchFull(Exception):
+    """Raised when a job cannot get the space it needs."""
+
+
+@dataclass(eq=False)
+class JobDir:
+    """A directory of the scratch space owned by one job."""
+    path: Path
+    user_id: str
+    reserved: int = 0
+
+    def usage(self) -> int:
+        """Bytes currently written in the directory."""
+        total = 0
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                try:
+                    total += os.stat(os.path.join(root, name)).st_size
+                except FileNotFoundError:
+                    pass
+        return total
+
+
+class ScratchSpace:
+    """
+    Working directories of the jobs, under a common root.
+
+    * Each job gets its own directory : jobs never collide on file names and
+      everything they leave is removed at once.
+    * Before downloading, a job reserves its input size times an expansion
+      factor. The reservation must fit the user and global quotas and leave
+      `min_free` bytes on the disk ; otherwise the job waits for space to be
+      released, and is refused after `admission_wait` seconds.
+    * A janitor removes the directories left behind by crashed or abandoned
+      jobs.
+    """
+
+    def __init__(self, root: str = SCRATCH_ROOT,
+                 user_quota: int = int(SCRATCH_USER_QUOTA_MB * MB),
+                 global_quota: int = int(SCRATCH_GLOBAL_QUOTA_MB * MB),
+                 expansion_factor: float = SCRATCH_EXPANSION_FACTOR,
+                 min_free: int = int(SCRATCH_MIN_FREE_MB * MB),
+                 admission_wait: float = SCRATCH_ADMISSION_WAIT,
+                 orphan_age: float = SCRATCH_ORPHAN_AGE):
+        self.root = Path(root).resolve()
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.user_quota = user_quota
+        self.global_quota = global_quota
+        self.expansion_factor = expansion_factor
+        self.min_free = min_free
+        self.admission_wait = admission_wait
+        self.orphan_age = orphan_age
+        self._active: dict[Path, JobDir] = {}
+        self._released = asyncio.Condition()
+        self._janitor_task: asyncio.Task | None = None
+
+    # === Job directories ===
+    def create(self, user_id: str) -> JobDir:
+        """Make a new empty directory for a job, with no space reserved yet."""
+        path = self.root / str(user_id) / uuid.uuid4().hex[:12]
+        path.mkdir(parents=True)
+        job_dir = self._active[path] = JobDir(path, str(user_id))
+        return job_dir
+
+    async def admit(self, job_dir: JobDir, input_size: int,
+                    on_wait: Callable[[str], Awaitable[None]] | None = None) -> None:
+        """
+        Reserve the space a job needs for an input of `input_size` bytes,
+        waiting for other jobs to release theirs if needed.
+
+        Args:
+            job_dir (JobDir): Directory of the job.
+            input_size (int): Size of the video to download, in bytes.
+            on_wait (Callable): Called once with the reason when the job has to wait.
+
+        Raises:
+            ScratchFull: If the user quota is too small for the job, or if no space
+                was released in time.
+        """
+        needed = int(input_size * self.expansion_factor)
+        if self.user_quota and needed > self.user_quota:
+            raise ScratchFull(f"video needs {needed / MB:.0f} MB, "
+                              f"more than the {self.user_quota / MB:.0f} MB allowed per user")
+        deadline = time.monotonic() + self.admission_wait
+        waiting = False
+        async with self._released:
+            while (refusal := await self._check(job_dir, needed)) is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ScratchFull(refusal)
+                if not waiting and on_wait is not None:
+                    await on_wait(refusal)
+                waiting = True
+                # Woken up by a release, or checks the disk again from time to time
+                try:
+                    await asyncio.wait_for(self._released.wait(), timeout=min(remaining, 5))
+                except asyncio.TimeoutError:
+                    pass
+            job_dir.reserved = needed
+
+    async def _check(self, job_dir: JobDir, needed: int) -> str | None:
+        """`_refusal` run in a thread : it walks the directories of the running jobs."""
+        others = [other for other in self._active.values() if other is not job_dir]
+        return await asyncio.to_thread(self._refusal, job_dir, needed, others)
+
+    def _refusal(self, job_dir: JobDir, needed: int, others: list[JobDir]) -> str | None:
+        """Reason why a reservation cannot be granted right now, or None if it can."""
+        if self.user_quota:
+            user_reserved = sum(other.reserved for other in others if other.user_id == job_dir.user_id)
+            if user_reserved + needed > self.user_quota:
+                return "your other videos use all your space, wait for them to finish"
+        if self.global_quota and sum(other.reserved for other in others) + needed > self.global_quota:
+            return "the bot is busy, not enough space left"
+        # Space promised to the running jobs but not written yet
+        promised = sum(max(0, other.reserved - other.usage()) for other in others if other.reserved)
+        if shutil.disk_usage(self.root).free - promised - needed < self.min_free:
+            return "the server disk is full"
+        return None
+
+    async def release(self, path: Path | str) -> None:
+        """Remove a job directory and give its space back to the waiting jobs."""
+        path = Path(path)
+        if path.resolve().parent.parent != self.root:
+            logger.warning(f"Refusing to remove {path}: not a scratch job directory")
+            return
+        self._active.pop(path, None)
+        await asyncio.to_thread(shutil.rmtree, path, True)
+        async with self._released:
+            self._released.notify_all()
+
+    def usage(self) -> dict[str, int]:
+        """Number of active jobs, bytes they reserved and free bytes on the scratch filesystem."""
+        return {"jobs": len(self._active),
+                "reserved": sum(job_dir.reserved for job_dir in self._active.values()),
+                "free": shutil.disk_usage(self.root).free}
+
+    # === Janitor ===
+    def start(self, in_use: Callable[[], set[Path]], interval: float = SCRATCH_JANITOR_INTERVAL) -> None:
+        """
+        Start the janitor.
+
+        Args:
+            in_use (Callable): Directories of the queued jobs, kept even without a reservation.
+            interval (float): Seconds between two sweeps.
+        """
+        self._janitor_task = asyncio.create_task(self._janitor_loop(in_use, interval), name="scratch-janitor")
+
+    async def stop(self) -> None:
+        if self._janitor_task:
+            self._janitor_task.cancel()
+            await asyncio.gather(self._janitor_task, return_exceptions=True)
+
+    def sweep(self, in_use: set[Path]) -> int:
+        """
+        Remove the orphan job directories.
+
+        Returns:
+            int: Number of directories removed.
+        """
+        now = time.time()
+        kept = {path.resolve() for path in in_use} | set(self._active)
+        removed = 0
+        for user_dir in self.root.iterdir():
+            if not user_dir.is_dir():
+                continue
+            for job_dir in user_dir.iterdir():
+                try:
+                    if job_dir in kept or now - job_dir.stat().st_mtime < self.orphan_age:
+                        continue
+                except FileNotFoundError:
+                    continue
+                logger.warning(f"Removing orphan scratch directory {job_dir}")
+                if job_dir.is_dir():
+                    shutil.rmtree(job_dir, ignore_errors=True)
+                else:
+                    job_dir.unlink(missing_ok=True)
+                removed += 1
+        return removed
+
+    async def _janitor_loop(self, in_use: Callable[[], set[Path]], interval: float) -> None:
+        while True:
+            try:
+                await asyncio.to_thread(self.sweep, in_use())
+            except Exception as e:
+                logger.error(f"Scratch janitor failed: {e}")
+            await asyncio.sleep(interval)
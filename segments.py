@@ -0,0 +1,239 @@
+import asyncio
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable
+
+from engine import CompressionEngine, JobCancelled, build_ffmpeg_command, run_ffmpeg, stream_arguments
+from probe import probe_duration, run_ffprobe
+from progress import EncodeProgress
+
+
+logger = logging.getLogger(__name__)
+
+# Videos at least this long (in seconds) are encoded in parallel segments
+SEGMENT_MIN_DURATION = float(os.environ.get("SEGMENT_MIN_DURATION", 600))
+# Number of segments, 0 means one per engine worker
+SEGMENT_COUNT = int(os.environ.get("SEGMENT_COUNT", 0))
+# Minimum length of a segment in seconds : closer split points are skipped
+SEGMENT_MIN_LENGTH = 10.0
+# Accepted difference between the input and output durations, as a fraction of the duration
+SEGMENT_DURATION_TOLERANCE = 0.01
+
+
+class SegmentError(RuntimeError):
+    """Raised when a segmented encoding gives an unusable output."""
+
+
+def should_segment(duration: float | None, workers: int) -> bool:
+    return bool(duration) and duration >= SEGMENT_MIN_DURATION and workers > 1
+
+
+async def probe_keyframes(input_path: Path, stream: str = "v:0") -> list[float]:
+    """Timestamps of the keyframes of a video stream, read from the packets without decoding."""
+    info = await run_ffprobe(input_path, "-select_streams", stream,
+                             "-show_entries", "packet=pts_time,flags")
+    return sorted(float(packet["pts_time"]) for packet in info.get("packets", [])
+                  if "K" in packet.get("flags", "") and packet.get("pts_time") not in (None, "N/A"))
+
+
+def pick_split_points(keyframes: list[float], duration: float, count: int) -> list[float]:
+    """
+    Choose the keyframes closest to an even split of the video in `count` parts.
+
+    Returns:
+        list: The split timestamps, in increasing order, without 0.
+    """
+    points = []
+    for i in range(1, count):
+        target = duration * i / count
+        nearest = min(keyframes, key=lambda t: abs(t - target), default=None)
+        previous = points[-1] if points else 0.0
+        if nearest is not None and nearest - previous >= SEGMENT_MIN_LENGTH \
+                and duration - nearest >= SEGMENT_MIN_LENGTH:
+            points.append(nearest)
+    return points
+
+
+def _load_manifest(path: Path) -> dict:
+    """State of a previous run of a resumable segmented encoding, empty if there is none."""
+    try:
+        return json.loads(path.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_manifest(path: Path, manifest: dict) -> None:
+    # Written aside then renamed : a crash never leaves a truncated manifest
+    temporary = path.with_suffix(".tmp")
+    temporary.write_text(json.dumps(manifest))
+    temporary.replace(path)
+
+
+class _CombinedProgress:
+    """Sums the progress of the segments into the progress of the whole video."""
+
+    def __init__(self, total_duration: float, on_progress: Callable[[EncodeProgress], None] | None):
+        self.progress = EncodeProgress(total_duration=total_duration, started_at=time.monotonic())
+        self.on_progress = on_progress
+        self.parts: dict[int, EncodeProgress] = {}
+
+    def part_callback(self, index: int) -> Callable[[EncodeProgress], None]:
+        def update(part: EncodeProgress) -> None:
+            self.parts[index] = part
+            running = [p for p in self.parts.values() if not p.finished]
+            self.progress.out_time = sum(p.out_time for p in self.parts.values())
+            self.progress.frame = sum(p.frame for p in self.parts.values())
+            self.progress.fps = sum(p.fps for p in running)
+            self.progress.speed = sum(p.speed for p in running)
+            if self.on_progress:
+                self.on_progress(self.progress)
+        return update
+
+
+async def compress_segmented(engine: CompressionEngine,
+                             input_path: Path,
+                             output_path: Path,
+                             duration: float,
+                             on_progress: Callable[[EncodeProgress], None] | None = None,
+                             segment_count: int = SEGMENT_COUNT,
+                             work_dir: Path | None = None,
+                             **options) -> tuple[float, float]:
+    """
+    Compress a long video by encoding segments of it in parallel.
+
+    The video stream is cut losslessly at keyframes, each part is encoded by the
+    engine with the same options, then the parts are concatenated without
+    re-encoding and muxed with the audio and subtitles of the original.
+
+    With a `work_dir`, the encoding can be resumed : the split points and the
+    finished parts are recorded there, and a new call after an interruption
+    only encodes the missing parts.
+
+    Args:
+        engine (CompressionEngine): Engine running the segment encodings.
+        input_path (Path): Path to original video.
+        output_path (Path): Path to save compressed video.
+        duration (float): Duration of the original video, in seconds.
+        on_progress (Callable): Called with the progress of the whole video.
+        segment_count (int): Number of segments, one per engine worker if 0.
+        work_dir (Path): Directory kept between runs to resume the encoding, temporary if None.
+        **options: Encoding options accepted by `build_ffmpeg_command`.
+
+    Returns:
+        tuple: (compressed_file_size_MB, compression_duration_sec)
+
+    Raises:
+        SegmentError: If the video cannot be split or the output does not match the input.
+        RuntimeError: If FFmpeg fails.
+    """
+    start_time = time.time()
+    plan = options.pop("plan", None)
+    if plan is not None and plan.video is None:
+        raise SegmentError("No video stream to split")
+    # The video stream the plan encodes, which is not always the first one
+    video_stream = str(plan.video.index) if plan is not None else "v:0"
+    resumable = work_dir is not None
+    if resumable:
+        work_dir.mkdir(parents=True, exist_ok=True)
+    else:
+        work_dir = Path(tempfile.mkdtemp(prefix=".segments_", dir=output_path.parent))
+    manifest_path = work_dir / "segments.json"
+    manifest = _load_manifest(manifest_path)
+    try:
+        split_points = manifest.get("split_points")
+        parts = sorted(work_dir.glob("part_*.mkv"))
+        if split_points and len(parts) == len(split_points) + 1:
+            logger.info(f"Resuming the segmented encoding of {input_path.name}: "
+                        f"{len(manifest.get('encoded', []))}/{len(parts)} parts already encoded")
+        else:
+            count = segment_count or engine.max_workers
+            split_points = pick_split_points(await probe_keyframes(input_path, video_stream), duration, count)
+            if not split_points:
+                raise SegmentError("No keyframe to split the video on")
+            manifest_path.unlink(missing_ok=True)
+            for leftover in work_dir.glob("*.mkv"):
+                leftover.unlink()
+            # Lossless cut of the video stream, each part starts on a keyframe
+            await run_ffmpeg([
+                "ffmpeg", "-loglevel", "error",
+                "-i", str(input_path),
+                "-map", f"0:{video_stream}", "-c", "copy",
+                "-f", "segment",
+                "-segment_times", ",".join(f"{point:.6f}" for point in split_points),
+                "-segment_format", "matroska",
+                "-reset_timestamps", "1",
+                str(work_dir / "part_%03d.mkv")
+            ])
+            parts = sorted(work_dir.glob("part_*.mkv"))
+            manifest = {"split_points": split_points, "encoded": []}
+            _save_manifest(manifest_path, manifest)
+        bounds = [0.0, *split_points, duration]
+
+        # The parts only hold the video stream
+        part_options = {**options, "plan": plan.video_only()} if plan is not None else options
+        combined = _CombinedProgress(duration, on_progress)
+        jobs = []
+
+        async def encode_part(index: int, job) -> None:
+            await job.result()
+            manifest["encoded"].append(index)
+            _save_manifest(manifest_path, manifest)
+
+        for index, part in enumerate(parts):
+            encoded = work_dir / f"encoded_{index:03d}.mkv"
+            part_duration = bounds[index + 1] - bounds[index] if index + 1 < len(bounds) else None
+            if index in manifest["encoded"] and encoded.exists():
+                combined.parts[index] = EncodeProgress(total_duration=part_duration, out_time=part_duration or 0.0,
+                                                       finished=True)
+                continue
+            # Partial output of an encoding killed with the process
+            encoded.unlink(missing_ok=True)
+            jobs.append((index, engine.submit(part, encoded,
+                                              on_progress=combined.part_callback(index),
+                                              command=build_ffmpeg_command(part, encoded, **part_options),
+                                              total_duration=part_duration)))
+        try:
+            await asyncio.gather(*(encode_part(index, job) for index, job in jobs))
+        except BaseException:
+            for _, job in jobs:
+                job.cancel()
+            await asyncio.gather(*(job.task for _, job in jobs), return_exceptions=True)
+            raise
+
+        concat_list = work_dir / "parts.txt"
+        # Paths in the list are relative to the list itself
+        concat_list.write_text("".join(f"file 'encoded_{index:03d}.mkv'\n" for index in range(len(parts))))
+        # Video parts copied as is (the only stream of the concatenation), other streams taken from the original
+        if plan is not None:
+            other_streams = ["-c:0", "copy", *stream_arguments(plan.others, input_index=1, first_output=1)]
+        else:
+            other_streams = ["-map", "1:a?", "-map", "1:s?", "-c:v", "copy"]
+        await run_ffmpeg([
+            "ffmpeg", "-n", "-loglevel", "error",
+            "-f", "concat", "-safe", "0", "-i", str(concat_list),
+            "-i", str(input_path),
+            "-map", "0:0", *other_streams,
+            str(output_path)
+        ])
+    except (JobCancelled, asyncio.CancelledError):
+        # Interrupted : the encoded parts are kept for the next run
+        if not resumable:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+    except BaseException:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    output_duration = await probe_duration(output_path)
+    if output_duration is None or abs(output_duration - duration) > max(1.0, duration * SEGMENT_DURATION_TOLERANCE):
+        output_path.unlink(missing_ok=True)
+        raise SegmentError(f"Segmented output lasts {output_duration}s instead of {duration}s")
+
+    size_mb = output_path.stat().st_size / (1024 * 1024)
+    return round(size_mb, 2), round(time.time() - start_time, 2)
@@ -0,0 +1,215 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import asdict, dataclass, fields, replace
+from pathlib import Path
+from typing import Callable
+
+
+logger = logging.getLogger(__name__)
+
+SETTINGS_DB = os.environ.get("SETTINGS_DB", "compresse_settings.db")
+# Seconds between two write-behind flushes of the modified settings
+SETTINGS_FLUSH_INTERVAL = float(os.environ.get("SETTINGS_FLUSH_INTERVAL", 2))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_settings (
+    user_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+@dataclass(slots=True)
+class UserSettings:
+    """Compression and upload preferences of a user."""
+    upload_type: str = "media"
+    video_format: str = "mp4"
+    compresse_resolution: str = "720:480"
+    prefixe: str = ""
+    suffixe: str = ""
+    thumbnail: str = "Not exist"
+    bitrate: str = "480k"
+    tune: str = "film"
+    # ffmpeg video encoder, or "auto" for the smallest output the CPU budget allows
+    vcodec: str = "libx264"
+    # Size the output must not exceed (e.g. "50MB"), the bitrate is derived from it ; "off" to use the bitrate
+    target_size: str = "off"
+    # Ladder mode : "resolution@bitrate" pairs separated by commas, empty for a single output
+    renditions: str = ""
+    # Encode samples and show an estimate before queuing the job
+    preview: bool = False
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "UserSettings":
+        """Build settings from a stored dict, ignoring unknown keys and keeping defaults for missing ones."""
+        return cls(**{name: data[name] for name in SETTING_NAMES if name in data})
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    def copy(self) -> "UserSettings":
+        return replace(self)
+
+
+SETTING_NAMES = frozenset(field.name for field in fields(UserSettings))
+
+
+class SettingsStore:
+    """
+    In-memory cache of the users settings, persisted to SQLite (WAL mode).
+
+    Reads never touch the disk. Changes are only marked dirty and written in a
+    single transaction by a periodic write-behind flush, so a button press
+    costs no I/O and handlers running concurrently cannot overwrite each other.
+    """
+
+    def __init__(self, path: str = SETTINGS_DB, legacy_json: str | None = None,
+                 flush_interval: float = SETTINGS_FLUSH_INTERVAL,
+                 on_flush: Callable[[int, float], None] | None = None):
+        self.path = path
+        self.flush_interval = flush_interval
+        # Called with the number of users written and the duration of the write
+        self.on_flush = on_flush
+        self._cache: dict[str, UserSettings] = {}
+        self._dirty: set[str] = set()
+        self._lock = threading.Lock()
+        self._flush_task: asyncio.Task | None = None
+
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._load(legacy_json)
+
+    def _load(self, legacy_json: str | None) -> None:
+        imported = self._db.execute("SELECT value FROM meta WHERE key = 'legacy_imported'").fetchone()
+        if not imported and legacy_json and os.path.exists(legacy_json):
+            self._import_legacy(Path(legacy_json))
+
+        for user_id, data in self._db.execute("SELECT user_id, data FROM user_settings"):
+            self._cache[user_id] = UserSettings.from_dict(json.loads(data))
+
+    def _import_legacy(self, legacy_json: Path) -> None:
+        """Copy the users of the former JSON data file, once, on first start."""
+        content = legacy_json.read_text()
+        users = json.loads(content) if content.strip() else {}
+        with self._lock:
+            self._db.execute("BEGIN")
+            self._db.executemany("INSERT OR REPLACE INTO user_settings (user_id, data) VALUES (?, ?)",
+                                 [(user_id, self._dump(UserSettings.from_dict(data)))
+                                  for user_id, data in users.items()])
+            self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('legacy_imported', ?)",
+                             (str(legacy_json),))
+            self._db.execute("COMMIT")
+        logger.warning(f"Imported {len(users)} user(s) from {legacy_json}")
+
+    @staticmethod
+    def _dump(settings: UserSettings) -> str:
+        return json.dumps(settings.to_dict(), separators=(",", ":"))
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._cache
+
+    def get(self, user_id: str) -> UserSettings:
+        """Settings of a user, created with the default values if the user is new."""
+        settings = self._cache.get(user_id)
+        if settings is None:
+            settings = self._cache[user_id] = UserSettings()
+            self._dirty.add(user_id)
+        return settings
+
+    def update(self, user_id: str, **values) -> UserSettings:
+        """
+        Change some settings of a user.
+
+        Raises:
+            KeyError: If a value does not match a known setting.
+        """
+        unknown = values.keys() - SETTING_NAMES
+        if unknown:
+            raise KeyError(f"Unknown setting(s): {', '.join(sorted(unknown))}")
+        settings = self.get(user_id)
+        for name, value in values.items():
+            setattr(settings, name, value)
+        self._dirty.add(user_id)
+        return settings
+
+    def reset(self, user_id: str) -> UserSettings:
+        settings = self._cache[user_id] = UserSettings()
+        self._dirty.add(user_id)
+        return settings
+
+    def _take_dirty(self) -> tuple[set[str], list[tuple[str, str]]]:
+        dirty, self._dirty = self._dirty, set()
+        return dirty, [(user_id, self._dump(self._cache[user_id])) for user_id in dirty]
+
+    def _write(self, rows: list[tuple[str, str]]) -> None:
+        with self._lock:
+            try:
+                self._db.execute("BEGIN")
+                self._db.executemany("INSERT OR REPLACE INTO user_settings (user_id, data) VALUES (?, ?)", rows)
+                self._db.execute("COMMIT")
+            except Exception:
+                if self._db.in_transaction:
+                    self._db.execute("ROLLBACK")
+                raise
+
+    def flush(self) -> int:
+        """
+        Write the modified settings to the database in one transaction.
+
+        Returns:
+            int: Number of users written.
+        """
+        dirty, rows = self._take_dirty()
+        if not rows:
+            return 0
+        start = time.perf_counter()
+        try:
+            self._write(rows)
+        except Exception:
+            self._dirty |= dirty
+            raise
+        self._flushed(len(rows), time.perf_counter() - start)
+        return len(rows)
+
+    def _flushed(self, count: int, duration: float) -> None:
+        if self.on_flush:
+            self.on_flush(count, duration)
+
+    def start(self) -> None:
+        """Start the periodic write-behind flush."""
+        self._flush_task = asyncio.create_task(self._flush_loop(), name="settings-flush")
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            # Rows are serialized in the loop thread, only the disk write goes to a thread
+            dirty, rows = self._take_dirty()
+            if not rows:
+                continue
+            start = time.perf_counter()
+            try:
+                await asyncio.to_thread(self._write, rows)
+            except Exception as e:
+                logger.error(f"Settings flush failed: {e}")
+                self._dirty |= dirty
+            else:
+                self._flushed(len(rows), time.perf_counter() - start)
+
+    async def close(self) -> None:
+        """Stop the periodic flush and write what is left."""
+        if self._flush_task:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        self.flush()
+        self._db.close()
@@ -0,0 +1,257 @@
+import asyncio
+import logging
+import os
+import struct
+from pathlib import Path
+from typing import Callable
+
+import httpx
+
+from engine import PIPE_INPUT, CompressionEngine, build_ffmpeg_command
+from probe import EncodePlan, plan_encode, probe_media
+from progress import EncodeProgress
+from thumbnails import add_cover_output
+
+
+logger = logging.getLogger(__name__)
+
+# Encode the videos downloaded from a remote Bot API server while they are still being transferred
+STREAM_ENCODE = os.environ.get("STREAM_ENCODE", "1") == "1"
+# Bytes read from the start of a download to tell whether its container can be read as it arrives
+STREAM_SNIFF_BYTES = int(os.environ.get("STREAM_SNIFF_BYTES", 1024 * 1024))
+# Bytes on disk before the partial input is probed for its streams
+STREAM_PROBE_BYTES = 8 * 1024 * 1024
+# Bytes read from the network or written to ffmpeg at a time
+CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_TIMEOUT = httpx.Timeout(30.0, read=120.0)
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+EBML_MAGIC = b"\x1a\x45\xdf\xa3"
+# Top-level boxes found before the media of an ISO BMFF file (MP4, MOV)
+BMFF_BOXES = {b"ftyp", b"free", b"skip", b"wide", b"pdin", b"uuid", b"styp", b"sidx", b"moov", b"mdat", b"moof"}
+
+
+class StreamError(RuntimeError):
+    """Raised when a video cannot be encoded while it is downloaded."""
+
+
+def is_streamable(head: bytes) -> bool | None:
+    """
+    Tell from the first bytes of a file whether ffmpeg can read it sequentially, as it arrives.
+
+    MPEG-TS and Matroska/WebM always can. MP4/MOV only when the index (`moov`)
+    comes before the media (`mdat`), as in "faststart" files.
+
+    Returns:
+        bool | None: None while `head` is too short to tell.
+    """
+    if head[:1] == bytes([TS_SYNC_BYTE]):
+        if len(head) < 3 * TS_PACKET_SIZE:
+            return None
+        if all(head[i * TS_PACKET_SIZE] == TS_SYNC_BYTE for i in range(3)):
+            return True
+    if head[:4] == EBML_MAGIC:
+        return True
+
+    offset = 0
+    while offset + 8 <= len(head):
+        size, kind = struct.unpack(">I4s", head[offset:offset + 8])
+        if kind not in BMFF_BOXES:
+            return False
+        # Fragmented MP4 : every fragment carries its own index
+        if kind in (b"moov", b"moof"):
+            return True
+        if kind == b"mdat":
+            return False
+        if size == 1:
+            if offset + 16 > len(head):
+                return None
+            size = struct.unpack(">Q", head[offset + 8:offset + 16])[0]
+        if size < 8:
+            # Box running to the end of the file, or corrupted
+            return False
+        offset += size
+    return None
+
+
+class StreamingDownload:
+    """
+    Download of a remote Telegram file, readable while it is written.
+
+    The bytes go to `<path>.part`, renamed to `path` once complete : a download
+    interrupted by a restart never looks like a finished input. `feed` tails
+    the growing file into ffmpeg, so the encoding follows the transfer.
+    """
+
+    def __init__(self, url: str, path: Path, total_size: int | None = None, duration: float | None = None):
+        self.url = url
+        self.path = path
+        self.part_path = path.with_name(path.name + ".part")
+        self.total_size = total_size
+        # Duration announced by Telegram, the partial file does not always tell it
+        self.duration = duration
+        self.written = 0
+        self.streamable: bool | None = None
+        self.finished = False
+        self.error: BaseException | None = None
+        self.task: asyncio.Task | None = None
+        self._head = bytearray()
+        self._changed = asyncio.Condition()
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self._download(), name=f"download-{self.path.name}")
+
+    def cancel(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+
+    async def wait_streamable(self) -> bool:
+        """True once the container is known to be streamable while the download still goes on."""
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.streamable is not None or self.finished)
+        return bool(self.streamable) and not self.finished
+
+    async def wait_for_bytes(self, count: int) -> None:
+        """Wait until `count` bytes are on disk, or the end of the download."""
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.written >= count or self.finished)
+
+    async def wait(self) -> Path:
+        """
+        Wait for the end of the download.
+
+        Raises:
+            RuntimeError: If the download failed or was stopped.
+        """
+        await asyncio.wait([self.task])
+        if self.error is not None:
+            raise RuntimeError(f"Download of {self.path.name} failed: {self.error!r}") from self.error
+        return self.path
+
+    async def feed(self, writer: asyncio.StreamWriter) -> None:
+        """
+        Write the file to `writer` as it is downloaded, until its end.
+
+        Raises:
+            RuntimeError: If the download fails before the end.
+        """
+        sent = 0
+        with self._open() as source:
+            while True:
+                chunk = source.read(CHUNK_SIZE)
+                if chunk:
+                    sent += len(chunk)
+                    writer.write(chunk)
+                    await writer.drain()
+                    continue
+                if self.finished:
+                    if self.error is not None:
+                        raise RuntimeError(f"Download of {self.path.name} failed: {self.error!r}")
+                    return
+                async with self._changed:
+                    await self._changed.wait_for(lambda: self.written > sent or self.finished)
+
+    def _open(self):
+        try:
+            return open(self.part_path, "rb")
+        except FileNotFoundError:
+            # Already complete and renamed
+            return open(self.path, "rb")
+
+    async def _download(self) -> None:
+        try:
+            async with httpx.AsyncClient(timeout=DOWNLOAD_TIMEOUT) as client:
+                async with client.stream("GET", self.url) as response:
+                    response.raise_for_status()
+                    with open(self.part_path, "wb") as output:
+                        async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                            output.write(chunk)
+                            # Visible to the readers of the file before they are told
+                            output.flush()
+                            self.written += len(chunk)
+                            if self.streamable is None:
+                                self._sniff(chunk)
+                            async with self._changed:
+                                self._changed.notify_all()
+            os.replace(self.part_path, self.path)
+        except BaseException as e:
+            self.error = e
+            self.part_path.unlink(missing_ok=True)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            logger.warning(f"Download of {self.path.name} failed: {e!r}")
+        finally:
+            self.finished = True
+            if self.streamable is None:
+                self.streamable = False
+            async with self._changed:
+                self._changed.notify_all()
+
+    def _sniff(self, chunk: bytes) -> None:
+        self._head += chunk[:STREAM_SNIFF_BYTES - len(self._head)]
+        self.streamable = is_streamable(bytes(self._head))
+        if self.streamable is None and len(self._head) >= STREAM_SNIFF_BYTES:
+            self.streamable = False
+        if self.streamable is not None:
+            logger.info(f"{self.path.name} {'can' if self.streamable else 'cannot'} be encoded while downloaded")
+            self._head = bytearray()
+
+
+async def compress_streaming(engine: CompressionEngine,
+                             download: StreamingDownload,
+                             output_path: Path,
+                             on_progress: Callable[[EncodeProgress], None] | None = None,
+                             cover: Path | None = None,
+                             **options) -> tuple[float, float]:
+    """
+    Compress a video while it is downloaded, ffmpeg reading it from a pipe fed with the growing file.
+
+    The streams are planned from a probe of the first bytes of the file. The
+    encoding is a single pass : segments need to seek through the whole input.
+
+    Args:
+        engine (CompressionEngine): Engine running the encoding.
+        download (StreamingDownload): Download of the original video, started and streamable.
+        output_path (Path): Path to save compressed video.
+        on_progress (Callable): Called with the encoding progress.
+        cover (Path): Where to write the cover frame, if wanted.
+        **options: Encoding options, see `pipeline.encode_options`.
+
+    Returns:
+        tuple: (compressed_file_size_MB, compression_duration_sec)
+
+    Raises:
+        StreamError: If the encoding failed, the caller may encode the complete file instead.
+        JobCancelled: If the job is cancelled.
+    """
+    plan: EncodePlan | None = None
+    duration = download.duration
+    await download.wait_for_bytes(STREAM_PROBE_BYTES)
+    if download.error is not None:
+        raise StreamError(f"Download of {download.path.name} failed: {download.error!r}")
+    try:
+        info = await probe_media(download.part_path if download.part_path.exists() else download.path)
+        duration = duration or info.duration
+        plan = plan_encode(info, video_format=output_path.suffix.lstrip(".").lower(),
+                           resolution=options["resolution"], bitrate=options["bitrate"], vcodec=options["vcodec"])
+        logger.info(f"Encode plan of {download.path.name} (streaming): {plan}")
+    except (OSError, RuntimeError, KeyError, ValueError) as e:
+        logger.warning(f"Cannot probe the start of {download.path.name}, every stream re-encoded: {e}")
+
+    command = build_ffmpeg_command(Path(PIPE_INPUT), output_path, plan=plan, **options)
+    extra_outputs = None
+    if cover is not None:
+        command = add_cover_output(command, plan, cover, duration)
+        extra_outputs = [cover]
+    job = engine.submit(download.path, output_path,
+                        on_progress=on_progress,
+                        command=command,
+                        total_duration=duration or 0.0,
+                        extra_outputs=extra_outputs,
+                        feed_input=download.feed)
+    try:
+        return await job.result()
+    except RuntimeError as e:
+        output_path.unlink(missing_ok=True)
+        raise StreamError(f"Streaming compression of {download.path.name} failed: {e}") from e
@@ -0,0 +1,101 @@
+import os
+from dataclasses import dataclass
+
+from probe import EncodePlan, MediaInfo
+
+
+# Setting value of the target size mode when it is off
+TARGET_SIZE_OFF = "off"
+# Relative margin kept under the target : the encoders only hit a bitrate on average
+TARGET_SIZE_TOLERANCE = float(os.environ.get("TARGET_SIZE_TOLERANCE", 0.05))
+# Encode in two passes in target size mode, with the encoders supporting it (capped VBV otherwise)
+TARGET_TWO_PASS = os.environ.get("TARGET_TWO_PASS", "0") == "1"
+# Encodings of a video tried to get under its target size, each one with a corrected bitrate
+TARGET_SIZE_ATTEMPTS = int(os.environ.get("TARGET_SIZE_ATTEMPTS", 2))
+# Share of the file taken by the container (headers, index, interleaving)
+MUXING_OVERHEAD = 0.02
+# Below this video bitrate, the target size is not reachable with a watchable video
+MIN_VIDEO_BITRATE = 32_000
+# Bitrate of the audio encoders of probe.CONTAINER_AUDIO_ENCODERS, ffmpeg defaults
+AUDIO_ENCODER_BITRATES = {"aac": 128_000, "libopus": 96_000, "libmp3lame": 128_000}
+# Assumed for a copied audio track whose bitrate ffprobe does not tell
+DEFAULT_AUDIO_BITRATE = 128_000
+
+
+class TargetSizeError(RuntimeError):
+    """Raised when a video cannot be brought under its target size."""
+
+
+def parse_size(value: str) -> int | None:
+    """Bytes of a target size setting such as "50MB", None when the mode is off."""
+    if not value or value == TARGET_SIZE_OFF:
+        return None
+    return int(float(value.upper().removesuffix("MB")) * 1024 * 1024)
+
+
+def audio_bitrate(info: MediaInfo, plan: EncodePlan | None) -> int:
+    """Bits per second of the audio tracks of the output, copied or re-encoded as planned."""
+    if plan is None:
+        return sum(stream.bit_rate or DEFAULT_AUDIO_BITRATE for stream in info.streams if stream.codec_type == "audio")
+    streams = {stream.index: stream for stream in info.streams}
+    total = 0
+    for stream_plan in plan.others:
+        if stream_plan.codec_type != "audio":
+            continue
+        if stream_plan.codec == "copy":
+            total += streams[stream_plan.index].bit_rate or DEFAULT_AUDIO_BITRATE
+        else:
+            total += AUDIO_ENCODER_BITRATES.get(stream_plan.codec, DEFAULT_AUDIO_BITRATE)
+    return total
+
+
+@dataclass(frozen=True)
+class SizeTarget:
+    """Size an output must not exceed, and the video bitrate aimed at to get there."""
+    max_bytes: int
+    duration: float
+    audio_bitrate: int
+    video_bitrate: int
+
+    @property
+    def aimed_bytes(self) -> float:
+        return self.max_bytes * (1 - TARGET_SIZE_TOLERANCE)
+
+    def fits(self, size: int) -> bool:
+        return size <= self.max_bytes
+
+    def corrected_bitrate(self, bitrate: int, size: int) -> int:
+        """
+        Video bitrate of a new attempt, after an encoding at `bitrate` gave `size` bytes.
+
+        Raises:
+            TargetSizeError: If the correction falls under MIN_VIDEO_BITRATE.
+        """
+        audio_bytes = self.audio_bitrate * self.duration / 8
+        video_bytes = max(1.0, size - audio_bytes)
+        return _checked_bitrate(int(bitrate * (self.aimed_bytes - audio_bytes) / video_bytes), self.max_bytes)
+
+
+def _checked_bitrate(bitrate: int, max_bytes: int) -> int:
+    if bitrate < MIN_VIDEO_BITRATE:
+        raise TargetSizeError(f"{max_bytes / (1024 * 1024):.1f}MB leaves less than "
+                              f"{MIN_VIDEO_BITRATE // 1000}k for the video")
+    return bitrate
+
+
+def size_target(info: MediaInfo, plan: EncodePlan | None, target_bytes: int) -> SizeTarget:
+    """
+    Video bitrate bringing a video under `target_bytes`, from its probed duration
+    and the bitrate of its audio tracks. The target is lowered to the size of the
+    input : the output is never larger than the original.
+
+    Raises:
+        TargetSizeError: If the duration is unknown or the target too small.
+    """
+    if not info.duration:
+        raise TargetSizeError("Unknown duration, no bitrate can be derived from the target size")
+    max_bytes = min(target_bytes, info.size) if info.size else target_bytes
+    audio = audio_bitrate(info, plan)
+    aimed_bits = max_bytes * (1 - TARGET_SIZE_TOLERANCE) * (1 - MUXING_OVERHEAD) * 8
+    video = _checked_bitrate(int(aimed_bits / info.duration - audio), max_bytes)
+    return SizeTarget(max_bytes=max_bytes, duration=info.duration, audio_bitrate=audio, video_bitrate=video)
@@ -0,0 +1,54 @@
+import pytest
+
+from compression_queue import RUNNING, CompressionQueue
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = CompressionQueue(str(tmp_path / "jobs.db"))
+    yield queue
+    queue.close()
+
+
+def claim_all(queue: CompressionQueue) -> list[int]:
+    claimed = []
+    while (job := queue.claim_next()) is not None:
+        claimed.append(job.job_id)
+        queue.finish(job.job_id)
+    return claimed
+
+
+def test_claim_round_robin_between_users(queue):
+    a1, a2, a3 = (queue.enqueue("a", 1, {}).job_id for _ in range(3))
+    b1, b2 = (queue.enqueue("b", 2, {}).job_id for _ in range(2))
+    assert claim_all(queue) == [a1, b1, a2, b2, a3]
+
+
+def test_claim_priority_tiers_first(queue):
+    normal = queue.enqueue("a", 1, {}).job_id
+    urgent = queue.enqueue("b", 2, {}, priority=1).job_id
+    assert claim_all(queue) == [urgent, normal]
+
+
+def test_claim_per_user_cap(queue):
+    first = queue.enqueue("a", 1, {}).job_id
+    queue.enqueue("a", 1, {})
+    other = queue.enqueue("b", 2, {}).job_id
+    assert queue.claim_next().job_id == first
+    # "a" already has its running job
+    assert queue.claim_next().job_id == other
+    assert queue.claim_next() is None
+    assert queue.get(first).status == RUNNING
+
+
+def test_claim_skips_held_jobs(queue):
+    held = queue.enqueue("a", 1, {}, hold=True).job_id
+    assert queue.claim_next() is None
+    assert queue.confirm(held)
+    assert queue.claim_next().job_id == held
+
+
+def test_pending_order_predicts_claims(queue):
+    for user in "aab":
+        queue.enqueue(user, 1, {})
+    assert queue.pending_order() == claim_all(queue)
@@ -0,0 +1,8 @@
+from encoders import scaled_bitrate
+
+
+def test_scaled_bitrate():
+    assert scaled_bitrate("1000k", "libx264") == "1000k"
+    assert scaled_bitrate("1000k", "libx265") == "600k"
+    # Unknown encoders use the x264 flags, and its bitrates
+    assert scaled_bitrate("2M", "unknown") == "2000k"
@@ -0,0 +1,83 @@
+from pathlib import Path
+
+from engine import CpuBudget, build_ffmpeg_command, with_threads
+from probe import MediaInfo, StreamInfo, fit_resolution, plan_encode
+
+SCALE_720P = "scale=1280:720:force_original_aspect_ratio=decrease:force_divisible_by=2"
+
+
+def media(*streams: StreamInfo, size: int = 10_000_000, duration: float = 60.0) -> MediaInfo:
+    return MediaInfo(format_names=("mov", "mp4"), duration=duration, size=size, bit_rate=None, streams=streams)
+
+
+def test_fit_resolution():
+    assert fit_resolution(StreamInfo(0, "video", "h264", 1920, 1080), "1280:720") == SCALE_720P
+    # Never upscaled
+    assert fit_resolution(StreamInfo(0, "video", "h264", 640, 360), "1280:720") is None
+    # Portrait videos fit in the turned box
+    assert fit_resolution(StreamInfo(0, "video", "h264", 720, 1280), "1280:720") is None
+    assert fit_resolution(StreamInfo(0, "video", "h264", 1920, 1080, rotation=90), "1280:720") == (
+        "scale=720:1280:force_original_aspect_ratio=decrease:force_divisible_by=2")
+
+
+def test_plan_encode_streams():
+    info = media(StreamInfo(0, "video", "h264", 1920, 1080, bit_rate=4_000_000),
+                 StreamInfo(1, "audio", "aac", bit_rate=128_000),
+                 StreamInfo(2, "audio", "flac"),
+                 StreamInfo(3, "subtitle", "subrip"),
+                 StreamInfo(4, "subtitle", "hdmv_pgs_subtitle"))
+    plan = plan_encode(info, "mp4", "1280:720", "480k")
+    assert plan.video.codec == "libx264"
+    assert plan.scale == SCALE_720P
+    assert [(stream.index, stream.codec) for stream in plan.others] == [(1, "copy"), (2, "aac"), (3, "mov_text")]
+    assert not plan.remux_only
+
+
+def test_plan_encode_copies_a_small_video():
+    info = media(StreamInfo(0, "video", "h264", 640, 360, bit_rate=300_000),
+                 StreamInfo(1, "audio", "aac", bit_rate=96_000))
+    assert plan_encode(info, "mp4", "1280:720", "480k").remux_only
+
+
+def test_plan_encode_skips_cover_pictures():
+    info = media(StreamInfo(0, "video", "mjpeg", 320, 320, attached_pic=True),
+                 StreamInfo(1, "video", "h264", 1920, 1080))
+    assert plan_encode(info, "mkv", "1280:720", "480k").video.index == 1
+
+
+def test_build_ffmpeg_command_with_plan():
+    plan = plan_encode(media(StreamInfo(0, "video", "h264", 1920, 1080), StreamInfo(1, "audio", "aac")),
+                       "mp4", "1280:720", "480k")
+    command = build_ffmpeg_command(Path("in.mkv"), Path("out.mp4"), bitrate="480k", tune="film",
+                                   preset="fast", plan=plan)
+    assert command[:6] == ["ffmpeg", "-n", "-loglevel", "error", "-i", "in.mkv"]
+    assert command[-1] == "out.mp4"
+    assert ["-c:v:0", "libx264", "-b:v:0", "480k"] == command[command.index("-c:v:0"):command.index("-c:v:0") + 4]
+    assert command[command.index("-vf") + 1] == SCALE_720P
+    assert ["-map", "0:1", "-c:1", "copy"] == command[command.index("0:1") - 1:command.index("0:1") + 3]
+
+
+def test_build_ffmpeg_command_maps_the_encoder_options():
+    command = build_ffmpeg_command(Path("in.mkv"), Path("out.mp4"), vcodec="libvpx-vp9", tune="film", preset="fast")
+    assert "-tune:v" not in command
+    assert command[command.index("-cpu-used:v") + 1] == "3"
+
+
+def test_with_threads_splits_between_outputs():
+    command = ["ffmpeg", "-i", "in.mkv", "-frames:v", "1", "cover.jpeg", "-c:v", "libx264", "out.mp4"]
+    assert with_threads(command, 4, [Path("cover.jpeg")]) == [
+        "ffmpeg", "-filter_threads", "4", "-i", "in.mkv", "-frames:v", "1", "-threads", "2", "cover.jpeg",
+        "-c:v", "libx264", "-threads", "2", "out.mp4"]
+
+
+def test_with_threads_keeps_explicit_threads():
+    command = ["ffmpeg", "-i", "in.mkv", "-threads", "1", "out.mp4"]
+    assert with_threads(command, 4) == command
+
+
+def test_cpu_budget_threads_never_exceed_the_budget():
+    budget = CpuBudget(budget=0, pin=False)
+    budget.cpus = list(range(8))
+    assert budget.threads(1) == 8
+    assert budget.threads(3) * 3 <= 8
+    assert budget.threads(16) == 1
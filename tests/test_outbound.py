@@ -0,0 +1,29 @@
+import pytest
+
+from outbound import TokenBucket
+
+
+def test_token_bucket_burst_then_rate():
+    bucket = TokenBucket(rate=2.0, capacity=3)
+    now = bucket.updated
+    for _ in range(3):
+        assert bucket.delay(now) == 0
+        bucket.take(now)
+    assert bucket.delay(now) == pytest.approx(0.5)
+    assert bucket.delay(now + 0.5) == pytest.approx(0.0)
+
+
+def test_token_bucket_refill_is_capped():
+    bucket = TokenBucket(rate=1.0, capacity=2)
+    now = bucket.updated
+    bucket.take(now)
+    bucket.take(now)
+    bucket.delay(now + 100)
+    assert bucket.tokens == 2
+
+
+def test_token_bucket_blocked():
+    bucket = TokenBucket(rate=10.0, capacity=5)
+    bucket.block(30)
+    assert bucket.tokens == 0
+    assert bucket.delay(bucket.updated) > 29
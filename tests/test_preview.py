@@ -0,0 +1,34 @@
+from collections import deque
+
+import pytest
+
+from preview import ESTIMATE_MIN_HISTORY, EstimateModel, sample_windows, windowed
+
+
+def test_sample_windows_spread_over_the_video():
+    assert sample_windows(120.0, count=3, length=4.0) == [(18.0, 4.0), (58.0, 4.0), (98.0, 4.0)]
+
+
+def test_sample_windows_whole_short_video():
+    assert sample_windows(10.0, count=3, length=4.0) == [(0.0, 10.0)]
+
+
+def test_windowed_seeks_before_the_input():
+    command = ["ffmpeg", "-n", "-i", "in.mp4", "-c:v", "libx264", "out.mp4"]
+    assert windowed(command, 12.5, 4.0) == ["ffmpeg", "-n", "-ss", "12.500", "-t", "4.000",
+                                            "-i", "in.mp4", "-c:v", "libx264", "out.mp4"]
+
+
+def test_fit_needs_history():
+    pairs = deque([(1.0, 2.0)] * (ESTIMATE_MIN_HISTORY - 1))
+    assert EstimateModel._fit(pairs) == 1.0
+
+
+def test_fit_slope_through_origin():
+    pairs = deque([(1.0, 2.0), (2.0, 4.0), (4.0, 8.0)])
+    assert EstimateModel._fit(pairs) == pytest.approx(2.0)
+
+
+def test_fit_is_clamped():
+    assert EstimateModel._fit(deque([(1.0, 100.0)] * 3)) == 4.0
+    assert EstimateModel._fit(deque([(100.0, 1.0)] * 3)) == 0.25
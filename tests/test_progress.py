@@ -0,0 +1,44 @@
+import pytest
+
+from progress import EncodeProgress, ProgressParser
+
+
+def feed(parser: ProgressParser, text: str) -> list[bool]:
+    return [parser.feed(line) for line in text.strip().splitlines()]
+
+
+def test_progress_block():
+    progress = EncodeProgress(total_duration=20.0)
+    parser = ProgressParser(progress)
+    completed = feed(parser, """
+        frame=250
+        fps=50.5
+        out_time_us=10000000
+        speed=2.02x
+        progress=continue
+    """)
+    assert completed == [False, False, False, False, True]
+    assert (progress.frame, progress.fps, progress.out_time, progress.speed) == (250, 50.5, 10.0, 2.02)
+    assert progress.percent == 50.0
+    assert progress.eta == pytest.approx(10.0 / 2.02)
+    assert not progress.finished
+
+
+def test_progress_end_and_unknown_values():
+    progress = EncodeProgress(frame=10, speed=1.5)
+    parser = ProgressParser(progress)
+    feed(parser, """
+        frame=N/A
+        out_time_us=N/A
+        speed=N/A
+        progress=end
+    """)
+    # Values ffmpeg does not know yet keep the last ones
+    assert (progress.frame, progress.out_time, progress.speed) == (10, 0.0, 1.5)
+    assert progress.finished
+    assert progress.percent is None
+
+
+def test_progress_blank_lines_ignored():
+    parser = ProgressParser(EncodeProgress())
+    assert feed(parser, "\n\nframe=1\n") == [False]
@@ -0,0 +1,60 @@
+import asyncio
+import shutil
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from engine import CompressionEngine
+from probe import probe_duration, probe_media, plan_encode
+from segments import compress_segmented, pick_split_points
+
+
+# Accepted difference between the segmented and single pass output sizes, as a fraction of the single pass one
+SEGMENT_SIZE_TOLERANCE = 0.1
+
+needs_ffmpeg = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg not installed")
+
+
+def test_split_points_snap_to_keyframes():
+    keyframes = [0.0, 9.0, 12.0, 19.5, 21.0, 30.0, 41.0]
+    assert pick_split_points(keyframes, 45.0, 3) == [12.0, 30.0]
+
+
+def test_split_points_skip_short_segments():
+    assert pick_split_points([0.0, 2.0, 4.0], 6.0, 3) == []
+
+
+@pytest.fixture(scope="module")
+def audio_first_clip(tmp_path_factory) -> Path:
+    """30s clip whose video is the second stream, with a keyframe every 2 seconds."""
+    path = tmp_path_factory.mktemp("segments") / "clip.mkv"
+    subprocess.run(["ffmpeg", "-loglevel", "error",
+                    "-f", "lavfi", "-i", "sine=frequency=440:duration=30",
+                    "-f", "lavfi", "-i", "testsrc2=size=640x360:rate=25:duration=30",
+                    "-map", "0:a", "-map", "1:v", "-c:a", "aac", "-c:v", "libx264", "-g", "50",
+                    "-preset", "ultrafast", str(path)], check=True)
+    return path
+
+
+@needs_ffmpeg
+def test_segmented_output_matches_single_pass(audio_first_clip, tmp_path):
+    async def encode() -> tuple[int, int, float]:
+        info = await probe_media(audio_first_clip)
+        plan = plan_encode(info, "mp4", "640:360", "300k")
+        assert plan.video.index == 1
+        options = {"vcodec": "libx264", "resolution": "640:360", "bitrate": "300k", "preset": "ultrafast",
+                   "plan": plan}
+        engine = CompressionEngine(max_workers=2)
+        try:
+            single, segmented = tmp_path / "single.mp4", tmp_path / "segmented.mp4"
+            await engine.compress(audio_first_clip, single, total_duration=info.duration, **options)
+            await compress_segmented(engine, audio_first_clip, segmented, info.duration, segment_count=2,
+                                     **options)
+        finally:
+            await engine.shutdown()
+        return single.stat().st_size, segmented.stat().st_size, await probe_duration(segmented)
+
+    single_size, segmented_size, segmented_duration = asyncio.run(encode())
+    assert abs(segmented_size - single_size) <= single_size * SEGMENT_SIZE_TOLERANCE
+    assert segmented_duration == pytest.approx(30.0, abs=1.0)
@@ -0,0 +1,17 @@
+from settings_store import UserSettings
+
+
+def test_from_dict_keeps_defaults_for_missing_keys():
+    settings = UserSettings.from_dict({"bitrate": "800k", "preview": True})
+    assert settings.bitrate == "800k"
+    assert settings.preview is True
+    assert settings.vcodec == UserSettings().vcodec
+
+
+def test_from_dict_ignores_unknown_keys():
+    assert UserSettings.from_dict({"removed_setting": 1, "tune": "grain"}) == UserSettings(tune="grain")
+
+
+def test_from_dict_round_trip():
+    settings = UserSettings(video_format="mkv", target_size="50MB", renditions="1280:720@900k")
+    assert UserSettings.from_dict(settings.to_dict()) == settings
@@ -0,0 +1,29 @@
+import pytest
+
+from target_size import (MIN_VIDEO_BITRATE, TARGET_SIZE_OFF, TARGET_SIZE_TOLERANCE, SizeTarget, TargetSizeError,
+                         parse_size)
+
+MB = 1024 * 1024
+
+
+def test_parse_size():
+    assert parse_size("50MB") == 50 * MB
+    assert parse_size("8.5mb") == int(8.5 * MB)
+    assert parse_size(TARGET_SIZE_OFF) is None
+    assert parse_size("") is None
+
+
+def test_corrected_bitrate_scales_the_video_part():
+    target = SizeTarget(max_bytes=10 * MB, duration=100.0, audio_bitrate=128_000, video_bitrate=600_000)
+    audio_bytes = 128_000 * 100 / 8
+    # An output 20% above the aimed size gets a bitrate 20% lower on its video part
+    size = int(audio_bytes + (target.aimed_bytes - audio_bytes) * 1.2)
+    assert target.corrected_bitrate(600_000, size) == pytest.approx(500_000, rel=0.001)
+    assert target.aimed_bytes == pytest.approx(10 * MB * (1 - TARGET_SIZE_TOLERANCE))
+
+
+def test_corrected_bitrate_too_low():
+    target = SizeTarget(max_bytes=MB, duration=100.0, audio_bitrate=0, video_bitrate=MIN_VIDEO_BITRATE)
+    with pytest.raises(TargetSizeError):
+        target.corrected_bitrate(MIN_VIDEO_BITRATE, 10 * MB)
+
@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import os
+import weakref
+from pathlib import Path
+
+from engine import run_ffmpeg
+from probe import EncodePlan, probe_media
+
+
+logger = logging.getLogger(__name__)
+
+# Telegram ignores the thumbnails larger than that
+THUMBNAIL_SIZE = 320
+THUMBNAIL_MAX_BYTES = 200 * 1024
+# JPEG qualities tried in turn (ffmpeg -q:v, lower is better) until the thumbnail is small enough
+JPEG_QUALITIES = (2, 5, 10, 20, 31)
+# Frames compared by the `thumbnail` filter to choose the cover of a video, spread over its duration
+COVER_CANDIDATES = int(os.environ.get("COVER_CANDIDATES", 50))
+
+# Fits in THUMBNAIL_SIZE without upscaling small images
+SCALE_FILTER = (f"scale=w='min({THUMBNAIL_SIZE},iw)':h='min({THUMBNAIL_SIZE},ih)'"
+                ":force_original_aspect_ratio=decrease")
+
+
+def cover_path(video_path: Path) -> Path:
+    """Where the cover frame of an encoded video is written, next to it."""
+    return video_path.with_suffix(".cover.jpeg")
+
+
+def cover_filter(duration: float | None) -> str:
+    """
+    Filter choosing a representative frame of a video.
+
+    The candidates are sampled evenly over the whole video and downscaled
+    before the `thumbnail` filter keeps the most representative one, so that
+    a black intro is not chosen and only small frames are buffered.
+    """
+    rate = f"{COVER_CANDIDATES}/{duration:.3f}" if duration else "1"
+    return f"fps={rate},{SCALE_FILTER},thumbnail={COVER_CANDIDATES}"
+
+
+def add_cover_output(ffmpeg_cmd: list[str], plan: EncodePlan | None, cover: Path,
+                     duration: float | None) -> list[str]:
+    """
+    Add the cover frame as an output of an encoding command.
+
+    The frame is taken from the frames decoded for the encoding itself : the
+    video is not decoded a second time. The cover output is placed right after
+    the inputs, before the options of the main output.
+
+    Args:
+        ffmpeg_cmd (list): The command, with a single input.
+        plan (EncodePlan): Streams of the input, from `probe.plan_encode`.
+        cover (Path): Where to write the cover.
+        duration (float): Duration of the input, to spread the candidates over it.
+    """
+    if plan is None or plan.video is None:
+        return ffmpeg_cmd
+    cover.unlink(missing_ok=True)
+    outputs = ffmpeg_cmd.index("-i") + 2
+    return [*ffmpeg_cmd[:outputs],
+            "-map", f"0:{plan.video.index}", "-vf", cover_filter(duration),
+            "-frames:v", "1", "-update", "1", "-q:v", str(JPEG_QUALITIES[1]), str(cover),
+            *ffmpeg_cmd[outputs:]]
+
+
+async def extract_cover(video_path: Path, cover: Path, duration: float | None = None) -> Path | None:
+    """
+    Write the cover of a video whose encoding did not produce one (segments, remux, ladder).
+
+    Only a few frames after a third of the video are decoded.
+
+    Returns:
+        Path | None: The cover, None if the video has no frame to show.
+    """
+    start = duration / 3 if duration else 0
+    try:
+        await run_ffmpeg(["ffmpeg", "-y", "-loglevel", "error", "-ss", f"{start:.3f}", "-i", str(video_path),
+                          "-map", "0:v:0", "-vf", f"{SCALE_FILTER},thumbnail=25",
+                          "-frames:v", "1", "-update", "1", "-q:v", str(JPEG_QUALITIES[1]), str(cover)])
+    except (OSError, RuntimeError) as e:
+        logger.warning(f"Cannot extract the cover of {video_path.name}: {e}")
+        return None
+    return cover if cover.exists() else None
+
+
+async def normalize_image(source: Path, destination: Path) -> Path:
+    """
+    Convert an image to a JPEG within the Telegram thumbnail limits.
+
+    Raises:
+        RuntimeError: If ffmpeg cannot read the image or the thumbnail stays too big.
+    """
+    for quality in JPEG_QUALITIES:
+        await run_ffmpeg(["ffmpeg", "-y", "-loglevel", "error", "-i", str(source), "-vf", SCALE_FILTER,
+                          "-frames:v", "1", "-update", "1", "-q:v", str(quality), str(destination)])
+        if destination.stat().st_size <= THUMBNAIL_MAX_BYTES:
+            return destination
+    destination.unlink(missing_ok=True)
+    raise RuntimeError(f"Thumbnail of {source.name} still above {THUMBNAIL_MAX_BYTES} bytes")
+
+
+async def video_attributes(video_path: Path) -> dict:
+    """Duration and size of an encoded video for send_video : Telegram does not have to compute them."""
+    try:
+        info = await probe_media(video_path)
+    except (OSError, RuntimeError, KeyError, ValueError) as e:
+        logger.warning(f"Cannot probe {video_path.name} before its upload: {e}")
+        return {}
+    attributes = {}
+    if info.duration:
+        attributes["duration"] = max(1, round(info.duration))
+    if info.video is not None and info.video.width:
+        attributes["width"], attributes["height"] = info.video.display_size
+    return attributes
+
+
+class UserThumbnails:
+    """
+    Custom thumbnails of the users, as sent (`<user_id>/thumbnail.jpeg`) and
+    normalized to the Telegram limits. The normalized copy is made once and
+    kept until the user sends another image.
+    """
+
+    def __init__(self, root: Path | None = None):
+        self.root = root
+        # One lock per user : the thumbnails of different users are normalized at the same time.
+        # A lock is dropped once no normalization holds or waits for it
+        self._locks: weakref.WeakValueDictionary[str, asyncio.Lock] = weakref.WeakValueDictionary()
+
+    def original_path(self, user_id: str) -> Path:
+        return (self.root or Path.cwd()) / user_id / "thumbnail.jpeg"
+
+    def normalized_path(self, user_id: str) -> Path:
+        return (self.root or Path.cwd()) / user_id / f"thumbnail_{THUMBNAIL_SIZE}.jpeg"
+
+    async def get(self, user_id: str) -> Path | None:
+        """
+        Normalized thumbnail of a user, made now if the image is new.
+
+        Returns:
+            Path | None: None if the user has no thumbnail, or an unusable one.
+        """
+        original = self.original_path(user_id)
+        normalized = self.normalized_path(user_id)
+        async with self._locks.setdefault(user_id, asyncio.Lock()):
+            if not original.exists():
+                return None
+            if normalized.exists() and normalized.stat().st_mtime >= original.stat().st_mtime:
+                return normalized
+            try:
+                return await normalize_image(original, normalized)
+            except (OSError, RuntimeError) as e:
+                logger.warning(f"Unusable thumbnail for user {user_id}: {e}")
+                return None
+
+    def forget(self, user_id: str) -> bool:
+        """Delete the thumbnail of a user. Returns False if there was none."""
+        self.normalized_path(user_id).unlink(missing_ok=True)
+        original = self.original_path(user_id)
+        if not original.exists():
+            return False
+        original.unlink(missing_ok=True)
+        return True
@@ -0,0 +1,250 @@
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Awaitable, Callable, Iterator
+
+
+logger = logging.getLogger(__name__)
+
+# Directory of the trace files (Chrome trace / Perfetto JSON), tracing is off when empty
+TRACE_DIR = os.environ.get("TRACE_DIR", "")
+# Fraction of the jobs traced
+TRACE_SAMPLE = float(os.environ.get("TRACE_SAMPLE", 1))
+# A handler holding the event loop longer than that (in seconds) at once is logged, 0 to disable
+SLOW_HANDLER_SECONDS = float(os.environ.get("SLOW_HANDLER_SECONDS", 0.5))
+
+# Returned by `span` outside of a trace : nothing to record, nothing to allocate
+_NO_SPAN = nullcontext()
+
+_current_trace: contextvars.ContextVar["Trace | None"] = contextvars.ContextVar("trace", default=None)
+
+
+def _microseconds(timestamp: float) -> int:
+    return int(timestamp * 1_000_000)
+
+
+class Trace:
+    """
+    Spans of one job or one update, in the Chrome trace event format.
+
+    Each asyncio task gets its own track, so that the spans of the download,
+    the encoding and the upload of a job show side by side.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.events: list[dict] = []
+        self._tracks: dict[str, int] = {}
+
+    def _track(self) -> int:
+        task = asyncio.current_task()
+        name = task.get_name() if task is not None else "main"
+        track = self._tracks.get(name)
+        if track is None:
+            track = self._tracks[name] = len(self._tracks) + 1
+            self.events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": track, "args": {"name": name}})
+        return track
+
+    def add(self, name: str, start: float, end: float, **args) -> None:
+        """Record a span between two `time.time()` timestamps."""
+        self.events.append({"name": name, "ph": "X", "pid": 1, "tid": self._track(),
+                            "ts": _microseconds(start), "dur": _microseconds(max(0.0, end - start)),
+                            "args": args})
+
+    @contextmanager
+    def span(self, name: str, **args) -> Iterator[None]:
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.time(), **args)
+
+    def breakdown(self) -> str:
+        """The spans and their durations, in the order they started."""
+        spans = sorted((event for event in self.events if event["ph"] == "X"), key=lambda event: event["ts"])
+        return ", ".join(f"{event['name']} {event['dur'] / 1000:.1f} ms" for event in spans) or "no span"
+
+    def write(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps({"traceEvents": self.events, "displayTimeUnit": "ms",
+                                    "otherData": {"trace": self.name}}))
+
+
+def span(name: str, **args):
+    """
+    Context manager recording a span in the trace of the current job or update.
+
+    Outside of a trace (tracing off, job not sampled) it does nothing.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return _NO_SPAN
+    return trace.span(name, **args)
+
+
+def record(name: str, start: float, end: float, **args) -> None:
+    """Record a span measured by the caller, between two `time.time()` timestamps."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(name, start, end, **args)
+
+
+def current_trace() -> Trace | None:
+    return _current_trace.get()
+
+
+def detached_task(coroutine: Awaitable, name: str | None = None) -> asyncio.Task:
+    """
+    Start a task outside of the current trace.
+
+    A task copies the context it is created in : without this, a task outliving
+    the handler or the job which started it would keep recording its spans in a
+    trace already written.
+    """
+    context = contextvars.copy_context()
+    context.run(_current_trace.set, None)
+    return asyncio.create_task(coroutine, name=name, context=context)
+
+
+class _StepTimer:
+    """
+    Runs a coroutine and measures each of its steps, i.e. each time it holds
+    the event loop between two awaits.
+    """
+
+    def __init__(self, coroutine):
+        self.coroutine = coroutine
+        self.longest = 0.0
+
+    def __await__(self):
+        send, value = self.coroutine.send, None
+        while True:
+            start = time.perf_counter()
+            try:
+                future = send(value)
+            except StopIteration as e:
+                self.longest = max(self.longest, time.perf_counter() - start)
+                return e.value
+            except BaseException:
+                self.longest = max(self.longest, time.perf_counter() - start)
+                raise
+            self.longest = max(self.longest, time.perf_counter() - start)
+            try:
+                value = yield future
+                send = self.coroutine.send
+            except BaseException as e:
+                send, value = self.coroutine.throw, e
+
+
+class Tracer:
+    """
+    Traces of the jobs and of the Telegram handlers.
+
+    A job keeps its trace from the handler which received the video to the
+    end of its upload, and the trace is written to `directory` as
+    `job-<id>.json` (open it in ui.perfetto.dev or chrome://tracing).
+    Handlers holding the event loop longer than `slow_handler` seconds are
+    logged, with the breakdown of their spans and their trace written when
+    the update is traced.
+    """
+
+    def __init__(self, directory: str = TRACE_DIR, sample: float = TRACE_SAMPLE,
+                 slow_handler: float = SLOW_HANDLER_SECONDS):
+        self.directory = Path(directory) if directory else None
+        self.sample = sample
+        self.slow_handler = slow_handler
+        self._jobs: dict[int, Trace] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    def _sampled(self) -> bool:
+        return self.enabled and random.random() < self.sample
+
+    def attach(self, job_id: int, trace: Trace | None = None) -> None:
+        """Continue the trace of an update (the current one by default) as the trace of a job."""
+        trace = trace or _current_trace.get()
+        if trace is not None:
+            trace.name = f"job-{job_id}"
+            self._jobs[job_id] = trace
+
+    def _job_trace(self, job_id: int) -> Trace | None:
+        """Trace of a job, started now if the job has none yet (resumed job, job encoded by a worker)."""
+        trace = self._jobs.get(job_id)
+        if trace is None and self._sampled():
+            trace = self._jobs[job_id] = Trace(f"job-{job_id}")
+        return trace
+
+    @contextmanager
+    def activate(self, job_id: int) -> Iterator[None]:
+        """Record the spans of the block, and of the tasks it starts, in the trace of a job."""
+        token = _current_trace.set(self._job_trace(job_id))
+        try:
+            yield
+        finally:
+            _current_trace.reset(token)
+
+    def enter(self, job_id: int) -> None:
+        """
+        Record the spans of the current task in the trace of a job, for a task running only this job.
+        When the job is not traced, neither is the task : it does not report in the trace of the
+        update which queued the job.
+        """
+        _current_trace.set(self._job_trace(job_id))
+
+    def finish(self, job_id: int, suffix: str = "") -> None:
+        """Write the trace of a finished job."""
+        trace = self._jobs.pop(job_id, None)
+        if trace is not None:
+            self._write(trace, f"job-{job_id}{suffix}.json")
+
+    def _write(self, trace: Trace, name: str) -> None:
+        try:
+            trace.write(self.directory / name)
+        except OSError as e:
+            logger.warning(f"Cannot write the trace {name}: {e}")
+
+    def handler(self, callback: Callable[..., Awaitable]) -> Callable[..., Awaitable]:
+        """Wrap a PTB handler to trace its updates and report it when it blocks the event loop."""
+        if not self.enabled and self.slow_handler <= 0:
+            return callback
+
+        @functools.wraps(callback)
+        async def traced(update, context):
+            if not self._sampled():
+                # Only timed : no trace, no span recorded by the handler
+                timer = _StepTimer(callback(update, context))
+                try:
+                    return await timer
+                finally:
+                    if 0 < self.slow_handler <= timer.longest:
+                        self._report_slow(callback.__name__, update.update_id, timer.longest)
+
+            trace = Trace(f"{callback.__name__}-{update.update_id}")
+            token = _current_trace.set(trace)
+            timer = _StepTimer(callback(update, context))
+            start = time.time()
+            try:
+                return await timer
+            finally:
+                _current_trace.reset(token)
+                trace.add(callback.__name__, start, time.time(), update_id=update.update_id,
+                          longest_step_ms=round(timer.longest * 1000, 1))
+                if 0 < self.slow_handler <= timer.longest:
+                    self._report_slow(callback.__name__, update.update_id, timer.longest, trace)
+        return traced
+
+    def _report_slow(self, name: str, update_id: int, longest: float, trace: Trace | None = None) -> None:
+        breakdown = f": {trace.breakdown()}" if trace is not None else ""
+        logger.warning(f"Handler {name} blocked the event loop for {longest * 1000:.0f} ms "
+                       f"(update {update_id}){breakdown}")
+        if trace is not None:
+            self._write(trace, f"slow-{name}-{update_id}.json")
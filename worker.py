@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import os
+import signal
+import socket
+from dataclasses import asdict
+
+from codec_policy import CodecPolicy
+from compression_queue import WORKER_HEARTBEAT, WORKER_LEASE, CompressionQueue, QueuedJob
+from encoders import probe_encoders
+from engine import COMPRESS_WORKERS, CompressionEngine, JobCancelled
+from pipeline import encode_job, restore_speeds
+from preset_policy import PresetPolicy
+from progress import EncodeProgress
+from tracing import Tracer
+
+# Configuration du logging
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+# Name of this worker in the queue, unique among the running workers
+WORKER_ID = os.environ.get("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+# Number of jobs this worker encodes at the same time
+WORKER_JOBS = int(os.environ.get("WORKER_JOBS", COMPRESS_WORKERS))
+# Seconds between two looks at the queue when the worker has free slots
+WORKER_POLL_INTERVAL = float(os.environ.get("WORKER_POLL_INTERVAL", 2))
+
+
+class QueueWorker:
+    """
+    Encodes the jobs of the shared queue, next to the bot or on another machine.
+
+    The bot keeps everything related to Telegram : it downloads the videos,
+    queues them, relays the progress and uploads the results. Workers only
+    run ffmpeg. The scratch directories must be on a filesystem shared with the
+    bot, at the same path.
+
+    Each claimed job is held with a lease renewed every `heartbeat` seconds. A
+    worker which stops gives its jobs back ; one which crashes loses them when
+    the lease expires, and another worker starts them again.
+    """
+
+    def __init__(self, queue: CompressionQueue,
+                 worker_id: str = WORKER_ID,
+                 jobs: int = WORKER_JOBS,
+                 lease: float = WORKER_LEASE,
+                 heartbeat: float = WORKER_HEARTBEAT,
+                 poll_interval: float = WORKER_POLL_INTERVAL):
+        self.queue = queue
+        self.worker_id = worker_id
+        self.jobs = max(1, jobs)
+        self.lease = lease
+        self.heartbeat = heartbeat
+        self.poll_interval = poll_interval
+        self.engine = CompressionEngine(max_workers=self.jobs)
+        self.policy = PresetPolicy()
+        self.codecs = CodecPolicy()
+        self.tracer = Tracer()
+        self._tasks: dict[int, asyncio.Task] = {}
+        self._stopping = asyncio.Event()
+
+    async def run(self) -> None:
+        """Claim and encode jobs until `stop` is called, then give the running ones back to the queue."""
+        await probe_encoders()
+        restore_speeds(self.policy, self.queue, self.codecs)
+        logger.warning(f"Worker {self.worker_id} started with {self.jobs} slot(s)")
+        try:
+            while not self._stopping.is_set():
+                await asyncio.to_thread(self.queue.register_worker, self.worker_id, self.jobs)
+                while len(self._tasks) < self.jobs:
+                    job = await asyncio.to_thread(self.queue.claim_next, worker_id=self.worker_id, lease=self.lease)
+                    if job is None:
+                        break
+                    logger.info(f"Job {job.job_id} claimed")
+                    self._tasks[job.job_id] = asyncio.create_task(self._run(job), name=f"job-{job.job_id}")
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            tasks = list(self._tasks.values())
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.codecs.stop()
+            await self.engine.shutdown()
+            self.queue.unregister_worker(self.worker_id)
+            logger.warning(f"Worker {self.worker_id} stopped")
+
+    def stop(self) -> None:
+        self._stopping.set()
+
+    async def _run(self, job: QueuedJob) -> None:
+        progress: EncodeProgress | None = None
+
+        def on_progress(current: EncodeProgress) -> None:
+            nonlocal progress
+            progress = current
+
+        # The bot has its own trace of the job, this one holds the encoding
+        with self.tracer.activate(job.job_id):
+            encoding = asyncio.create_task(encode_job(self.engine, self.queue, self.policy, job,
+                                                      workers=self.jobs, on_progress=on_progress,
+                                                      codecs=self.codecs))
+        lost = False
+        try:
+            # Renew the lease while encoding : a refusal means the job was cancelled or reclaimed
+            while not encoding.done():
+                await asyncio.wait({encoding}, timeout=self.heartbeat)
+                if encoding.done():
+                    break
+                state = None if progress is None else {
+                    name: value for name, value in asdict(progress).items() if name != "started_at"}
+                if not await asyncio.to_thread(self.queue.heartbeat, job.job_id, self.worker_id, self.lease, state):
+                    logger.warning(f"Job {job.job_id} lost, stopping its encoding")
+                    lost = True
+                    encoding.cancel()
+                    break
+            result = await encoding
+            await asyncio.to_thread(self.queue.complete, job.job_id, self.worker_id, result.to_dict())
+        except (JobCancelled, asyncio.CancelledError):
+            if not encoding.done():
+                encoding.cancel()
+                await asyncio.gather(encoding, return_exceptions=True)
+            if not lost:
+                # Stopped with the worker : another one starts the job again
+                self.queue.release(job.job_id, self.worker_id)
+                raise
+        except Exception as e:
+            logger.error(f"Job {job.job_id} failed: {e}")
+            await asyncio.to_thread(self.queue.complete, job.job_id, self.worker_id, {"error": str(e)})
+        finally:
+            # The encoding is over : if the job was cancelled, the bot may now remove its files
+            self.queue.acknowledge_cancel(job.job_id, self.worker_id)
+            self._tasks.pop(job.job_id, None)
+            self.tracer.finish(job.job_id, suffix=f"-{self.worker_id}")
+
+
+async def main() -> None:
+    worker = QueueWorker(CompressionQueue())
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, worker.stop)
+    await worker.run()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())